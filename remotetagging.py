@@ -9,15 +9,75 @@ The credentials used to access Docker Hub has to be set as environment variables
 PLease note that for deleting aliases the DOCKER_TOKER must be the real password of DOCKER_USERNAME,
 the accces token does not work here.
 
+The registry can be replaced with the environment variable DOCKER_REGISTRY_URL (default
+https://registry-1.docker.io), e.g. with http://127.0.0.1:5000 for a local stub.
+
+Registry tokens are kept in the token cache shared with sc-app-deploy.py (see sad_common.token_cache),
+so consecutive runs reuse a valid token instead of authenticating again.
+The Docker Hub tag listing of --retention is kept in the tag index shared with sc-app-deploy.py (see
+sad_common.tag_index) and revalidated with a conditional request, a repository whose tags this script
+changed is dropped from the index.
+
+Batch mode: instead of a single --tag/--alias pair the operations can be read from a file (--batch)
+with one operation per line, lines starting with '#' are ignored:
+    add <repo> <tag> <alias>
+    del <repo> <tag>
+    copy <repo> <tag> <target> <alias>
+<repo> can be 'all' for all repositories deployed by sc-app-deploy, <tag> of a deletion can be a glob
+pattern like 'feature_*_latest'. Both --repo and --tag of the command line accept the same, e.g.
+    remotetagging.py --del --repo all --tag 'feature_SC-1*_latest' --dry-run
+The tags of each repository are listed once, the operations run concurrently over one session per
+repository. Deletions are confirmed once for the whole plan, --yes skips the question and --dry-run
+only prints the plan. --rate limits the operations per second.
+
+Deleting a tag deletes its manifest and with it every tag of the same digest, e.g. the tag an alias was
+added to. Deletions are therefore planned against the Docker Hub listing, which carries the digests:
+a tag sharing its digest with a tag that is kept (or added by the same batch) is not deleted, the plan
+lists these tags with the tag they share the digest with. Of several deleted tags with the same digest
+one deletion removes them all, the plan lists the others as removed together with it.
+
+Retention mode (--retention) deletes outdated branch tags according to a policy (see
+sad_common.tag_retention), e.g. keep the 5 newest feature and hotfix tags per repository and
+delete the others older than 30 days:
+    remotetagging.py --retention --repo all --keep-last 5 --max-age 30 --protect 'hotfix_SC-9*' --dry-run
+
+Promotion (--promote, batch: copy) copies a tag into another repository
+of the registry, also of another namespace. <target> is a repository like 'schulcloud-server-prod', a
+repository with namespace like 'otherns/schulcloud-server' or only a namespace like 'otherns/' to keep the
+repository name, the only target allowed for 'all'. The layers are mounted from the source repository, only the manifests are uploaded, so no
+layer passes through the machine running the script. Multi-arch images (manifest lists) keep their digest:
+    remotetagging.py --promote --repo all --tag release_v26.1_latest --to schulcloud-staging/ --alias v26.1
+
+The registry calls are timed (see sad_common.instrumentation): a summary per call type is logged at the end,
+--trace-file appends every call as JSON line and --metrics-file writes the summary as Prometheus textfile.
+
 Parameters specification is available while calling the script with option --help
 """
 from logging import INFO
 import os
-from os import name
 import sys
 import logging
+import fnmatch
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from dxf import DXF
 import argparse
+from urllib.parse import urlparse
+
+# Share the helpers of sc-app-deploy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sc-app-deploy'))
+from sad_common.instrumentation import span, tracer
+from sad_common.manifest_copy import ManifestCopier
+from sad_common.token_cache import TokenCache
+from sad_common.docker_helper import DockerRegistry
+from sad_common.tag_index import TagIndex
+from sad_common.tag_retention import RetentionPolicy, RateLimiter, excludeSharedDigests, selectExpiredTags
+
+registry_url = urlparse(os.environ.get('DOCKER_REGISTRY_URL', 'https://registry-1.docker.io'))
+registry_host = registry_url.netloc
+token_cache = TokenCache()
+# Concurrent operations per repository
+operation_workers = 4
 
 def parseArguments():
     '''
@@ -25,14 +85,48 @@ def parseArguments():
     '''
     parser = argparse.ArgumentParser(description='Add or delete tags on Docker Hub.')
 
-    parser.add_argument('--version', action='version', version='1.0.0')
-    parser.add_argument('--repo', dest='repo', required=True)
+    parser.add_argument('--version', action='version', version='1.1.0')
+    parser.add_argument('--repo', dest='repo', help="Repository without namespace, 'all' for all repositories")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--add', dest='add_tag', action='store_true')
     group.add_argument('--del', dest='del_tag', action='store_true')
-    parser.add_argument('--tag', dest='exist_tag', required=True)
+    group.add_argument('--batch', dest='batch_file', help='File with one add or del operation per line')
+    group.add_argument('--retention', dest='retention', action='store_true', help='Delete branch tags according to the retention policy')
+    group.add_argument('--promote', dest='promote', action='store_true', help='Copy --tag as --alias into the repository --to, moving manifests only')
+    parser.add_argument('--tag', dest='exist_tag', help='Existing tag, for --del a glob pattern is allowed')
     parser.add_argument('--alias', dest='new_tag')
+    parser.add_argument('--to', dest='target', help="Target of --promote: 'repo', 'namespace/repo' or 'namespace/' (default: --repo)")
+    parser.add_argument('--yes', dest='yes', action='store_true', help='Do not ask before deleting tags')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='Print the planned operations only')
+    parser.add_argument('--rate', dest='rate', type=float, help='Maximum operations per second (default: 5 for --retention, otherwise unlimited)')
+    parser.add_argument('--tag-cache-max-age', dest='tag_cache_max_age', type=int, default=0,
+                        help='Seconds the Docker Hub tag listing is used from the tag index without asking Docker Hub (default: 0)')
+    parser.add_argument('--refresh-tags', dest='refresh_tags', action='store_true', help='Ignore the tag index of earlier runs and list the tags again')
+    parser.add_argument('--no-tag-cache', dest='no_tag_cache', action='store_true', help='Neither read nor write the tag index')
+    parser.add_argument('--trace-file', dest='trace_file', help='File the timed registry calls are appended to as JSON lines')
+    parser.add_argument('--metrics-file', dest='metrics_file', help='Prometheus textfile the timings of the run are written to')
+    retention = parser.add_argument_group('retention policy')
+    retention.add_argument('--keep-last', dest='keep_last', type=int, help='Number of newest tags kept per branch prefix')
+    retention.add_argument('--max-age', dest='max_age', type=int, help='Days after which tags beyond --keep-last are deleted')
+    retention.add_argument('--prefix', dest='prefixes', action='append', help="Branch prefix managed by the policy, repeatable (default: feature and hotfix)")
+    retention.add_argument('--protect', dest='protected', action='append', help='Glob pattern of tags that are never deleted, repeatable')
     args = parser.parse_args()
+    if args.rate != None and args.rate <= 0:
+        parser.error('--rate must be greater than 0')
+    if args.retention:
+        if args.repo == None:
+            parser.error('--retention requires --repo')
+        if args.keep_last == None and args.max_age == None:
+            parser.error('--retention requires --keep-last or --max-age')
+        if args.rate == None:
+            args.rate = 5
+    elif args.batch_file == None:
+        if args.repo == None or args.exist_tag == None:
+            parser.error('--add, --del and --promote require --repo and --tag')
+        if (args.add_tag or args.promote) and args.new_tag == None:
+            parser.error('--add and --promote require --alias')
+        if args.promote and args.repo == 'all' and args.target != None and not args.target.endswith('/'):
+            parser.error("--promote --repo all copies every repository, --to must be a namespace like 'otherns/'")
     return args
 
 def query_yes_no(question, default="no"):
@@ -68,8 +162,259 @@ def query_yes_no(question, default="no"):
                              "(or 'y' or 'n').\n")
 
 
-def auth(dxf, response):
-    dxf.authenticate(os.environ.get("DOCKER_USERNAME"), os.environ.get("DOCKER_TOKEN"), response=response)
+def auth(dxf, response, cacheKey):
+    '''
+    Called by DXF if the registry answers with 401, i.e. without or with an expired or insufficient token.
+    Authenticates again and stores the new token in the token cache.
+    '''
+    username = os.environ.get("DOCKER_USERNAME")
+    with span('dxf_auth', repo=cacheKey):
+        token = dxf.authenticate(username, os.environ.get("DOCKER_TOKEN"), response=response)
+    if token != None:
+        token_cache.putToken(username, cacheKey, token)
+
+def getRepository(repo):
+    '''
+    Returns the repository with namespace, like 'schulcloud/schulcloud-server' for 'schulcloud-server'.
+    '''
+    return repo if '/' in repo else 'schulcloud/{}'.format(repo)
+
+def createDXF(repo):
+    '''
+    Returns the DXF client for the repository, prepared with the cached token if there is a valid one.
+    Registry tokens are scoped to a repository, so they are cached per repository.
+    '''
+    repository = getRepository(repo)
+    cacheKey = '{}/{}'.format(registry_host, repository)
+    dxf = DXF(registry_host, repository, lambda dxf, response: auth(dxf, response, cacheKey), insecure=registry_url.scheme == 'http')
+    token = token_cache.getToken(os.environ.get("DOCKER_USERNAME"), cacheKey)
+    if token != None:
+        logging.info("Reusing cached registry token for '{}'".format(repo))
+        dxf.token = token
+    return dxf
+
+
+class TagOperation:
+    '''
+    Dataclass of a single add, del or copy operation on a repository.
+    '''
+
+    def __init__(self, action, repo, tag, alias=None, target=None):
+        '''
+        The action 'add', 'del' or 'copy'.
+        The repo like 'schulcloud-server', 'all' until the operation is expanded.
+        The tag like 'develop_latest', for 'del' a glob pattern until the operation is expanded.
+        The alias like 'feature_SC-1234_latest' for 'add' and 'copy'.
+        The target repository of 'copy' like 'otherns/schulcloud-server', 'otherns/' until the operation is expanded.
+        '''
+        self.action = action
+        self.repo = repo
+        self.tag = tag
+        self.alias = alias
+        self.target = target
+
+    def __str__(self):
+        if self.action == 'add':
+            return "add '{}' to '{}' in repository '{}'".format(self.alias, self.tag, self.repo)
+        if self.action == 'copy':
+            return "copy '{}' of repository '{}' as '{}' to repository '{}'".format(self.tag, self.repo, self.alias, self.target)
+        return "del '{}' in repository '{}'".format(self.tag, self.repo)
+
+def readOperations(parsedArgs):
+    '''
+    Returns the operations given on the command line or in the batch file.
+    '''
+    if parsedArgs.batch_file == None:
+        if parsedArgs.promote:
+            return [TagOperation('copy', parsedArgs.repo, parsedArgs.exist_tag, parsedArgs.new_tag, parsedArgs.target or parsedArgs.repo)]
+        action = 'add' if parsedArgs.add_tag else 'del'
+        return [TagOperation(action, parsedArgs.repo, parsedArgs.exist_tag, parsedArgs.new_tag)]
+    operations = []
+    with open(parsedArgs.batch_file) as batchFile:
+        for lineNumber, line in enumerate(batchFile, 1):
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            if fields[0] == 'add' and len(fields) == 4:
+                operations.append(TagOperation('add', fields[1], fields[2], fields[3]))
+            elif fields[0] == 'del' and len(fields) == 3:
+                operations.append(TagOperation('del', fields[1], fields[2]))
+            elif fields[0] == 'copy' and len(fields) == 5 and fields[1] == 'all' and not fields[3].endswith('/'):
+                raise ValueError("Invalid operation in '{}' line {}: copying 'all' repositories needs a target namespace like 'otherns/'".format(
+                    parsedArgs.batch_file, lineNumber))
+            elif fields[0] == 'copy' and len(fields) == 5:
+                operations.append(TagOperation('copy', fields[1], fields[2], fields[4], fields[3]))
+            else:
+                raise ValueError("Invalid operation in '{}' line {}: '{}'".format(parsedArgs.batch_file, lineNumber, line.strip()))
+    return operations
+
+def expandRepository(repo):
+    '''
+    Returns the repositories deployed by sc-app-deploy for 'all', otherwise the given repository.
+    '''
+    if repo != 'all':
+        return [repo]
+    from sad_deploy.deploy_commands import getApplications
+    return [sc_image['image_name'] for sc_image in getApplications()]
+
+def expandRepositories(operations):
+    '''
+    Replaces the repository 'all' by the repositories deployed by sc-app-deploy
+    and a target namespace like 'otherns/' by the repository in that namespace.
+    '''
+    expanded = []
+    for operation in operations:
+        for repo in expandRepository(operation.repo):
+            target = operation.target
+            if target != None and target.endswith('/'):
+                target += repo
+            elif target == 'all':
+                # --promote without --to copies within each repository
+                target = repo
+            expanded.append(TagOperation(operation.action, repo, operation.tag, operation.alias, target))
+    return expanded
+
+def listTagDescriptions(repos):
+    '''
+    Lists the tags of the repositories concurrently through the Docker Hub API, which reports the digest
+    and when a tag was last updated. Returns a dictionary repo -> list of tag descriptions.
+    '''
+    repos = list(repos)
+    registries = {}
+    for repo in repos:
+        namespace = getRepository(repo).split('/', 1)[0]
+        if namespace not in registries:
+            registries[namespace] = DockerRegistry(namespace)
+            registries[namespace].dockerRegistryLogin()
+
+    def listRepository(repo):
+        namespace, repoName = getRepository(repo).split('/', 1)
+        return list(registries[namespace].listTags(repoName))
+
+    with ThreadPoolExecutor(max_workers=max(1, len(repos))) as executor:
+        return dict(zip(repos, executor.map(listRepository, repos)))
+
+def planRetention(parsedArgs):
+    '''
+    Lists the tags of the repositories once through the Docker Hub API and returns the deletions
+    required by the retention policy and the tags removed together with them as list of
+    (operation, removedWith) tuples. Expired tags whose manifest is shared with kept tags are kept.
+    '''
+    policy = RetentionPolicy(parsedArgs.prefixes, parsedArgs.protected, parsedArgs.keep_last, parsedArgs.max_age)
+    logging.info("Retention policy: {}".format(policy))
+    repos = expandRepository(parsedArgs.repo)
+    tagsByRepo = listTagDescriptions(repos)
+    plan = []
+    together = []
+    for repo in repos:
+        expired, skipped, removed = selectExpiredTags(tagsByRepo[repo], policy)
+        logging.info("Repository '{}': {} tag(s), {} expired, {} expired but kept".format(repo, len(tagsByRepo[repo]), len(expired) + len(removed), len(skipped)))
+        deletions = {}
+        for tagName, reason in expired:
+            logging.debug("'{}' in '{}' expired: {}".format(tagName, repo, reason))
+            deletions[tagName] = TagOperation('del', repo, tagName)
+        plan += deletions.values()
+        together += [(TagOperation('del', repo, tagName), deletions[removedWith]) for tagName, removedWith in removed]
+        for tagName, reason in skipped:
+            logging.info("Not deleting '{}' in '{}': {}".format(tagName, repo, reason))
+    return plan, together
+
+def planOperations(operations, aliases, descriptions):
+    '''
+    Expands the tag patterns of the deletions against the listed tags (aliases: repo -> list of tags).
+    Deletions that would remove other tags with the same digest are skipped, see excludeSharedDigests
+    (descriptions: repo -> tag descriptions of the repositories with deletions). Aliases added by the
+    operations count as kept tags with the digest of their tag.
+    Returns the planned operations, the rejected additions of tags that do not exist, the skipped
+    deletions as list of (operation, reason) tuples and the deletions done by another deletion of the
+    same digest as list of (operation, removedWith) tuples.
+    '''
+    plan = []
+    rejected = []
+    deletions = {}
+    for operation in operations:
+        existing = aliases[operation.repo]
+        if operation.action == 'del':
+            matches = sorted(tag for tag in existing if fnmatch.fnmatchcase(tag, operation.tag))
+            if len(matches) == 0:
+                logging.warning("No tag matches '{}' in repository '{}'".format(operation.tag, operation.repo))
+            deletions.setdefault(operation.repo, []).extend(matches)
+        elif operation.tag not in existing:
+            logging.error("Tag '{}' does not exist in repository '{}', cannot {}".format(operation.tag, operation.repo, operation))
+            rejected.append(operation)
+        else:
+            plan.append(operation)
+    skipped = []
+    together = []
+    for repo, tagNames in deletions.items():
+        tags = list(descriptions[repo])
+        digests = dict((tag['name'], tag.get('digest')) for tag in tags)
+        tags += [{'name': operation.alias, 'digest': digests.get(operation.tag)} for operation in plan
+                 if operation.action == 'add' and operation.repo == repo]
+        deletable, shared, removed = excludeSharedDigests(tags, [(tagName, None) for tagName in dict.fromkeys(tagNames)])
+        repoDeletions = dict((tagName, TagOperation('del', repo, tagName)) for tagName, _ in deletable)
+        plan += repoDeletions.values()
+        skipped += [(TagOperation('del', repo, tagName), reason) for tagName, reason in shared]
+        together += [(TagOperation('del', repo, tagName), repoDeletions[removedWith]) for tagName, removedWith in removed]
+    return plan, rejected, skipped, together
+
+def runOperation(dxfs, operation, limiter=None, copier=None):
+    '''
+    Runs the operation over the DXF clients of its repositories (dxfs: repo -> DXF),
+    returns None on success otherwise the exception.
+    '''
+    dxf = dxfs[operation.repo]
+    try:
+        if limiter != None:
+            limiter.wait()
+        logging.info(str(operation))
+        if operation.action == 'copy':
+            with span('dxf_copy', repo=operation.repo, target=operation.target):
+                (copier or ManifestCopier()).copy(dxf, getRepository(operation.repo), dxfs[operation.target], getRepository(operation.target),
+                                                  operation.tag, operation.alias)
+        elif operation.action == 'add':
+            with span('dxf_get_manifest', repo=operation.repo):
+                manifest = dxf.get_manifest(operation.tag)
+            with span('dxf_set_manifest', repo=operation.repo):
+                dxf.set_manifest(operation.alias, manifest)
+        else:
+            with span('dxf_del_alias', repo=operation.repo):
+                dxf.del_alias(operation.tag)
+        if DockerRegistry.tag_index != None:
+            # The tags changed, the next lookup must not be answered from the index
+            DockerRegistry.tag_index.invalidate(getRepository(operation.target if operation.action == 'copy' else operation.repo))
+        return None
+    except Exception as ex:
+        logging.error("Failed to {}: {}".format(operation, ex))
+        return ex
+
+def runOperations(dxfs, plan, rate=None):
+    '''
+    Runs the planned operations concurrently over the DXF clients of their repositories,
+    at most rate operations per second if given. The copies share the mounted blobs.
+    Returns the failed operations.
+    '''
+    if len(plan) == 0:
+        return []
+    limiter = RateLimiter(rate) if rate != None else None
+    copier = ManifestCopier()
+    workers = min(len(plan), operation_workers * len(dxfs))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        errors = list(executor.map(lambda operation: runOperation(dxfs, operation, limiter, copier), plan))
+    return [operation for operation, error in zip(plan, errors) if error != None]
+
+def listAliases(dxfs, repos=None):
+    '''
+    Lists the tags of the repositories (default: all) concurrently, returns a dictionary repo -> list of tags.
+    '''
+    def listRepository(repo):
+        with span('dxf_list_aliases', repo=repo):
+            return dxfs[repo].list_aliases(batch_size=1000)
+
+    repos = list(dxfs) if repos == None else list(repos)
+    with ThreadPoolExecutor(max_workers=len(repos)) as executor:
+        aliases = executor.map(listRepository, repos)
+        return dict(zip(repos, aliases))
 
 
 if __name__ == '__main__':
@@ -77,20 +422,60 @@ if __name__ == '__main__':
         logging.basicConfig(level=logging.INFO)
         parsedArgs = parseArguments()
         logging.info('Call arguments given: %s' % sys.argv[1:])
-        dxf = DXF('registry-1.docker.io', 'schulcloud/{}'.format(parsedArgs.repo), auth)
-        if hasattr(parsedArgs, 'add_tag') and parsedArgs.add_tag == True:
-            logging.info("Adding tag '{}' to '{}' in repository '{}'".format(parsedArgs.new_tag, parsedArgs.exist_tag, parsedArgs.repo))
-            manifest = dxf.get_manifest('{}'.format(parsedArgs.exist_tag))
-            dxf.set_manifest('{}'.format(parsedArgs.new_tag), manifest)
+        tracer.configure(parsedArgs.trace_file, parsedArgs.metrics_file)
+        DockerRegistry.tag_index = None if parsedArgs.no_tag_cache else TagIndex(max_age=parsedArgs.tag_cache_max_age, refresh=parsedArgs.refresh_tags)
+        if parsedArgs.retention:
+            operations, together = planRetention(parsedArgs)
         else:
-            logging.info("Deleting tag '{}' in repository '{}'".format(parsedArgs.exist_tag, parsedArgs.repo))
-            suretodel = query_yes_no("Are you sure to delete tag '{}' from '{}'".format(parsedArgs.exist_tag, parsedArgs.repo))
-            if suretodel:
-                dxf.del_alias(parsedArgs.exist_tag)
-        exit(0)
+            operations = expandRepositories(readOperations(parsedArgs))
+        with contextlib.ExitStack() as sessions:
+            # One DXF client and keep-alive session per repository
+            dxfs = {}
+            for operation in operations:
+                for repo in (operation.repo, operation.target):
+                    if repo != None and repo not in dxfs:
+                        dxfs[repo] = sessions.enter_context(createDXF(repo))
+            if parsedArgs.retention:
+                # The deletions are planned from the tag listing already
+                plan, rejected, skipped = operations, [], []
+            else:
+                # Only the tags of the source repositories are needed, a target may not exist yet
+                deleteRepos = set(operation.repo for operation in operations if operation.action == 'del')
+                plan, rejected, skipped, together = planOperations(operations, listAliases(dxfs, set(operation.repo for operation in operations)),
+                                                                   listTagDescriptions(deleteRepos) if deleteRepos else {})
+            logging.info("Planned {} operation(s):".format(len(plan) + len(together)))
+            for operation in plan:
+                logging.info("  {}".format(operation))
+            for operation, removedWith in together:
+                logging.info("  {} (removed together with '{}', same digest)".format(operation, removedWith.tag))
+            if skipped:
+                logging.warning("Not planned, the manifest is shared with other tags:")
+                for operation, reason in skipped:
+                    logging.warning("  {}: {}".format(operation, reason))
+            if parsedArgs.dry_run:
+                exit(1 if rejected or skipped else 0)
+            deletions = len([operation for operation in plan if operation.action == 'del']) + len(together)
+            if deletions > 0 and not parsedArgs.yes:
+                if not query_yes_no("Are you sure to delete {} tag(s) as planned above".format(deletions)):
+                    exit(0)
+            failed = runOperations(dxfs, plan, parsedArgs.rate)
+        # A tag removed together with another one is gone if that deletion succeeded
+        failed += [operation for operation, removedWith in together if removedWith in failed]
+        total = len(plan) + len(together)
+        logging.info("{} of {} operation(s) succeeded.".format(total - len(failed), total))
+        if parsedArgs.retention:
+            deleted = plan + [operation for operation, _ in together]
+            for repo in dxfs:
+                removed = len([operation for operation in deleted if operation.repo == repo and operation not in failed])
+                logging.info("Removed {} tag(s) from repository '{}'".format(removed, repo))
+        exit(1 if failed or rejected or skipped else 0)
 
+    except SystemExit as ex:
+        tracer.finish('remotetagging', not ex.code)
+        raise
     except Exception as ex:
         logging.exception(ex)
+        tracer.finish('remotetagging', False)
         exit(1)
 
 
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+'''
+Remote side of sc-app-deploy. The script runs on the docker swarm manager as forced command of the
+remote user "travis", e.g. in ~travis/.ssh/authorized_keys:
+
+    command="/usr/local/bin/sad-remote.py",no-port-forwarding,no-X11-forwarding,no-pty ssh-rsa AAAA...
+
+The command sent by sc-app-deploy.py is read from SSH_ORIGINAL_COMMAND (or the program arguments
+when called directly):
+
+    <image> <service> [<policy>]
+                                Updates the service to the image, like the former forced command
+                                docker service update --force --image <image> <service>
+                                The optional rollout policy (JSON, see sad_infra/rollout_policy.py) like
+                                {"parallelism": 1, "order": "start-first", "delay": 0, "failure_action": "rollback", "monitor": 10}
+                                is applied with the --update-* options of docker service update.
+    inspect <service> ...       Prints '<service> <image>' per service. The image is the one of the
+                                service spec and includes the digest the service runs, like
+                                'schulcloud/schulcloud-server:develop_latest@sha256:...'.
+                                Unknown services are printed with the image '-'.
+    ps <service> ...            Prints the tasks of the services with their task history (ended and
+                                replaced tasks), one per line as
+                                '<service>|<task>|<image>|<current state>|<desired state>|<error>'.
+    pull <image> ...            Pulls the images concurrently on this node while the services keep running,
+                                so the following updates start their tasks on this node without download,
+                                tasks on the other nodes of the swarm still pull the image. Prints one
+                                JSON object per image once it is pulled:
+                                {"image": ..., "event": "pulled", "time": <seconds since the start>,
+                                 "duration": <seconds>, "returncode": ..., "output": [...]}
+                                Exits with 0 once all pulls finished, the result of each is in its event.
+    plan <deploy plan>          Runs the service updates of a deploy plan (JSON, see sad_deploy/deploy_plan.py)
+                                with up to 'parallel' updates at once, each with the rollout 'policy' of its
+                                entry and after the services of its 'after' list, which must come earlier in
+                                the plan. An update whose dependency failed is not run but reported as failed.
+                                The plan is read from stdin if the argument is '-'. Prints one JSON object per
+                                line and event:
+                                {"service": ..., "event": "started", "time": <seconds since the plan started>}
+                                {"service": ..., "event": "finished", "time": ..., "returncode": ..., "output": [...]}
+                                Exits with 0 once all updates finished, the result of each is in its event.
+'''
+
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+docker = '/usr/bin/docker'
+update_orders = ('start-first', 'stop-first')
+failure_actions = ('rollback', 'pause', 'continue')
+
+def getPolicyOptions(policy):
+    '''
+    Returns the docker service update options of the rollout policy (dictionary, None for none).
+    Raises a ValueError for unknown settings or invalid values, only known values reach the docker command line.
+    '''
+    if policy == None:
+        return []
+    if not isinstance(policy, dict):
+        raise ValueError("Invalid rollout policy '%s'" % policy)
+    options = []
+    for name, value in sorted(policy.items()):
+        if name in ('parallelism', 'delay', 'monitor') and isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+            options += ['--update-%s' % name, str(value) if name == 'parallelism' else '%ds' % value]
+        elif name == 'order' and value in update_orders:
+            options += ['--update-order', value]
+        elif name == 'failure_action' and value in failure_actions:
+            options += ['--update-failure-action', value]
+        else:
+            raise ValueError("Invalid rollout setting %s '%s'" % (name, value))
+    return options
+
+def getUpdateCommand(image, service, policy=None, quiet=False):
+    '''
+    Returns the docker command updating the service to the image with the rollout policy.
+    '''
+    return [docker, 'service', 'update', '--force'] + (['--quiet'] if quiet else []) + getPolicyOptions(policy) + ['--image', image, service]
+
+def updateService(image, service, policy=None):
+    '''
+    Updates the service to the image and returns the exit code of docker.
+    '''
+    try:
+        command = getUpdateCommand(image, service, json.loads(policy) if policy != None else None)
+    except ValueError as ex:
+        print("Invalid rollout policy: %s" % ex, file=sys.stderr)
+        return 2
+    return subprocess.call(command)
+
+def inspectServices(services):
+    '''
+    Prints the image including the digest of each service.
+    '''
+    for service in services:
+        process = subprocess.run([docker, 'service', 'inspect', '--format', '{{.Spec.TaskTemplate.ContainerSpec.Image}}', service],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        image = process.stdout.decode().strip() if process.returncode == 0 else '-'
+        print('%s %s' % (service, image), flush=True)
+    return 0
+
+def listTasks(services):
+    '''
+    Prints the tasks of each service including the task history, so restarted tasks can be told.
+    '''
+    for service in services:
+        process = subprocess.run([docker, 'service', 'ps', '--no-trunc',
+                '--format', '{{.Name}}|{{.Image}}|{{.CurrentState}}|{{.DesiredState}}|{{.Error}}', service],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        for line in process.stdout.decode().splitlines():
+            print('%s|%s' % (service, line), flush=True)
+    return 0
+
+def pullImages(images):
+    '''
+    Pulls the images concurrently and prints the result of each as JSON line.
+    '''
+    if any(image.startswith('-') for image in images):
+        print("Invalid image in '%s'" % ' '.join(images), file=sys.stderr)
+        return 2
+    start = time.time()
+    lock = threading.Lock()
+
+    def pull(image):
+        pullStart = time.time()
+        process = subprocess.run([docker, 'pull', '--quiet', image], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.stdout.decode(errors='replace').splitlines()[-20:]
+        event = {'image': image, 'event': 'pulled', 'time': round(time.time() - start, 3), 'duration': round(time.time() - pullStart, 3),
+                 'returncode': process.returncode, 'output': output}
+        with lock:
+            print(json.dumps(event), flush=True)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(images))) as executor:
+        list(executor.map(pull, images))
+    return 0
+
+def readPlan(argument):
+    '''
+    Returns the deploy plan given as argument or on stdin ('-').
+    '''
+    plan = json.loads(sys.stdin.read() if argument == '-' else argument)
+    earlier = set()
+    for update in plan['services']:
+        if not isinstance(update.get('image'), str) or not isinstance(update.get('service'), str):
+            raise ValueError("Invalid plan entry '%s'" % update)
+        getPolicyOptions(update.get('policy'))
+        if any(service not in earlier for service in update.get('after', [])):
+            raise ValueError("Plan entry '%s' comes before a service of its 'after' list" % update['service'])
+        earlier.add(update['service'])
+    return plan
+
+def runPlan(argument):
+    '''
+    Runs the service updates of the plan concurrently and streams the events as JSON lines.
+    '''
+    try:
+        plan = readPlan(argument)
+    except (ValueError, KeyError, TypeError) as ex:
+        print("Invalid deploy plan: %s" % ex, file=sys.stderr)
+        return 2
+    start = time.time()
+    lock = threading.Lock()
+    # The updates are queued in plan order, so the updates a service waits for are running or done
+    finished = {entry['service']: threading.Event() for entry in plan['services']}
+    returncodes = {}
+
+    def emit(event):
+        event['time'] = round(time.time() - start, 3)
+        with lock:
+            print(json.dumps(event), flush=True)
+
+    def update(entry):
+        try:
+            for service in entry.get('after', []):
+                finished[service].wait()
+            failed = [service for service in entry.get('after', []) if returncodes.get(service) != 0]
+            if failed:
+                returncodes[entry['service']] = 1
+                emit({'service': entry['service'], 'event': 'finished', 'returncode': 1,
+                      'output': ["Not updated, the update of '%s' failed" % failed[0]]})
+                return
+            emit({'service': entry['service'], 'event': 'started'})
+            process = subprocess.run(getUpdateCommand(entry['image'], entry['service'], entry.get('policy'), quiet=True),
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            returncodes[entry['service']] = process.returncode
+            output = process.stdout.decode(errors='replace').splitlines()[-20:]
+            emit({'service': entry['service'], 'event': 'finished', 'returncode': process.returncode, 'output': output})
+        finally:
+            finished[entry['service']].set()
+
+    with ThreadPoolExecutor(max_workers=max(1, int(plan.get('parallel', 1)))) as executor:
+        list(executor.map(update, plan['services']))
+    return 0
+
+def main(args):
+    if len(args) >= 1 and args[0] == 'inspect':
+        return inspectServices(args[1:])
+    if len(args) >= 1 and args[0] == 'ps':
+        return listTasks(args[1:])
+    if len(args) >= 2 and args[0] == 'pull':
+        return pullImages(args[1:])
+    if len(args) == 2 and args[0] == 'plan':
+        return runPlan(args[1])
+    if len(args) in (2, 3):
+        return updateService(*args)
+    print("Unsupported command: '%s'" % ' '.join(args), file=sys.stderr)
+    return 2
+
+if __name__ == '__main__':
+    if 'SSH_ORIGINAL_COMMAND' in os.environ:
+        arguments = shlex.split(os.environ['SSH_ORIGINAL_COMMAND'])
+    else:
+        arguments = sys.argv[1:]
+    sys.exit(main(arguments))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+'''
+Offline benchmark of sc-app-deploy and remotetagging.py.
+
+Docker Hub and the registry are replaced by a local HTTP stub with configurable latency, rate limiting
+(429) and missing tags, ssh and the swarm manager by a fake command with configurable delays
+(see sad_benchmark). For every combination of --apps and --hosts a deployment is run, for every --apps
+value a tag retention run and a promotion of multi-arch images. Per scenario the wall time, the HTTP requests (429 answers among them), the
+ssh invocations and the local processes are printed, with --verbose also the timings per phase.
+
+Example for CI, failing if a scenario got more than 25% slower than the stored results:
+    sad-benchmark.py --apps 1,8,50 --hosts 1,5,20 --baseline benchmark.json --tolerance 0.25
+    sad-benchmark.py --apps 1,8,50 --hosts 1,5,20 --save benchmark.json
+'''
+
+import sys
+import logging
+import argparse
+
+from sad_benchmark.harness import compareResults, loadResults, runBenchmarks, saveResults
+
+def parseNumbers(value):
+    try:
+        return [int(number) for number in value.split(',') if number.strip() != '']
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is no comma separated list of numbers" % value)
+
+def parseArguments():
+    '''
+    Parses the program arguments and returns the data parsed by argparse.
+    '''
+    parser = argparse.ArgumentParser(description='Benchmark sc-app-deploy and remotetagging.py against local stand-ins.')
+    parser.add_argument('--apps', type=parseNumbers, default=[1, 8, 50], help='Comma separated numbers of applications (1-50, default: 1,8,50)')
+    parser.add_argument('--hosts', type=parseNumbers, default=[1, 5, 20], help='Comma separated numbers of hosts (1-20, default: 1,5,20)')
+    parser.add_argument('--kinds', type=lambda value: value.split(','), default=['deploy', 'retention', 'promote'],
+                        help='Scenarios to run (default: deploy,retention,promote)')
+    parser.add_argument('--parallel', type=int, default=4, help='Applications rolled out concurrently per host (default: 4)')
+    parser.add_argument('--hostparallel', type=int, help='Hosts deployed concurrently (default: all)')
+    parser.add_argument('--skipunchanged', action='store_true', help='Deploy with --skipunchanged')
+    parser.add_argument('--deployplan', action='store_true', help='Deploy with --deployplan')
+    parser.add_argument('--convergencetimeout', type=int, help='Deploy with --convergencetimeout')
+    parser.add_argument('--convergenceinterval', type=float, default=0.2, help='Seconds between the task state queries (default: 0.2)')
+    parser.add_argument('--tags', type=int, default=40, help='Branch tags per repository for the retention runs (default: 40)')
+    parser.add_argument('--rate', type=float, help='Deletions per second of the retention runs (default: unlimited)')
+    parser.add_argument('--hub-latency', dest='hub_latency', type=float, default=0.02, help='Seconds per HTTP request (default: 0.02)')
+    parser.add_argument('--rate-limit-every', dest='rate_limit_every', type=int, help='Answer every n-th HTTP request with 429 (default: never)')
+    parser.add_argument('--retry-after', dest='retry_after', type=int, default=1, help='Retry-After seconds of the 429 answers (default: 1)')
+    parser.add_argument('--missing-every', dest='missing_every', type=int, help='Every n-th repository lacks the deployed tag (default: none)')
+    parser.add_argument('--ssh-delay', dest='ssh_delay', type=float, default=0.1, help='Seconds per service update (default: 0.1)')
+    parser.add_argument('--ssh-connect-delay', dest='ssh_connect_delay', type=float, default=0.05, help='Seconds per ssh connect (default: 0.05)')
+    parser.add_argument('--save', type=str, help='File the results are written to as JSON')
+    parser.add_argument('--baseline', type=str, help='Results of an earlier run (--save) to compare the wall times with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown against the baseline (default: 0.25 = 25%%)')
+    parser.add_argument('--verbose', action='store_true', help='Print the phase timings and the log of the runs')
+    args = parser.parse_args()
+    if any(apps < 1 or apps > 50 for apps in args.apps):
+        parser.error('--apps must be between 1 and 50')
+    if any(hosts < 1 or hosts > 20 for hosts in args.hosts):
+        parser.error('--hosts must be between 1 and 20')
+    if args.parallel < 1:
+        parser.error('--parallel must be at least 1')
+    return args
+
+
+if __name__ == '__main__':
+    parsedArgs = parseArguments()
+    logging.basicConfig(level=logging.INFO if parsedArgs.verbose else logging.ERROR,
+                        format="%(relativeCreated)8d [%(threadName)-20.20s] [%(levelname)-5.5s]  %(message)s")
+    results = runBenchmarks(parsedArgs)
+    if parsedArgs.save != None:
+        saveResults(results, parsedArgs.save)
+    if parsedArgs.baseline != None:
+        regressions = compareResults(results, loadResults(parsedArgs.baseline), parsedArgs.tolerance)
+        for regression in regressions:
+            print("Regression: %s" % regression)
+        sys.exit(1 if regressions else 0)
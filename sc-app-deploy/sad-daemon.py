@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+'''
+Runs sc-app-deploy as long running deploy service (see sad_deploy.deploy_daemon). Instead of starting
+sc-app-deploy.py per deployment, the deployments are requested over the local HTTP API, e.g.
+
+    curl -X POST -d '{"deployhost": "team", "branchprefix": "develop", "teamnumber": 6}' http://127.0.0.1:8765/deploy
+    curl http://127.0.0.1:8765/status
+    curl http://127.0.0.1:8765/metrics
+
+The ssh key is decrypted once at the start, so CI_GITHUB_TRAVISUSER_SWARMVM_KEY has to be set for the
+daemon only. Requests for the same host and tag are coalesced into one rollout.
+'''
+
+import sys
+import signal
+import logging
+import argparse
+
+from sad_common.docker_helper import DockerRegistry
+from sad_common.sad_logging import initLogging
+from sad_common.tag_index import TagIndex
+from sad_deploy import deploy_commands
+from sad_deploy.application_config import default_application_config
+from sad_deploy.deploy_daemon import DeployDaemon, serve
+
+def parseArguments():
+    '''
+    Parses the program arguments and returns the data parsed by argparse.
+    '''
+    parser = argparse.ArgumentParser(description='Deploy service for branch specific images of Schul-Cloud.')
+    parser.add_argument('--version', action='version', version='1.1.0', help='Prints the script version')
+    parser.add_argument('--bind', type=str, default='127.0.0.1', help='Address the API listens on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='Port the API listens on (default: 8765)')
+    parser.add_argument('--workers', type=int, default=4, help='Number of hosts deployed concurrently (default: 4)')
+    parser.add_argument('--appconfig', type=str, help='Application config with the applications and their rollout policies (default: applications.json)')
+    parser.add_argument('--parallel', type=int, help='Number of applications rolled out concurrently per host (default: parallel of the application config)')
+    parser.add_argument('--updateunchanged', action='store_true', help='Also update services that already run the image digest of the tag')
+    parser.add_argument('--convergencetimeout', type=int, help='Seconds the updated services have to run the new image, not watched if not set')
+    parser.add_argument('--convergenceinterval', type=int, default=5, help='Seconds between the task state queries per host (default: 5)')
+    parser.add_argument('--tagcachemaxage', type=int, default=0, help='Seconds tag lookups are answered from the tag index without asking the registry (default: 0)')
+    parser.add_argument('--refreshtags', action='store_true', help='Ignore the tag index of earlier runs and fetch the tags again')
+    parser.add_argument('--notagcache', action='store_true', help='Neither read nor write the tag index')
+    parser.add_argument('--logformat', choices=['text', 'json'], default='text', help='Format of the log file, json for one JSON object per line (default: text)')
+    parser.add_argument('--deployplan', action='store_true', help='Send all service updates of a host in one remote call (needs remote/sad-remote.py)')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.parallel != None and args.parallel < 1:
+        parser.error('--parallel must be at least 1')
+    return args
+
+
+if __name__ == '__main__':
+    parsedArgs = parseArguments()
+    initLogging(parsedArgs.logformat, 'sad-daemon')
+    logging.info('Call arguments given: %s' % sys.argv[1:])
+    # Stop like on Ctrl+C, so the ssh connections are closed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    DockerRegistry.tag_index = None if parsedArgs.notagcache else TagIndex(max_age=parsedArgs.tagcachemaxage, refresh=parsedArgs.refreshtags)
+    try:
+        deploy_commands.loadApplicationConfig(parsedArgs.appconfig or default_application_config)
+    except Exception as ex:
+        logging.exception(ex)
+        sys.exit(1)
+    parallel = deploy_commands.default_parallel if parsedArgs.parallel == None else parsedArgs.parallel
+    daemon = DeployDaemon(parsedArgs.workers, parallel, not parsedArgs.updateunchanged, parsedArgs.convergencetimeout,
+                          parsedArgs.convergenceinterval, parsedArgs.deployplan)
+    try:
+        serve(daemon, parsedArgs.bind, parsedArgs.port)
+    except Exception as ex:
+        logging.exception(ex)
+        sys.exit(1)
@@ -0,0 +1,7 @@
+import hashlib
+
+def getDigest(image):
+    '''
+    Returns the digest the stand-ins report for an image like 'schulcloud/schulcloud-server:develop_latest'.
+    '''
+    return 'sha256:' + hashlib.sha256(image.encode()).hexdigest()
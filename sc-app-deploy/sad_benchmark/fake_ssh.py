@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+'''
+Stand-in for ssh and remote/sad-remote.py, used with SAD_SSH_COMMAND="<python> fake_ssh.py".
+It accepts the ssh options used by SshTransport and answers the remote commands of sad-remote.py
+without a network or docker:
+
+    -N (master)         Waits the connect delay and creates the ControlPath, so following commands
+                        over that path are not charged the connect delay again
+    -O exit             Removes the ControlPath
+    -O check            Exits with 0 if the ControlPath exists
+    <image> <service> [<policy>]
+                        Waits the update delay and stores the image of the service
+    inspect / ps        Report the stored images, the tasks of updated services run immediately
+    pull                Waits the pull delay per image, concurrently, and reports the pulls
+    plan                Runs the updates of the plan concurrently, after their 'after' services,
+                        and streams the events
+
+Configured by the environment:
+    SAD_FAKE_SSH_DELAY          Seconds per service update (default: 0.1)
+    SAD_FAKE_SSH_CONNECT_DELAY  Seconds per connection without master (default: 0.05)
+    SAD_FAKE_SSH_PULL_DELAY     Seconds per image pull (default: 0.05)
+    SAD_FAKE_SSH_STATE          Directory the images of the services are stored in
+    SAD_FAKE_SSH_LOG            File one line '<host> <command>' per invocation is appended to
+'''
+
+import json
+import os
+import shlex
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sad_benchmark.digests import getDigest
+
+delay = float(os.environ.get('SAD_FAKE_SSH_DELAY', '0.1'))
+connectDelay = float(os.environ.get('SAD_FAKE_SSH_CONNECT_DELAY', '0.05'))
+pullDelay = float(os.environ.get('SAD_FAKE_SSH_PULL_DELAY', '0.05'))
+stateDir = os.environ.get('SAD_FAKE_SSH_STATE')
+
+def parseArguments(args):
+    '''
+    Returns the ssh options as dictionary, the flags, the remote and the remote command.
+    '''
+    options = {}
+    flags = []
+    while args and args[0].startswith('-'):
+        if args[0] in ('-o', '-i', '-O'):
+            key = args[1].split('=', 1)[0] if args[0] == '-o' else args[0]
+            options[key] = args[1].split('=', 1)[-1] if args[0] == '-o' else args[1]
+            args = args[2:]
+        else:
+            flags.append(args[0])
+            args = args[1:]
+    remote = args[0] if args else ''
+    # Like ssh the remote command is joined and split by the remote shell
+    return options, flags, remote, shlex.split(' '.join(args[1:]))
+
+def log(remote, command):
+    logFile = os.environ.get('SAD_FAKE_SSH_LOG')
+    if logFile != None:
+        with open(logFile, 'a') as logs:
+            logs.write('%s %s\n' % (remote.split('@')[-1], command))
+
+def getStateFile(service):
+    return os.path.join(stateDir, service) if stateDir != None else None
+
+def readImage(service):
+    try:
+        with open(getStateFile(service)) as state:
+            return state.read()
+    except (OSError, TypeError):
+        return None
+
+def updateService(image, service):
+    time.sleep(delay)
+    stateFile = getStateFile(service)
+    if stateFile != None:
+        # Written atomically, the service may be inspected concurrently
+        with open(stateFile + '.tmp', 'w') as state:
+            state.write('%s@%s' % (image, getDigest(image)))
+        os.replace(stateFile + '.tmp', stateFile)
+
+def pullImages(images):
+    start = time.time()
+
+    def pull(image):
+        time.sleep(pullDelay)
+        return {'image': image, 'event': 'pulled', 'time': round(time.time() - start, 3), 'duration': pullDelay, 'returncode': 0, 'output': []}
+
+    with ThreadPoolExecutor(max_workers=max(1, len(images))) as executor:
+        for event in executor.map(pull, images):
+            print(json.dumps(event), flush=True)
+
+def runPlan(argument):
+    plan = json.loads(sys.stdin.read() if argument == '-' else argument)
+    start = time.time()
+    lock = threading.Lock()
+    finished = {entry['service']: threading.Event() for entry in plan['services']}
+
+    def emit(event):
+        event['time'] = round(time.time() - start, 3)
+        with lock:
+            print(json.dumps(event), flush=True)
+
+    def update(entry):
+        for service in entry.get('after', []):
+            finished[service].wait()
+        emit({'service': entry['service'], 'event': 'started'})
+        updateService(entry['image'], entry['service'])
+        emit({'service': entry['service'], 'event': 'finished', 'returncode': 0, 'output': []})
+        finished[entry['service']].set()
+
+    with ThreadPoolExecutor(max_workers=max(1, int(plan.get('parallel', 1)))) as executor:
+        list(executor.map(update, plan['services']))
+
+def main(args):
+    options, flags, remote, command = parseArguments(args)
+    controlPath = options.get('ControlPath')
+    if options.get('-O') == 'check':
+        return 0 if controlPath != None and os.path.exists(controlPath) else 255
+    if '-O' in options:
+        log(remote, 'exit')
+        if controlPath != None and os.path.exists(controlPath):
+            os.remove(controlPath)
+        return 0
+    if '-N' in flags:
+        log(remote, 'master')
+        time.sleep(connectDelay)
+        if controlPath != None:
+            open(controlPath, 'w').close()
+        return 0
+    log(remote, command[0] if command and command[0] in ('inspect', 'ps', 'pull', 'plan') else 'update')
+    if controlPath == None or not os.path.exists(controlPath):
+        time.sleep(connectDelay)
+    if command[:1] == ['inspect']:
+        for service in command[1:]:
+            print('%s %s' % (service, readImage(service) or '-'))
+    elif command[:1] == ['ps']:
+        for service in command[1:]:
+            image = readImage(service)
+            if image != None:
+                print('%s|%s.1|%s|Running 1 second ago|Running|' % (service, service, image))
+    elif command[:1] == ['pull'] and len(command) >= 2:
+        pullImages(command[1:])
+    elif command[:1] == ['plan'] and len(command) == 2:
+        runPlan(command[1])
+    elif len(command) in (2, 3):
+        updateService(command[0], command[1])
+    else:
+        print("Unsupported command: '%s'" % ' '.join(command), file=sys.stderr)
+        return 2
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,260 @@
+""" Benchmark harness
+Runs deployments (deployImagesAsync) and tag retention runs of remotetagging.py against
+the local stand-ins: HubStub for Docker Hub and the registry, fake_ssh.py for ssh and the swarm manager.
+Nothing leaves the machine, so the wall times only depend on the code and the configured delays.
+
+For more applications than sc_image_list contains, synthetic applications are appended to the list.
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import logging
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+from sad_benchmark.hub_stub import HubStub, createTags
+from sad_common.docker_helper import DockerRegistry
+from sad_common.instrumentation import tracer
+from sad_deploy import deploy_commands
+from sad_deploy.deploy_engine import deployImagesAsync
+
+# The unmodified application table, synthetic applications are added to a copy of it, set by runBenchmarks
+original_image_list = None
+
+def createImageList(count):
+    '''
+    Returns count entries like the ones of sc_image_list, the real ones first.
+    '''
+    images = original_image_list[:count]
+    for number in range(len(images), count):
+        images.append({'image_name': 'schulcloud-bench-%02d' % number, 'application_name': 'bench%02d' % number})
+    return images
+
+class BenchmarkEnvironment:
+    '''
+    Starts the stand-ins and points sc-app-deploy and remotetagging.py to them through the environment
+    (DOCKER_HUB_URL, DOCKER_REGISTRY_URL, SAD_SSH_COMMAND, SAD_TOKEN_CACHE). Used as context manager.
+    '''
+
+    def __init__(self, hubLatency=0.0, rateLimitEvery=None, retryAfter=1, sshDelay=0.1, sshConnectDelay=0.05):
+        self.stub = HubStub(latency=hubLatency, rateLimitEvery=rateLimitEvery, retryAfter=retryAfter)
+        self.sshDelay = sshDelay
+        self.sshConnectDelay = sshConnectDelay
+        self.workDir = None
+        self.url = None
+        self.environ = None
+
+    def __enter__(self):
+        self.workDir = tempfile.mkdtemp(prefix='sad-benchmark-')
+        self.url = self.stub.start()
+        self.environ = dict(os.environ)
+        fakeSsh = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_ssh.py')
+        os.environ.update({
+            'DOCKER_HUB_URL': self.url + '/v2',
+            'DOCKER_REGISTRY_URL': self.url,
+            'DOCKER_USERNAME': 'benchmark',
+            'DOCKER_TOKEN': 'benchmark',
+            # -S: the stand-in needs no site packages, that saves most of the interpreter start
+            'SAD_SSH_COMMAND': '%s -S %s' % (shlex.quote(sys.executable), shlex.quote(fakeSsh)),
+            'SAD_FAKE_SSH_DELAY': str(self.sshDelay),
+            'SAD_FAKE_SSH_CONNECT_DELAY': str(self.sshConnectDelay)
+        })
+        for name in ('CI_GITHUB_TRAVISUSER_SWARMVM_KEY', 'TESTMODE'):
+            os.environ.pop(name, None)
+        # The base URL is read when the module is imported
+        DockerRegistry.base_url = self.url + '/v2'
+        return self
+
+    def __exit__(self, *args):
+        self.stub.stop()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def prepare(self, name, images, tagCount=0, missingEvery=None, platforms=None):
+        '''
+        Resets the stub and the fake swarm for a scenario. Every missingEvery-th repository has no
+        'develop_latest' tag, with platforms the tags are multi-arch images. Returns the file the ssh
+        invocations are logged to.
+        '''
+        self.stub.reset()
+        for number, sc_image in enumerate(images, 1):
+            tags = createTags(tagCount)
+            if missingEvery and number % missingEvery == 0:
+                tags = tags[1:]
+            self.stub.addRepository(sc_image['image_name'], tags, platforms)
+        scenarioDir = os.path.join(self.workDir, name)
+        os.makedirs(os.path.join(scenarioDir, 'swarm'))
+        os.environ['SAD_FAKE_SSH_STATE'] = os.path.join(scenarioDir, 'swarm')
+        os.environ['SAD_FAKE_SSH_LOG'] = os.path.join(scenarioDir, 'ssh.log')
+        os.environ['SAD_TOKEN_CACHE'] = os.path.join(scenarioDir, 'tokens.json')
+        os.environ['SAD_TAG_INDEX'] = os.path.join(scenarioDir, 'tags')
+        deploy_commands.sc_image_list = images
+        tracer.reset()
+        return os.environ['SAD_FAKE_SSH_LOG']
+
+def countSshCommands(logFile):
+    '''
+    Returns the number of ssh invocations per remote command, see fake_ssh.py.
+    '''
+    counts = {}
+    if os.path.exists(logFile):
+        with open(logFile) as logs:
+            for line in logs:
+                command = line.split()[-1]
+                counts[command] = counts.get(command, 0) + 1
+    counts['total'] = sum(counts.values())
+    return counts
+
+def collectResult(environment: BenchmarkEnvironment, result, sshLog, start, error):
+    result['wall'] = round(time.time() - start, 3)
+    result['error'] = None if error == None else str(error)
+    result['http'] = dict(environment.stub.requests)
+    result['ssh'] = countSshCommands(sshLog)
+    result['phases'] = tracer.getSummary()
+    return result
+
+def runDeployScenario(environment: BenchmarkEnvironment, apps, hosts, options):
+    '''
+    Deploys apps applications to hosts team hosts, returns the measured result as dictionary.
+    '''
+    name = 'deploy-%da-%dh' % (apps, hosts)
+    sshLog = environment.prepare(name, createImageList(apps), missingEvery=options.missing_every)
+    start = time.time()
+    error = None
+    try:
+        deployImagesAsync('team', 'develop', list(range(1, hosts + 1)), '', options.parallel, options.skipunchanged, None, options.hostparallel,
+                          options.convergencetimeout, options.convergenceinterval, options.deployplan)
+    except Exception as ex:
+        error = ex
+    return collectResult(environment, {'scenario': name, 'kind': 'deploy', 'apps': apps, 'hosts': hosts}, sshLog, start, error)
+
+def loadRemoteTagging():
+    '''
+    Imports remotetagging.py of the repository root, None if DXF is not installed.
+    '''
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'remotetagging.py')
+    spec = importlib.util.spec_from_file_location('remotetagging', path)
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except ImportError as ex:
+        logging.warning("Skipping the tagging benchmark: %s" % ex)
+        return None
+    return module
+
+def runTaggingScenario(environment: BenchmarkEnvironment, remotetagging, apps, tagCount, options):
+    '''
+    Runs the tag retention of remotetagging.py over apps repositories with tagCount branch tags each,
+    returns the measured result as dictionary.
+    '''
+    name = 'retention-%da-%dt' % (apps, tagCount)
+    sshLog = environment.prepare(name, createImageList(apps), tagCount=tagCount)
+    remotetagging.token_cache = remotetagging.TokenCache()
+    parsedArgs = argparse.Namespace(repo='all', prefixes=None, protected=None, keep_last=5, max_age=10)
+    start = time.time()
+    error = None
+    failed = []
+    try:
+        plan, _ = remotetagging.planRetention(parsedArgs)
+        with contextlib.ExitStack() as sessions:
+            dxfs = {repo: sessions.enter_context(remotetagging.createDXF(repo)) for repo in sorted(set(op.repo for op in plan))}
+            failed = remotetagging.runOperations(dxfs, plan, options.rate)
+        if failed:
+            error = "%d of %d deletion(s) failed" % (len(failed), len(plan))
+    except Exception as ex:
+        error = ex
+    return collectResult(environment, {'scenario': name, 'kind': 'retention', 'apps': apps, 'tags': tagCount}, sshLog, start, error)
+
+def runPromotionScenario(environment: BenchmarkEnvironment, remotetagging, apps, options):
+    '''
+    Promotes 'develop_latest' of apps multi-arch repositories into another namespace twice (as
+    'staging' and 'production'), returns the measured result as dictionary. The second copy of
+    every image needs no blob mounts.
+    '''
+    name = 'promote-%da' % apps
+    sshLog = environment.prepare(name, createImageList(apps), platforms=['linux/amd64', 'linux/arm64'])
+    remotetagging.token_cache = remotetagging.TokenCache()
+    operations = remotetagging.expandRepositories([remotetagging.TagOperation('copy', 'all', 'develop_latest', alias, 'promoted/')
+                                                   for alias in ('staging', 'production')])
+    start = time.time()
+    error = None
+    try:
+        with contextlib.ExitStack() as sessions:
+            repos = sorted(set(op.repo for op in operations) | set(op.target for op in operations))
+            dxfs = {repo: sessions.enter_context(remotetagging.createDXF(repo)) for repo in repos}
+            failed = remotetagging.runOperations(dxfs, operations, options.rate)
+        if failed:
+            error = "%d of %d copies failed" % (len(failed), len(operations))
+    except Exception as ex:
+        error = ex
+    return collectResult(environment, {'scenario': name, 'kind': 'promote', 'apps': apps}, sshLog, start, error)
+
+def logResult(result, verbose=False):
+    '''
+    Prints one line per scenario, with verbose followed by the phase timings.
+    '''
+    http = result['http']
+    print("%-28s %8.2fs %6d %5d %6d %5d  %s" % (result['scenario'], result['wall'], http.get('total', 0), http.get('429', 0),
+                                                result['ssh']['total'], result['phases'].get('command', {}).get('count', 0),
+                                                result['error'] or 'ok'), flush=True)
+    if verbose:
+        for phase, values in result['phases'].items():
+            print("    %-24s %5d x  p50 %6.3fs  p95 %6.3fs  total %7.2fs" % (phase, values['count'], values['p50'], values['p95'], values['total']))
+
+def compareResults(results, baseline, tolerance):
+    '''
+    Returns the regressions as list of messages: scenarios whose wall time exceeds the one of the
+    baseline results by more than the tolerance (0.25 = 25%).
+    '''
+    previous = {result['scenario']: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result['scenario'])
+        if before == None:
+            continue
+        if result['wall'] > before['wall'] * (1 + tolerance):
+            regressions.append("%s: %.2fs instead of %.2fs" % (result['scenario'], result['wall'], before['wall']))
+        if result['error'] != None and before['error'] == None:
+            regressions.append("%s: %s" % (result['scenario'], result['error']))
+    return regressions
+
+def runBenchmarks(options):
+    '''
+    Runs all scenarios of the options (see sad-benchmark.py) and returns the results.
+    '''
+    global original_image_list
+    original_image_list = list(deploy_commands.getApplications())
+    results = []
+    print("%-28s %9s %6s %5s %6s %5s  %s" % ('scenario', 'wall', 'http', '429', 'ssh', 'procs', 'result'))
+    with BenchmarkEnvironment(options.hub_latency, options.rate_limit_every, options.retry_after, options.ssh_delay,
+                              options.ssh_connect_delay) as environment:
+        if 'deploy' in options.kinds:
+            for apps in options.apps:
+                for hosts in options.hosts:
+                    results.append(runDeployScenario(environment, apps, hosts, options))
+                    logResult(results[-1], options.verbose)
+        remotetagging = loadRemoteTagging() if 'retention' in options.kinds or 'promote' in options.kinds else None
+        if remotetagging != None:
+            for apps in options.apps:
+                if 'retention' in options.kinds:
+                    results.append(runTaggingScenario(environment, remotetagging, apps, options.tags, options))
+                    logResult(results[-1], options.verbose)
+                if 'promote' in options.kinds:
+                    results.append(runPromotionScenario(environment, remotetagging, apps, options))
+                    logResult(results[-1], options.verbose)
+    deploy_commands.sc_image_list = original_image_list
+    return results
+
+def saveResults(results, resultFile):
+    with open(resultFile, 'w') as output:
+        json.dump(results, output, indent=2)
+
+def loadResults(resultFile):
+    with open(resultFile) as results:
+        return json.load(results)
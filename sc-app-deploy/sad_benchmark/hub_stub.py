@@ -0,0 +1,364 @@
+""" Docker Hub stub
+Local HTTP server that answers the Docker Hub API calls of DockerRegistry (DOCKER_HUB_URL=<url>/v2)
+and the registry API calls DXF makes for remotetagging.py (DOCKER_REGISTRY_URL=<url>):
+
+    POST /v2/users/login                                     login, returns a token
+    GET  /v2/repositories/<namespace>/<repo>/tags/<tag>      tag description with digest, 404 for missing tags
+    GET  /v2/repositories/<namespace>/<repo>/tags            paginated tag list, newest first
+    GET  /v2/<namespace>/<repo>/tags/list                    registry tag list
+    GET  /v2/<namespace>/<repo>/manifests/<tag or digest>    image manifest or manifest list
+    PUT  /v2/<namespace>/<repo>/manifests/<tag or digest>    stores the manifest, 400 if a blob or manifest it references is missing
+    DELETE /v2/<namespace>/<repo>/manifests/<digest>         deletes the tags of the manifest
+    POST /v2/<namespace>/<repo>/blobs/uploads/?mount=<digest>&from=<namespace>/<repo>
+                                                             mounts the blob, 201 if the source has it, else 202
+
+Repositories outside the namespace (like 'otherns/schulcloud-server') are created by the first manifest put.
+
+The tag and tag list answers carry an ETag, a request with a matching If-None-Match is answered with 304.
+Every request is answered after the configured latency, every n-th request with 429 and a Retry-After header.
+For tests the next requests can be failed with 502 (failRequests) and the Docker Hub API can require the
+token of the last login (requireToken), so a token issued before expireToken() is answered with 401.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from sad_benchmark.digests import getDigest
+
+schema2_mimetype = 'application/vnd.docker.distribution.manifest.v2+json'
+list_mimetype = 'application/vnd.docker.distribution.manifest.list.v2+json'
+
+def createManifest(image):
+    '''
+    Returns the manifest (bytes) the stub serves for the image.
+    '''
+    return json.dumps({
+        'schemaVersion': 2,
+        'mediaType': schema2_mimetype,
+        'config': {'mediaType': 'application/vnd.docker.container.image.v1+json', 'size': 1, 'digest': getDigest(image + '#config')},
+        'layers': [{'mediaType': 'application/vnd.docker.image.rootfs.diff.tar.gzip', 'size': 1, 'digest': getDigest(image + '#layer')}]
+    }, sort_keys=True).encode()
+
+def createManifestList(image, platforms):
+    '''
+    Returns the manifest list (bytes) the stub serves for a multi-arch image, referencing
+    the manifests createManifest returns for '<image>/<platform>'.
+    '''
+    manifests = []
+    for platform in platforms:
+        manifest = createManifest('%s/%s' % (image, platform))
+        system, architecture = platform.split('/', 1)
+        manifests.append({'mediaType': schema2_mimetype, 'size': len(manifest), 'digest': getManifestDigest(manifest),
+                          'platform': {'os': system, 'architecture': architecture}})
+    return json.dumps({'schemaVersion': 2, 'mediaType': list_mimetype, 'manifests': manifests}, sort_keys=True).encode()
+
+def getManifestDigest(manifest):
+    return 'sha256:' + hashlib.sha256(manifest).hexdigest()
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class HubStub:
+    '''
+    The stub server and its repositories, runs in a background thread between start() and stop().
+    Attributes:
+        - latency: seconds every request is delayed
+        - rateLimitEvery: every n-th request is answered with 429, None for no rate limiting
+        - retryAfter: seconds sent in the Retry-After header of the 429 answers
+        - requireToken: the Docker Hub tag requests need the token of the last login, otherwise 401
+        - token: the token handed out by the login
+        - requests: number of requests per kind like 'tag', 'list', 'login', 'manifest', 'mount', '304', '401', '429' and '502'
+    Repositories of the namespace are keyed by their name, others by their path.
+    '''
+
+    def __init__(self, namespace='schulcloud', latency=0.0, rateLimitEvery=None, retryAfter=1, requireToken=False):
+        self.namespace = namespace
+        self.latency = latency
+        self.rateLimitEvery = rateLimitEvery
+        self.retryAfter = retryAfter
+        self.requireToken = requireToken
+        self.token = 'benchmark-token'
+        self.logins = 0
+        self.failing = 0
+        self.repositories = {}
+        self.platforms = {}
+        self.manifests = {}
+        self.blobs = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def addRepository(self, repo, tags, platforms=None):
+        '''
+        Adds the repository with the given tags as list of (name, last updated datetime) tuples.
+        With platforms like ['linux/amd64', 'linux/arm64'] the tags are multi-arch images.
+        '''
+        with self.lock:
+            self.repositories[repo] = {name: lastUpdated for name, lastUpdated in tags}
+            self.platforms[repo] = platforms
+
+    def failRequests(self, count):
+        '''
+        Answers the next count requests with 502.
+        '''
+        with self.lock:
+            self.failing = count
+
+    def expireToken(self):
+        '''
+        Invalidates the token handed out so far, the next login hands out a new one.
+        '''
+        with self.lock:
+            self.logins += 1
+            self.token = 'benchmark-token-%d' % self.logins
+
+    def reset(self):
+        '''
+        Removes all repositories and resets the request counters.
+        '''
+        with self.lock:
+            self.repositories = {}
+            self.platforms = {}
+            self.manifests = {}
+            self.blobs = {}
+            self.requests = {}
+
+    def count(self, kind, request=True):
+        '''
+        Counts a request of the kind, or with request False an answer like '429' to a request counted already.
+        Returns the number of requests.
+        '''
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            if request:
+                self.requests['total'] = self.requests.get('total', 0) + 1
+            return self.requests.get('total', 0)
+
+    def start(self):
+        '''
+        Starts the server on a free local port and returns its URL like 'http://127.0.0.1:40123'.
+        '''
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                stub.handle(self, 'GET')
+
+            def do_POST(self):
+                stub.handle(self, 'POST')
+
+            def do_PUT(self):
+                stub.handle(self, 'PUT')
+
+            def do_DELETE(self):
+                stub.handle(self, 'DELETE')
+
+        self.server = ThreadingServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, name='hub-stub', daemon=True).start()
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send(self, handler, status, body=b'', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def sendTagged(self, handler, body):
+        '''
+        Answers with the body and its ETag, or with 304 if the client sent that ETag.
+        '''
+        body = json.dumps(body).encode()
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+        if handler.headers.get('If-None-Match') == etag:
+            self.count('304', False)
+            return self.send(handler, 304, b'', {'ETag': etag})
+        self.send(handler, 200, body, {'ETag': etag})
+
+    def handle(self, handler, method):
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(handler.path)
+        kind, respond = self.route(method, url.path, parse_qs(url.query), body, handler.headers.get('Host'))
+        total = self.count(kind)
+        if self.rateLimitEvery and total % self.rateLimitEvery == 0:
+            self.count('429', False)
+            return self.send(handler, 429, {'detail': 'rate limited'}, {'Retry-After': str(self.retryAfter)})
+        with self.lock:
+            failing = self.failing > 0
+            self.failing = max(0, self.failing - 1)
+        if failing:
+            self.count('502', False)
+            return self.send(handler, 502, {'detail': 'bad gateway'})
+        if self.requireToken and kind in ('tag', 'list') and handler.headers.get('Authorization') != 'JWT %s' % self.token:
+            self.count('401', False)
+            return self.send(handler, 401, {'detail': 'invalid token'})
+        respond(handler)
+
+    def route(self, method, path, query, body, host):
+        '''
+        Returns the request kind and the function answering the request.
+        '''
+        hub = re.match(r'^/v2/repositories/([^/]+)/([^/]+)/tags(?:/([^/]+))?/?$', path)
+        registry = re.match(r'^/v2/(.+?)/(tags/list|manifests/([^/]+)|blobs/uploads/?)$', path)
+        repo = None
+        if registry:
+            repo = registry.group(1)[len(self.namespace) + 1:] if registry.group(1).startswith(self.namespace + '/') else registry.group(1)
+        if method == 'POST' and path.rstrip('/') == '/v2/users/login':
+            return 'login', lambda handler: self.send(handler, 200, {'token': self.token})
+        if path.rstrip('/') == '/v2':
+            return 'ping', lambda handler: self.send(handler, 200, {})
+        if hub and hub.group(3) != None:
+            return 'tag', lambda handler: self.getTag(handler, hub.group(2), hub.group(3))
+        if hub:
+            return 'list', lambda handler: self.listTags(handler, hub.group(2), query, host, path)
+        if registry and registry.group(2) == 'tags/list':
+            return 'registry_list', lambda handler: self.send(handler, 200, {'name': registry.group(1),
+                                                                              'tags': sorted(self.repositories.get(repo, {}))})
+        if registry and registry.group(3) == None and method == 'POST':
+            return 'mount', lambda handler: self.mountBlob(handler, registry.group(1), repo, query)
+        if registry and registry.group(3) == None:
+            return 'unknown', lambda handler: self.send(handler, 405, {})
+        if registry and method == 'GET':
+            return 'manifest', lambda handler: self.getManifest(handler, repo, registry.group(3))
+        if registry and method == 'PUT':
+            return 'put_manifest', lambda handler: self.putManifest(handler, repo, registry.group(3), body)
+        if registry and method == 'DELETE':
+            return 'delete_manifest', lambda handler: self.deleteManifest(handler, repo, registry.group(3))
+        return 'unknown', lambda handler: self.send(handler, 404, {})
+
+    def getImage(self, repo, tag):
+        return '%s/%s:%s' % (self.namespace, repo, tag)
+
+    def getTag(self, handler, repo, tag):
+        with self.lock:
+            lastUpdated = self.repositories.get(repo, {}).get(tag)
+        if lastUpdated == None:
+            return self.send(handler, 404, {'message': 'tag not found'})
+        self.sendTagged(handler, {'name': tag, 'digest': getDigest(self.getImage(repo, tag)), 'last_updated': lastUpdated.strftime('%Y-%m-%dT%H:%M:%S.%fZ')})
+
+    def listTags(self, handler, repo, query, host, path):
+        with self.lock:
+            tags = sorted(self.repositories.get(repo, {}).items(), key=lambda tag: tag[1], reverse=True)
+        size = int(query.get('page_size', ['10'])[0])
+        page = int(query.get('page', ['1'])[0])
+        results = [{'name': name, 'digest': getDigest(self.getImage(repo, name)), 'last_updated': lastUpdated.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}
+                   for name, lastUpdated in tags[(page - 1) * size:page * size]]
+        following = 'http://%s%s?page_size=%d&page=%d' % (host, path, size, page + 1) if page * size < len(tags) else None
+        self.sendTagged(handler, {'count': len(tags), 'results': results, 'next': following})
+
+    def createTagManifest(self, repo, tag):
+        image = self.getImage(repo, tag)
+        platforms = self.platforms.get(repo)
+        return createManifestList(image, platforms) if platforms else createManifest(image)
+
+    def findManifest(self, repo, reference):
+        '''
+        Returns the manifest (bytes) of a tag or digest in the repository, None if unknown.
+        '''
+        with self.lock:
+            tags = list(self.repositories.get(repo, {}))
+            pushed = self.manifests.get(repo, {}).get(reference)
+        if pushed != None:
+            return pushed
+        for tag in tags:
+            manifest = self.createTagManifest(repo, tag)
+            if reference in (tag, getManifestDigest(manifest)):
+                return manifest
+            # The platform manifests of a manifest list are only referenced by their digest
+            for entry in json.loads(manifest).get('manifests', []):
+                if entry['digest'] == reference:
+                    return createManifest('%s/%s' % (self.getImage(repo, tag), '%s/%s' % (entry['platform']['os'], entry['platform']['architecture'])))
+        return None
+
+    def hasBlob(self, repo, digest):
+        with self.lock:
+            if digest in self.blobs.get(repo, set()):
+                return True
+            tags = list(self.repositories.get(repo, {})) if repo in self.platforms else []
+        for tag in tags:
+            manifests = [json.loads(self.createTagManifest(repo, tag))]
+            manifests += [json.loads(self.findManifest(repo, entry['digest'])) for entry in manifests[0].get('manifests', [])]
+            for manifest in manifests:
+                if 'config' in manifest and digest in [manifest['config']['digest']] + [layer['digest'] for layer in manifest['layers']]:
+                    return True
+        return False
+
+    def getManifest(self, handler, repo, reference):
+        manifest = self.findManifest(repo, reference)
+        if manifest == None:
+            return self.send(handler, 404, {'errors': [{'code': 'MANIFEST_UNKNOWN'}]})
+        self.send(handler, 200, manifest, {'Content-Type': json.loads(manifest).get('mediaType', schema2_mimetype),
+                                           'Docker-Content-Digest': getManifestDigest(manifest)})
+
+    def putManifest(self, handler, repo, reference, body):
+        parsed = json.loads(body)
+        if 'manifests' in parsed:
+            missing = [entry['digest'] for entry in parsed['manifests'] if self.findManifest(repo, entry['digest']) == None]
+        else:
+            missing = [digest for digest in [parsed['config']['digest']] + [layer['digest'] for layer in parsed['layers']]
+                       if not self.hasBlob(repo, digest)]
+        if missing:
+            return self.send(handler, 400, {'errors': [{'code': 'MANIFEST_BLOB_UNKNOWN', 'detail': missing}]})
+        with self.lock:
+            manifests = self.manifests.setdefault(repo, {})
+            manifests[getManifestDigest(body)] = body
+            if not reference.startswith('sha256:'):
+                manifests[reference] = body
+                self.repositories.setdefault(repo, {})[reference] = datetime.now(timezone.utc)
+        self.send(handler, 201, b'', {'Docker-Content-Digest': getManifestDigest(body)})
+
+    def deleteManifest(self, handler, repo, digest):
+        manifest = self.findManifest(repo, digest)
+        if manifest == None:
+            return self.send(handler, 404, {'errors': [{'code': 'MANIFEST_UNKNOWN'}]})
+        for tag in list(self.repositories.get(repo, {})):
+            if self.findManifest(repo, tag) == manifest:
+                with self.lock:
+                    self.repositories[repo].pop(tag, None)
+                    self.manifests.get(repo, {}).pop(tag, None)
+        with self.lock:
+            self.manifests.get(repo, {}).pop(digest, None)
+        self.send(handler, 202)
+
+    def mountBlob(self, handler, path, repo, query):
+        digest = query.get('mount', [None])[0]
+        source = query.get('from', [''])[0]
+        source = source[len(self.namespace) + 1:] if source.startswith(self.namespace + '/') else source
+        if digest == None or not self.hasBlob(source, digest):
+            # Like a registry without the blob, an upload session is started instead
+            return self.send(handler, 202, b'', {'Location': '/v2/%s/blobs/uploads/benchmark' % path})
+        with self.lock:
+            self.blobs.setdefault(repo, set()).add(digest)
+        self.send(handler, 201, b'', {'Location': '/v2/%s/blobs/%s' % (path, digest), 'Docker-Content-Digest': digest})
+
+def createTags(count, now=None):
+    '''
+    Returns count branch tags with one day between their updates, newest first, plus 'develop_latest'.
+    '''
+    now = now or datetime.now(timezone.utc)
+    tags = [('develop_latest', now)]
+    for number in range(count):
+        prefix = 'feature' if number % 3 else 'hotfix'
+        tags.append(('%s_SC-%d_latest' % (prefix, 1000 + number), now - timedelta(days=number + 1)))
+    return tags
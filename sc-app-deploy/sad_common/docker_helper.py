@@ -5,7 +5,15 @@ import os
 import json
 from textwrap import indent
 import logging
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from sad_common.instrumentation import span
+from sad_common.tag_index import TagIndex
+from sad_common.token_cache import TokenCache
+
 class DockerRegistry:
     ''' Docker Registry Access Helper class
     Docker registry access class allows checking whether a tag exists for an repo in the initialized namespace.
@@ -16,8 +24,24 @@ class DockerRegistry:
         - dockerRegistryLogin: authenticate towards the registry
         - docker RegistryCheckTag: checks whether a tags exist for the specified repository in the initialized namespace
                  returns true if tag exists, otherwise false
+        - dockerRegistryGetTag: returns the description of a tag including its manifest digest, None if the tag does not exist
+        - getTags / checkTags: look up one tag for many repositories concurrently, return a dictionary repo -> description / bool
+        - listTags: yields all tag descriptions of a repository, newest first
+    All requests share one keep-alive session. Requests answered with 429 or 5xx are retried with
+    exponential backoff, a Retry-After header sent by the registry is respected.
+    The base_url can be overridden with the environment variable DOCKER_HUB_URL, e.g. for a local stub.
+    The login token is taken from the shared TokenCache while it is valid; a request rejected with 401
+    drops the cached token and is repeated once after a fresh login.
+    Tag lookups and listings are answered from the tag_index (see sad_common.tag_index) within its staleness
+    window and revalidated with conditional requests otherwise. Set tag_index to None to bypass the index.
     '''
-    base_url = "https://hub.docker.com/v2"
+    base_url = os.environ.get("DOCKER_HUB_URL", "https://hub.docker.com/v2")
+    # Seconds to wait for connect and read
+    timeout = (5, 30)
+    # Number of concurrent lookups and pooled connections
+    max_workers = 8
+    # Index the tags are looked up in before asking the registry, None to always ask the registry
+    tag_index = TagIndex()
     
     def __init__(self, namespace):
         """
@@ -25,31 +49,165 @@ class DockerRegistry:
         """
         self.docker_namespace = namespace
         self.auth_headers = ''
+        self.session = self.createSession()
+        self.token_cache = TokenCache()
+        self.login_lock = threading.Lock()
+
+    def createSession(self):
+        """
+        Creates the keep-alive session with a connection pool sized for the concurrent lookups
+        and the retry policy for rate limited (429) and failing (5xx) requests.
+        """
+        retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
 
-    def dockerRegistryLogin(self):
+    def dockerRegistryLogin(self, force=False):
         """
         Login in the registry specified in the base_url for the namepace used in the initialization
         Credentials are read from the environment (DOCKER_USERNAME, DOCKER_TOKEN)
+        A cached token is reused unless force is set.
         """
-        login_url = f"{self.base_url}/users/login"
-        logging.info("==> Logging into DockerHub")
-        tok_req = requests.post(login_url, json={"username": os.environ.get("DOCKER_USERNAME"), "password": os.environ.get("DOCKER_TOKEN")})
-        token = tok_req.json()["token"]
+        username = os.environ.get("DOCKER_USERNAME")
+        token = None if force else self.token_cache.getToken(username, self.base_url)
+        if token != None:
+            logging.info("==> Reusing cached DockerHub token")
+        else:
+            login_url = f"{self.base_url}/users/login"
+            logging.info("==> Logging into DockerHub")
+            with span('registry_login'):
+                tok_req = self.session.post(login_url, timeout=self.timeout, json={"username": username, "password": os.environ.get("DOCKER_TOKEN")})
+            token = tok_req.json()["token"]
+            self.token_cache.putToken(username, self.base_url, token)
         self.auth_headers = {"Authorization": f"JWT {token}"}
 
-    def dockerRegistryCheckTag(self, repo_name, alias):
+    def authorizedGet(self, url, headers=None, **kwargs):
         """
-        Checks whether a tag (alias) exist for the specified repository (repo_name) in the initialized namespace
-                 returns true if tag exists, otherwise false
+        GET request with the login token and the given headers. If the token is rejected (401) a fresh
+        login is done and the request repeated once.
+        """
+        auth_headers = self.auth_headers
+        response = self.session.get(url, headers=dict(auth_headers, **(headers or {})), timeout=self.timeout, **kwargs)
+        if response.status_code == 401:
+            with self.login_lock:
+                # Concurrent requests share a single fresh login
+                if self.auth_headers == auth_headers:
+                    logging.info("DockerHub rejected the token, logging in again")
+                    self.token_cache.dropToken(os.environ.get("DOCKER_USERNAME"), self.base_url)
+                    self.dockerRegistryLogin(force=True)
+            response = self.session.get(url, headers=dict(self.auth_headers, **(headers or {})), timeout=self.timeout, **kwargs)
+        return response
+
+    def dockerRegistryGetTag(self, repo_name, alias):
         """
-        tags_url = f"{self.base_url}/repositories/{self.docker_namespace}/{repo_name}/tags/{alias}"
-        tags_req = requests.get(tags_url, headers=self.auth_headers)
+        Returns the tag (alias) description of the specified repository (repo_name) in the initialized namespace,
+        a dictionary that contains i.a. the manifest 'digest' and 'last_updated'.
+                 returns None if the tag does not exist
+        """
+        repository = f"{self.docker_namespace}/{repo_name}"
+        cached = None
+        if self.tag_index != None:
+            cached = self.tag_index.getTag(repository, alias)
+            if cached != None and self.tag_index.isFresh(cached['checked']):
+                logging.info("Tag '{}' exists in repository: '{}' (tag index)".format(alias, repo_name))
+                return cached['description']
+            _, listed, _ = self.tag_index.getListing(repository)
+            if cached == None and self.tag_index.isFresh(listed):
+                logging.warning("Tags '{}' does not exists in repository: '{}' (tag index)".format(alias, repo_name))
+                return None
+        tags_url = f"{self.base_url}/repositories/{repository}/tags/{alias}"
+        headers = {"If-None-Match": cached['etag']} if cached != None and cached['etag'] != None else None
+        with span('registry_tag', repo=repo_name):
+            tags_req = self.authorizedGet(tags_url, headers=headers)
+        if tags_req.status_code == 304:
+            logging.info("Tag '{}' exists in repository: '{}' (unchanged)".format(alias, repo_name))
+            self.tag_index.putTag(repository, cached['description'], cached['etag'])
+            return cached['description']
         if tags_req.status_code == 200:
             logging.info("Tag '{}' exists in repository: '{}'".format(alias, repo_name))
-            return True
+            if self.tag_index != None:
+                self.tag_index.putTag(repository, tags_req.json(), tags_req.headers.get('ETag'))
+            return tags_req.json()
         else:
-            logging.warning("Tags '{}' does not exists in repository: '{}'".format(alias, repo_name))
-            return False
+            logging.warning("Tags '{}' does not exists in repository: '{}' (HTTP {})".format(alias, repo_name, tags_req.status_code))
+            if self.tag_index != None and tags_req.status_code == 404:
+                self.tag_index.removeTag(repository, alias)
+            return None
+
+    def dockerRegistryCheckTag(self, repo_name, alias):
+        """
+        Checks whether a tag (alias) exist for the specified repository (repo_name) in the initialized namespace
+                 returns true if tag exists, otherwise false
+        """
+        return self.dockerRegistryGetTag(repo_name, alias) != None
+
+    def getTags(self, repo_names, alias):
+        """
+        Returns the tag (alias) description for all specified repositories (repo_names) in the initialized namespace.
+        The lookups run concurrently over the shared session.
+                 returns a dictionary repo_name -> tag description, None if the tag does not exist
+        """
+        repo_names = list(repo_names)
+        if len(repo_names) == 0:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(repo_names)), thread_name_prefix='registry') as executor:
+            tags = executor.map(lambda repo_name: self.dockerRegistryGetTag(repo_name, alias), repo_names)
+            return dict(zip(repo_names, tags))
+
+    def checkTags(self, repo_names, alias):
+        """
+        Checks whether a tag (alias) exist for all specified repositories (repo_names) in the initialized namespace.
+                 returns a dictionary repo_name -> true if tag exists, otherwise false
+        """
+        return {repo_name: tag != None for repo_name, tag in self.getTags(repo_names, alias).items()}
+
+    def listTags(self, repo_name, page_size=100):
+        """
+        Lists all tags of the specified repository (repo_name) in the initialized namespace, newest first.
+        The pages are requested with the maximum page size over the shared session and yielded as they arrive.
+        A listing in the tag index is used within its staleness window or if the registry confirms that the
+        first page did not change, a completed listing is stored in the index.
+                 yields the tag descriptions (dictionaries with i.a. 'name', 'digest' and 'last_updated')
+        """
+        repository = f"{self.docker_namespace}/{repo_name}"
+        etag, listed, cached = self.tag_index.getListing(repository) if self.tag_index != None else (None, None, [])
+        if listed != None and self.tag_index.isFresh(listed):
+            logging.debug("Listing the tags of '{}' from the tag index".format(repository))
+            yield from cached
+            return
+        tags_url = f"{self.base_url}/repositories/{repository}/tags"
+        params = {"page_size": page_size, "ordering": "-last_updated"}
+        # The ETag of the first page validates the whole listing, a changed tag changes the first page or the count
+        headers = {"If-None-Match": etag} if listed != None and etag != None else None
+        first_etag = None
+        pages = 0
+        tags = []
+        while tags_url != None:
+            with span('registry_list', repo=repo_name):
+                tags_req = self.authorizedGet(tags_url, headers=headers, params=params)
+            if tags_req.status_code == 304:
+                logging.debug("The tags of '{}' did not change".format(repository))
+                self.tag_index.touchListing(repository)
+                yield from cached
+                return
+            tags_req.raise_for_status()
+            if pages == 0:
+                first_etag = tags_req.headers.get('ETag')
+            pages += 1
+            headers = None
+            page = tags_req.json()
+            for tag in page.get("results", []):
+                tags.append(tag)
+                yield tag
+            # The next URL already contains the query parameters
+            tags_url = page.get("next")
+            params = None
+        if self.tag_index != None:
+            self.tag_index.putListing(repository, tags, first_etag)
 
 if __name__ == "__main__":
     """
@@ -60,3 +218,4 @@ if __name__ == "__main__":
     logging.info("==> Logging into DockerHub")
     drh.dockerRegistryLogin()
     tag_exists = drh.dockerRegistryCheckTag(repo, "develop_latest")
+    tags_exist = drh.checkTags(["schulcloud-server", "schulcloud-client"], "develop_latest")
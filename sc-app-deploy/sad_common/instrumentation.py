@@ -0,0 +1,171 @@
+""" Instrumentation module
+Timed spans around the phases of a deploy or tagging run:
+
+    with span('registry_tag', repo='schulcloud-server'):
+        ...
+
+Every finished span is kept for the summary (count, p50, p95, max and total per phase) and, if a
+trace file is configured, written to it as one JSON line like
+    {"phase": "registry_tag", "start": 1612345678.12, "duration": 0.231, "ok": true, "thread": "registry_0", "repo": "schulcloud-server"}
+The summary can also be written as Prometheus textfile (node_exporter textfile collector), the same
+text can be pushed to a pushgateway, e.g. curl --data-binary @sad.prom http://pushgateway:9091/metrics/job/sc-app-deploy
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+class Tracer:
+    '''
+    Collects the spans of a run, thread safe. Only the latest max_spans spans are kept for the summary,
+    e.g. for the long running deploy daemon.
+    '''
+    max_spans = 100000
+
+    def __init__(self):
+        self.spans = deque(maxlen=self.max_spans)
+        self.traceFile = None
+        self.metricsFile = None
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def configure(self, traceFile=None, metricsFile=None):
+        '''
+        The traceFile for the JSON lines, the metricsFile for the Prometheus textfile, None to not write them.
+        '''
+        with self.lock:
+            if self.traceFile != None:
+                self.traceFile.close()
+            self.traceFile = open(traceFile, 'a') if traceFile != None else None
+            self.metricsFile = metricsFile
+
+    def reset(self):
+        '''
+        Drops the collected spans and restarts the run time, e.g. between benchmark scenarios.
+        '''
+        with self.lock:
+            self.spans.clear()
+            self.start = time.time()
+
+    def record(self, phase, start, duration, ok, attributes):
+        record = {'phase': phase, 'start': round(start, 3), 'duration': round(duration, 4), 'ok': ok,
+                  'thread': threading.current_thread().name}
+        record.update(attributes)
+        with self.lock:
+            self.spans.append(record)
+            if self.traceFile != None:
+                self.traceFile.write(json.dumps(record) + '\n')
+                self.traceFile.flush()
+
+    @contextmanager
+    def span(self, phase, **attributes):
+        '''
+        Measures the wall time of the block, a block left by an exception is recorded with ok false.
+        '''
+        start = time.time()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record(phase, start, time.time() - start, ok, attributes)
+
+    def getSummary(self):
+        '''
+        Returns a dictionary phase -> {'count', 'failed', 'p50', 'p95', 'max', 'total'} in the order the phases first finished.
+        '''
+        with self.lock:
+            spans = list(self.spans)
+        durations = {}
+        failed = {}
+        for record in spans:
+            durations.setdefault(record['phase'], []).append(record['duration'])
+            failed[record['phase']] = failed.get(record['phase'], 0) + (0 if record['ok'] else 1)
+        summary = {}
+        for phase, values in durations.items():
+            values = sorted(values)
+            summary[phase] = {'count': len(values), 'failed': failed[phase], 'p50': percentile(values, 50),
+                              'p95': percentile(values, 95), 'max': values[-1], 'total': sum(values)}
+        return summary
+
+    def logSummary(self):
+        '''
+        Logs the summary table of the phases.
+        '''
+        summary = self.getSummary()
+        if not summary:
+            return
+        logging.info("Phase timings:")
+        logging.info("  %-20s %6s %6s %8s %8s %8s %8s" % ('phase', 'count', 'failed', 'p50', 'p95', 'max', 'total'))
+        for phase, values in summary.items():
+            logging.info("  %-20s %6d %6d %7.2fs %7.2fs %7.2fs %7.2fs" % (phase, values['count'], values['failed'],
+                         values['p50'], values['p95'], values['max'], values['total']))
+
+    def writeMetrics(self, job, ok):
+        '''
+        Writes the summary as Prometheus textfile, replaced atomically so a collector never reads half a file.
+        '''
+        if self.metricsFile == None:
+            return
+        labels = 'job="%s"' % job
+        lines = [
+            '# HELP sad_phase_duration_seconds Duration of the phases of the last run.',
+            '# TYPE sad_phase_duration_seconds summary'
+        ]
+        summary = self.getSummary()
+        for phase, values in summary.items():
+            phaseLabels = '%s,phase="%s"' % (labels, phase)
+            lines.append('sad_phase_duration_seconds{%s,quantile="0.5"} %.4f' % (phaseLabels, values['p50']))
+            lines.append('sad_phase_duration_seconds{%s,quantile="0.95"} %.4f' % (phaseLabels, values['p95']))
+            lines.append('sad_phase_duration_seconds_sum{%s} %.4f' % (phaseLabels, values['total']))
+            lines.append('sad_phase_duration_seconds_count{%s} %d' % (phaseLabels, values['count']))
+        lines += ['# HELP sad_phase_failures Failed spans per phase of the last run.', '# TYPE sad_phase_failures gauge']
+        lines += ['sad_phase_failures{%s,phase="%s"} %d' % (labels, phase, values['failed']) for phase, values in summary.items()]
+        lines += [
+            '# HELP sad_run_duration_seconds Wall time of the last run.',
+            '# TYPE sad_run_duration_seconds gauge',
+            'sad_run_duration_seconds{%s} %.3f' % (labels, time.time() - self.start),
+            '# HELP sad_run_success Whether the last run succeeded.',
+            '# TYPE sad_run_success gauge',
+            'sad_run_success{%s} %d' % (labels, 1 if ok else 0),
+            '# HELP sad_run_timestamp_seconds End of the last run.',
+            '# TYPE sad_run_timestamp_seconds gauge',
+            'sad_run_timestamp_seconds{%s} %.3f' % (labels, time.time())
+        ]
+        directory = os.path.dirname(os.path.abspath(self.metricsFile))
+        handle, temporary = tempfile.mkstemp(dir=directory, prefix='.sad-metrics-')
+        with os.fdopen(handle, 'w') as metrics:
+            metrics.write('\n'.join(lines) + '\n')
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, self.metricsFile)
+
+    def finish(self, job, ok):
+        '''
+        Logs the summary, writes the metrics and closes the trace file.
+        '''
+        self.logSummary()
+        try:
+            self.writeMetrics(job, ok)
+        except OSError as ex:
+            logging.warning("Could not write the metrics to '%s' (%s)" % (self.metricsFile, ex))
+        self.configure(None, self.metricsFile)
+
+def percentile(sortedValues, percent):
+    '''
+    Returns the nearest rank percentile of the sorted values.
+    '''
+    rank = max(1, -(-len(sortedValues) * percent // 100))
+    return sortedValues[int(rank) - 1]
+
+# The tracer of the running program
+tracer = Tracer()
+
+def span(phase, **attributes):
+    '''
+    Timed span of the program tracer, see Tracer.span.
+    '''
+    return tracer.span(phase, **attributes)
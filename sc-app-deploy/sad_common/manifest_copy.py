@@ -0,0 +1,62 @@
+import json
+import logging
+import threading
+
+from sad_common.sadexception import SadException
+
+class ManifestCopier:
+    '''
+    Copies tagged images between repositories of one registry with DXF clients, without moving layers:
+    the blobs (config and layers) are mounted from the source repository into the target repository
+    and only the manifests are uploaded. Manifest lists (multi-arch images) are copied with all the
+    manifests they reference, so the copy keeps the digest of the source.
+    Blobs already mounted into a target repository are remembered, so copying many tags of the same
+    images in one session mounts every blob once. Thread safe.
+    '''
+
+    def __init__(self):
+        self.mounted = set()
+        self.lock = threading.Lock()
+
+    def copy(self, source, sourceRepository, target, targetRepository, tag, alias):
+        '''
+        Copies the tag of the source repository (like 'schulcloud/schulcloud-server') as alias into the target repository.
+        source and target are the DXF clients of the repositories, the same client if the repository is the same.
+        '''
+        manifest, _ = source.get_manifest_and_response(tag)
+        self.copyManifest(source, sourceRepository, target, targetRepository, manifest, alias)
+
+    def copyManifest(self, source, sourceRepository, target, targetRepository, manifest, reference):
+        '''
+        Uploads the manifest (JSON string) as reference (tag or digest) after the blobs or manifests it refers to.
+        '''
+        parsed = json.loads(manifest)
+        if 'manifests' in parsed:
+            # Manifest list or OCI index, the platform manifests are referenced by their digest
+            for entry in parsed['manifests']:
+                platformManifest, _ = source.get_manifest_and_response(entry['digest'])
+                self.copyManifest(source, sourceRepository, target, targetRepository, platformManifest, entry['digest'])
+        else:
+            for digest in [parsed['config']['digest']] + [layer['digest'] for layer in parsed.get('layers', [])]:
+                self.mountBlob(target, targetRepository, sourceRepository, digest)
+        if 'mediaType' not in parsed:
+            raise SadException("The manifest '%s' of '%s' has no mediaType and cannot be copied" % (reference, sourceRepository))
+        target.set_manifest(reference, manifest)
+
+    def mountBlob(self, target, targetRepository, sourceRepository, digest):
+        '''
+        Mounts the blob from the source into the target repository unless it is there already.
+        '''
+        if targetRepository == sourceRepository:
+            return
+        with self.lock:
+            if (targetRepository, digest) in self.mounted:
+                return
+        try:
+            target.mount_blob(sourceRepository, digest)
+        except Exception as ex:
+            # The registry answered with an upload session instead of the mount, the layer would have to be pushed
+            raise SadException("Cannot mount blob %s from '%s' into '%s' (%s)" % (digest, sourceRepository, targetRepository, type(ex).__name__))
+        logging.debug("Mounted blob %s from '%s' into '%s'" % (digest, sourceRepository, targetRepository))
+        with self.lock:
+            self.mounted.add((targetRepository, digest))
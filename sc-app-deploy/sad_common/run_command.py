@@ -1,26 +1,134 @@
 import subprocess
+import threading
+import time
 import logging
+import os
+import signal
+from collections import deque
+from sad_common.instrumentation import tracer
 from sad_common.sadexception import SadException
 
-def runCommand(popenargs):
+class CommandResult:
     '''
-    Runs the given command and writes all output to the logger.
+    Dataclass that stores the outcome of a command run by runCommand.
+    '''
+
+    returncode = None
+    # Exit code of the process, negative if it was killed by a signal
+
+    duration = None
+    # Wall time in seconds
+
+    output = None
+    # All output lines (stdout and stderr)
+
+    tail = None
+    # The last output lines, e.g. for error reports
+
+    timedout = False
+    cancelled = False
+
+    def __init__(self, returncode, duration, output, tail, timedout=False, cancelled=False):
+        self.returncode = returncode
+        self.duration = duration
+        self.output = output
+        self.tail = tail
+        self.timedout = timedout
+        self.cancelled = cancelled
+
+class Cancellation:
+    '''
+    Cancels the commands run with it (see runCommand), used like a threading.Event. Its condition also
+    wakes the watcher of a command when the command finished, so no watcher outlives its command.
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.cancelled = False
+
+    def set(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def is_set(self):
+        return self.cancelled
+
+    def wait(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(self.is_set, timeout)
+
+def runCommand(popenargs, timeout=None, cancel: Cancellation = None, check=True, tailLines=20, logLevel=logging.INFO):
+    '''
+    Runs the given command and writes all output to the logger with the given level. The output records
+    are marked as command_output, so the log may drop them if its queue is full (see sad_logging).
+    The output pipe is read blocking line by line until the process closes it, so no CPU is spent while
+    the command is waiting. The command runs in its own process group, which is killed after timeout
+    seconds or when the cancellation is set, so background children holding the pipe are killed too.
+    The watcher thread waits until the output is complete, the cancellation is set or the timeout expires.
+    Returns a CommandResult, raises a SadException if check is set and the process did not exit with 0.
     '''
     logger = logging.getLogger()
-    process = subprocess.Popen(popenargs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-    def check_io():
-           while True:
-                output = process.stdout.readline().decode().rstrip()
-                if output:
-                    logger.log(logging.INFO, output)
-                else:
-                    break
-
-    # keep checking stdout/stderr until the child exits
-    while process.poll() is None:
-        check_io()
-
-    logging.debug("runCommand returncode: '%s'" % process.returncode)
-    if process.returncode != 0:
-        raise SadException("The process has exited with an error.")
+    start = time.time()
+    process = subprocess.Popen(popenargs, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    cancellation = cancel if cancel != None else Cancellation()
+    finished = []
+    stopped = []
+
+    def killProcessGroup():
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def watch():
+        # Kills the process group on timeout or cancellation, unless the output is complete by then
+        remaining = None if timeout == None else max(start + timeout - time.time(), 0)
+        with cancellation.condition:
+            cancellation.condition.wait_for(lambda: finished or cancellation.is_set(), remaining)
+            if finished:
+                return
+            reason = 'cancelled' if cancellation.is_set() else 'timedout'
+        stopped.append(reason)
+        killProcessGroup()
+
+    watcher = None
+    if timeout != None or cancel != None:
+        watcher = threading.Thread(target=watch, name=threading.current_thread().name, daemon=True)
+        watcher.start()
+
+    output = []
+    tail = deque(maxlen=tailLines)
+    try:
+        for rawLine in iter(process.stdout.readline, b''):
+            line = rawLine.decode(errors='replace').rstrip()
+            output.append(line)
+            tail.append(line)
+            if line:
+                logger.log(logLevel, line, extra={'command_output': True})
+        process.wait()
+    finally:
+        with cancellation.condition:
+            finished.append(True)
+            cancellation.condition.notify_all()
+        if process.poll() == None:
+            # e.g. KeyboardInterrupt, the process group does not get the signal of the terminal
+            killProcessGroup()
+            process.wait()
+        process.stdout.close()
+        if watcher != None:
+            watcher.join()
+
+    result = CommandResult(process.returncode, time.time() - start, output, list(tail),
+                           'timedout' in stopped, 'cancelled' in stopped)
+    logging.debug("runCommand returncode: '%s' after %.2fs" % (result.returncode, result.duration))
+    tracer.record('command', start, result.duration, result.returncode == 0, {'program': os.path.basename(popenargs[0])})
+    if check:
+        if result.timedout:
+            raise SadException("The process has been killed after the timeout of %ss." % timeout)
+        if result.cancelled:
+            raise SadException("The process has been cancelled.")
+        if result.returncode != 0:
+            raise SadException("The process has exited with an error (exit code %s)." % result.returncode)
+    return result
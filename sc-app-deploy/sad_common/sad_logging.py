@@ -1,33 +1,147 @@
+""" Logging module
+The log records are put into a bounded queue by the threads that log them and written to the console
+and the log file by one background thread (QueueListener), so concurrent deploy workers never wait for
+handler locks or disk writes. If the queue is full, DEBUG records and the output lines streamed by
+runCommand (like the docker service update output of a rollout) are dropped and counted, the other
+records wait for the writer. The last output lines of a failed command are logged again as errors by
+the caller, so they are not lost.
+
+The log file in ./log is rotated by size, files older than log_max_age_days are removed at the start.
+With the format 'json' the file contains one JSON object per line, tagged with the host and application
+set by logContext, e.g.
+    {"time": "2021-02-03T10:11:12.345+00:00", "level": "INFO", "thread": "hotfix6_server", "host": "hotfix6", "application": "server", "message": "..."}
+so the output of concurrent rollouts can be filtered per service, e.g. with jq 'select(.application == "server")'.
+"""
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import threading
 import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from pathlib import Path
 
+# Records buffered for the writer thread
+log_queue_size = 10000
+# Size of a log file before it is rotated, and the number of rotated files kept
+log_max_bytes = 20 * 1024 * 1024
+log_backup_count = 5
+# Days the log files of earlier runs are kept
+log_max_age_days = 14
+
+context = threading.local()
+
+@contextmanager
+def logContext(**fields):
+    '''
+    Tags the records logged by the current thread within the block, e.g. logContext(host='hotfix6', application='server').
+    '''
+    previous = getattr(context, 'fields', {})
+    context.fields = dict(previous, **fields)
+    try:
+        yield
+    finally:
+        context.fields = previous
+
+class ContextFilter(logging.Filter):
+    '''
+    Copies the fields of logContext to the record, runs in the logging thread.
+    '''
+
+    def filter(self, record):
+        for name, value in getattr(context, 'fields', {}).items():
+            setattr(record, name, value)
+        return True
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats a record as one JSON line.
+    '''
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'thread': record.threadName
+        }
+        for name in ('host', 'application'):
+            if getattr(record, name, None) != None:
+                entry[name] = getattr(record, name)
+        entry['message'] = record.getMessage()
+        return json.dumps(entry)
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler for a bounded queue: records below INFO and command output records are dropped if the
+    queue is full, the others wait.
+    '''
+
+    def __init__(self, recordQueue):
+        super().__init__(recordQueue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if record.levelno >= logging.INFO and not getattr(record, 'command_output', False):
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def removeOldLogs(logdir, maxAgeDays):
+    '''
+    Removes the log files in logdir not written to within maxAgeDays.
+    '''
+    limit = time.time() - maxAgeDays * 24 * 3600
+    for logFile in Path(logdir).glob('*.log*'):
+        try:
+            if logFile.stat().st_mtime < limit:
+                logFile.unlink()
+        except OSError:
+            pass
 
-def initLogging():
+def initLogging(logFormat='text', applicationName='sc-app-deploy'):
     '''
-    Initializes the logger.
+    Initializes the logger, the logFormat of the file is 'text' or 'json'.
+    The writer thread is stopped at exit, after writing the queued records.
     '''
     logdir = './log'
     Path(logdir).mkdir(parents=True, exist_ok=True)
+    removeOldLogs(logdir, log_max_age_days)
     timestamp = time.strftime('%Y%m%d_%H%M%S')
-    applicationName = 'sc-app-deploy'
     logFilename = '%s/%s_%s.log' % (logdir, timestamp, applicationName)
-    logFormatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s", "%Y-%m-%d %H:%M:%S")
+    logFormatter = logging.Formatter("%(asctime)s [%(threadName)-20.20s] [%(levelname)-5.5s]  %(message)s", "%Y-%m-%d %H:%M:%S")
 
-    # The logger
-    rootLogger = logging.getLogger()
-    rootLogger.setLevel(logging.DEBUG)
-    
     # File handler
-    fileHandler = logging.FileHandler(logFilename)
-    fileHandler.setFormatter(logFormatter)
+    fileHandler = logging.handlers.RotatingFileHandler(logFilename, maxBytes=log_max_bytes, backupCount=log_backup_count)
+    fileHandler.setFormatter(JsonFormatter() if logFormat == 'json' else logFormatter)
     fileHandler.setLevel(logging.DEBUG)
-    rootLogger.addHandler(fileHandler)
 
     # Console handler
     consoleHandler = logging.StreamHandler()
     consoleHandler.setFormatter(logFormatter)
     consoleHandler.setLevel(logging.INFO)
-    rootLogger.addHandler(consoleHandler)
-    
+
+    # The logger only queues the records, the listener thread writes them
+    queueHandler = BoundedQueueHandler(queue.Queue(log_queue_size))
+    queueHandler.addFilter(ContextFilter())
+    listener = logging.handlers.QueueListener(queueHandler.queue, fileHandler, consoleHandler, respect_handler_level=True)
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.DEBUG)
+    rootLogger.addHandler(queueHandler)
+    listener.start()
+
+    def stopLogging():
+        listener.stop()
+        # Records logged by later exit handlers are written directly
+        rootLogger.removeHandler(queueHandler)
+        rootLogger.addHandler(fileHandler)
+        rootLogger.addHandler(consoleHandler)
+        if queueHandler.dropped:
+            logging.warning("%d debug and command output log record(s) dropped, the log queue was full" % queueHandler.dropped)
+
+    atexit.register(stopLogging)
     logging.debug('Logging initialized')
@@ -0,0 +1,138 @@
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import logging
+from sad_common.instrumentation import span
+from sad_common.run_command import runCommand
+from sad_infra.host import Host
+
+# Seconds the master connection stays without session before it exits, so a run killed before
+# close() does not leave an authenticated connection to the swarm manager behind
+master_idle_timeout = 60
+
+class SshTransport:
+    '''
+    Multiplexed ssh connection to a single host.
+    open() starts one ControlMaster connection, every following run() reuses it, so the
+    TCP connect, key exchange and authentication are paid once per host and run.
+    close() stops the master connection. The class can be used as a context manager.
+    The master exits by itself after master_idle_timeout seconds without session, isAlive() tells.
+
+    The ssh binary can be replaced with the environment variable SAD_SSH_COMMAND,
+    e.g. to point the transport to a fake local endpoint.
+    '''
+
+    def __init__(self, host: Host, identity=None, remoteUser: str = "travis"):
+        '''
+        The host to connect to.
+        The identity, an opened sad_secrets.ssh_identity.SshIdentity, None to use the identity of the current user (pageant).
+        The remoteUser like 'travis'.
+        '''
+        self.host = host
+        self.identity = identity
+        self.remoteUser = remoteUser
+        self.controlDir = None
+        self.controlPath = None
+        self.connectTime = None
+        self.commandTime = 0.0
+        self.commandCount = 0
+        self.lock = threading.Lock()
+
+    def getSshCommand(self):
+        '''
+        Returns the ssh binary and its fixed arguments.
+        '''
+        return shlex.split(os.environ.get('SAD_SSH_COMMAND', 'ssh'))
+
+    def getSshOptions(self):
+        '''
+        Returns the ssh options shared by the master and all multiplexed sessions.
+        '''
+        # Disable known hosts checking.
+        sshOptions = ['-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null']
+        if self.identity != None:
+            # Use provided ssh key
+            sshOptions += self.identity.getSshOptions()
+        if self.controlPath != None:
+            sshOptions += ['-o', 'ControlPath=%s' % self.controlPath]
+        return sshOptions
+
+    def getRemote(self):
+        '''
+        Returns the remote like 'travis@hotfix6.schul-cloud.dev'.
+        '''
+        return '%s@%s' % (self.remoteUser, self.host.getFQDN())
+
+    def open(self):
+        '''
+        Opens the master connection and measures the connect and handshake time.
+        If the local ssh does not support multiplexing, every run() falls back to its own connection.
+        '''
+        self.controlDir = tempfile.mkdtemp(prefix='sad-ssh-')
+        self.controlPath = os.path.join(self.controlDir, 'master')
+        command = self.getSshCommand() + self.getSshOptions() + ['-o', 'ControlMaster=yes', '-o', 'ControlPersist=%d' % master_idle_timeout, '-N', '-f', self.getRemote()]
+        logging.info("Opening ssh master connection to '%s'" % self.host.getFQDN())
+        start = time.time()
+        # The backgrounded master inherits the output handles, so they must not be pipes read until EOF.
+        with span('ssh_connect', host=self.host.getFQDN()), tempfile.TemporaryFile() as errorOutput:
+            process = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=errorOutput)
+            errorOutput.seek(0)
+            for line in errorOutput.read().decode(errors='replace').splitlines():
+                logging.debug(line)
+        if process.returncode != 0:
+            logging.warning("No ssh master connection to '%s' (exit code %d), using one connection per command." % (self.host.getFQDN(), process.returncode))
+            self.removeControlDir()
+            return self
+        self.connectTime = time.time() - start
+        logging.info("ssh master connection to '%s' established in %.2fs" % (self.host.getFQDN(), self.connectTime))
+        return self
+
+    def run(self, remoteArgs, timeout=None, cancel=None, logLevel=logging.INFO, check=True):
+        '''
+        Runs the remote command given as list of arguments over the master connection.
+        Returns the CommandResult of the remote command, see runCommand for timeout, cancel, logLevel and check.
+        '''
+        command = self.getSshCommand() + self.getSshOptions() + [self.getRemote()] + remoteArgs
+        logging.log(logLevel, "Running command: '%s'" % ' '.join(command))
+        start = time.time()
+        try:
+            return runCommand(command, timeout, cancel, check=check, logLevel=logLevel)
+        finally:
+            with self.lock:
+                self.commandTime += time.time() - start
+                self.commandCount += 1
+
+    def isAlive(self):
+        '''
+        Returns whether the master connection is running, it exits after master_idle_timeout seconds without session.
+        '''
+        if self.controlPath == None or not os.path.exists(self.controlPath):
+            return False
+        command = self.getSshCommand() + self.getSshOptions() + ['-O', 'check', self.getRemote()]
+        return subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+    def close(self):
+        '''
+        Stops the master connection and logs the connect and remote command times.
+        '''
+        if self.controlPath != None:
+            command = self.getSshCommand() + self.getSshOptions() + ['-O', 'exit', self.getRemote()]
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.removeControlDir()
+        connectTime = 'n/a' if self.connectTime == None else '%.2fs' % self.connectTime
+        logging.info("ssh transport '%s': connect %s, %d remote command(s) %.2fs" % (self.host.getFQDN(), connectTime, self.commandCount, self.commandTime))
+
+    def removeControlDir(self):
+        shutil.rmtree(self.controlDir, ignore_errors=True)
+        self.controlDir = None
+        self.controlPath = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
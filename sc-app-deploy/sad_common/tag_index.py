@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+class TagIndex:
+    '''
+    On-disk index of the tags of registry repositories shared by sc-app-deploy.py and remotetagging.py,
+    one file per repository like 'schulcloud/schulcloud-server.json' that stores tag -> digest and last update.
+    DockerRegistry answers tag lookups and listings from the index while they are at most max_age seconds
+    old. Older entries are revalidated with a conditional request (If-None-Match with the ETag the registry
+    sent), an unchanged tag or listing is then confirmed by a 304 answer without body.
+    Attributes:
+        - directory: the index directory, can be set with the environment variable SAD_TAG_INDEX
+        - max_age: staleness window in seconds, 0 revalidates every lookup
+        - refresh: ignores the entries stored by earlier runs, they are fetched again without ETag
+    '''
+
+    def __init__(self, directory=None, max_age=0, refresh=False):
+        '''
+        The directory like '~/.cache/sc-app-ci/tags', None to read it from the environment on use.
+        '''
+        self.directory = directory
+        self.max_age = max_age
+        self.refresh = refresh
+        self.refreshed = set()
+        self.lock = threading.Lock()
+
+    def getPath(self, repository):
+        directory = self.directory
+        if directory == None:
+            directory = os.environ.get('SAD_TAG_INDEX', os.path.join(os.path.expanduser('~'), '.cache', 'sc-app-ci', 'tags'))
+        # One directory per namespace, a name segment never contains '/' so two repositories never share a file
+        return os.path.join(directory, *repository.split('/')) + '.json'
+
+    def isFresh(self, timestamp):
+        '''
+        Returns whether an entry checked at the timestamp (seconds since epoch, None if never) can be used without request.
+        '''
+        return timestamp != None and time.time() - timestamp <= self.max_age
+
+    def getTag(self, repository, tag):
+        '''
+        Returns the index entry of the tag, a dictionary with 'description' (name, digest, last_updated),
+        'etag' and 'checked', None if the tag is not in the index.
+        '''
+        with self.lock:
+            return self.load(repository)['tags'].get(tag)
+
+    def getListing(self, repository):
+        '''
+        Returns the ETag, the time of the last complete listing (None if never) and the tag descriptions newest first.
+        '''
+        with self.lock:
+            entries = self.load(repository)
+        descriptions = sorted((tag['description'] for tag in entries['tags'].values()), key=lambda description: description.get('last_updated') or '',
+                              reverse=True)
+        return entries['etag'], entries['listed'], descriptions
+
+    def putTag(self, repository, description, etag=None):
+        '''
+        Stores the description of a tag fetched or confirmed now.
+        '''
+        with self.lock:
+            entries = self.load(repository)
+            entries['tags'][description['name']] = {'description': self.reduce(description), 'etag': etag, 'checked': time.time()}
+            self.save(repository, entries)
+
+    def removeTag(self, repository, tag):
+        '''
+        Removes a tag the registry reported as missing.
+        '''
+        with self.lock:
+            entries = self.load(repository)
+            if entries['tags'].pop(tag, None) != None:
+                self.save(repository, entries)
+
+    def putListing(self, repository, descriptions, etag=None):
+        '''
+        Replaces the tags of the repository by a complete listing fetched now.
+        '''
+        now = time.time()
+        with self.lock:
+            tags = {description['name']: {'description': self.reduce(description), 'etag': None, 'checked': now} for description in descriptions}
+            self.save(repository, {'etag': etag, 'listed': now, 'tags': tags})
+
+    def touchListing(self, repository):
+        '''
+        Marks the listing as confirmed now, after the registry answered that it did not change.
+        '''
+        now = time.time()
+        with self.lock:
+            entries = self.load(repository)
+            entries['listed'] = now
+            for tag in entries['tags'].values():
+                tag['checked'] = now
+            self.save(repository, entries)
+
+    def invalidate(self, repository):
+        '''
+        Drops the index of the repository, e.g. after its tags were changed.
+        '''
+        with self.lock:
+            try:
+                os.remove(self.getPath(repository))
+            except OSError:
+                pass
+
+    @staticmethod
+    def reduce(description):
+        return {key: description.get(key) for key in ('name', 'digest', 'last_updated')}
+
+    def load(self, repository):
+        empty = {'etag': None, 'listed': None, 'tags': {}}
+        if self.refresh and repository not in self.refreshed:
+            return empty
+        try:
+            with open(self.getPath(repository)) as indexFile:
+                return json.load(indexFile)
+        except (OSError, ValueError):
+            return empty
+
+    def save(self, repository, entries):
+        '''
+        Writes the index of the repository atomically, concurrent runs never see a partial file.
+        '''
+        path = self.getPath(repository)
+        directory = os.path.dirname(path)
+        temporaryPath = None
+        try:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            descriptor, temporaryPath = tempfile.mkstemp(dir=directory, prefix='.tags-')
+            with os.fdopen(descriptor, 'w') as indexFile:
+                json.dump(entries, indexFile)
+            os.replace(temporaryPath, path)
+            self.refreshed.add(repository)
+        except OSError as ex:
+            logging.warning("Could not write tag index '%s': %s" % (path, ex))
+            if temporaryPath != None and os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
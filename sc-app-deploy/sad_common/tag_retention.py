@@ -0,0 +1,134 @@
+import fnmatch
+import threading
+import time
+from datetime import datetime, timezone
+
+class RetentionPolicy:
+    '''
+    Dataclass that describes which tags of a repository are kept.
+    Only tags of the managed branch prefixes are candidates for deletion, tags matching a protected
+    pattern are always kept. Per branch prefix the keep_last newest tags are kept, of the remaining
+    tags those older than max_age_days are deleted (all of them if no maximum age is set).
+    '''
+
+    prefixes = ['feature', 'hotfix']
+    # Branch prefixes whose tags are managed by the policy
+
+    protected = []
+    # Glob patterns of tags that are never deleted, like 'hotfix_SC-1234_*'
+
+    keep_last = None
+    # Number of newest tags kept per branch prefix, None keeps no tags because of their age rank
+
+    max_age_days = None
+    # Tags older than that are deleted, None deletes all tags beyond keep_last
+
+    def __init__(self, prefixes=None, protected=None, keep_last=None, max_age_days=None):
+        if keep_last == None and max_age_days == None:
+            raise ValueError("A retention policy needs keep_last or max_age_days")
+        self.prefixes = list(self.prefixes if prefixes == None else prefixes)
+        self.protected = list(self.protected if protected == None else protected)
+        self.keep_last = keep_last
+        self.max_age_days = max_age_days
+
+    def __str__(self):
+        return "prefixes {}, keep last {}, max age {} days, protected {}".format(
+            ','.join(self.prefixes), self.keep_last, self.max_age_days, ','.join(self.protected) or '-')
+
+def getBranchPrefix(tagName):
+    '''
+    Returns the branch prefix of a tag like 'feature' for 'feature_SC-1234_latest'.
+    '''
+    return tagName.split('_', 1)[0]
+
+def parseLastUpdated(tag):
+    '''
+    Returns the 'last_updated' time of a Docker Hub tag description as seconds since epoch, None if unknown.
+    '''
+    lastUpdated = tag.get('last_updated')
+    if not lastUpdated:
+        return None
+    try:
+        return datetime.strptime(lastUpdated[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+def selectExpiredTags(tags, policy: RetentionPolicy, now=None):
+    '''
+    Applies the policy to the tag descriptions of one repository.
+    Returns the tags to delete and the expired tags that are not deleted because of their digest, both
+    as list of (name, reason) tuples, and the expired tags removed together with a deleted one, see
+    excludeSharedDigests.
+    '''
+    if now == None:
+        now = time.time()
+    byPrefix = {}
+    for tag in tags:
+        name = tag['name']
+        if getBranchPrefix(name) not in policy.prefixes:
+            continue
+        if any(fnmatch.fnmatchcase(name, pattern) for pattern in policy.protected):
+            continue
+        byPrefix.setdefault(getBranchPrefix(name), []).append((parseLastUpdated(tag), name))
+    expired = []
+    for prefix, candidates in byPrefix.items():
+        # Newest first, tags without a date are treated as the oldest
+        candidates.sort(key=lambda candidate: candidate[0] or 0, reverse=True)
+        if policy.keep_last != None:
+            candidates = candidates[policy.keep_last:]
+        for lastUpdated, name in candidates:
+            if policy.max_age_days == None:
+                expired.append((name, "beyond the newest %d '%s' tags" % (policy.keep_last, prefix)))
+            elif lastUpdated != None and now - lastUpdated > policy.max_age_days * 86400:
+                expired.append((name, "%d days old" % ((now - lastUpdated) // 86400)))
+    return excludeSharedDigests(tags, expired)
+
+def excludeSharedDigests(tags, deletions):
+    '''
+    Deleting a tag deletes its manifest (DELETE manifests/<digest>) and with it every tag of the same
+    digest, e.g. the source of an alias. tags are the descriptions of all tags of the repository.
+    Returns the deletions (list of (name, reason) tuples) to run, the skipped ones with the reason as
+    list of (name, reason) tuples: tags sharing the digest with a kept tag and tags of unknown digest,
+    and the tags removed together with an earlier deletion of the same digest as list of
+    (name, removedWith) tuples.
+    '''
+    digests = dict((tag['name'], tag.get('digest')) for tag in tags)
+    deleted = set(name for name, _ in deletions)
+    kept = {}
+    for tag in tags:
+        if tag['name'] not in deleted and tag.get('digest') != None:
+            kept.setdefault(tag['digest'], tag['name'])
+    deletable = []
+    skipped = []
+    together = []
+    removedWith = {}
+    for name, reason in deletions:
+        digest = digests.get(name)
+        if digest == None:
+            skipped.append((name, "digest unknown, the manifest may be shared with a kept tag"))
+        elif digest in kept:
+            skipped.append((name, "shares the digest {} with the kept tag '{}'".format(digest, kept[digest])))
+        elif digest in removedWith:
+            together.append((name, removedWith[digest]))
+        else:
+            removedWith[digest] = name
+            deletable.append((name, reason))
+    return deletable, skipped, together
+
+class RateLimiter:
+    '''
+    Spaces calls from any number of threads to at most 'rate' per second.
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next)
+            self.next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
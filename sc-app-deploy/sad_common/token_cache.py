@@ -0,0 +1,108 @@
+import base64
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+class TokenCache:
+    '''
+    File based cache for registry tokens shared by sc-app-deploy.py and remotetagging.py.
+    Tokens are stored keyed by user and registry in a file only readable by the owner.
+    A token is handed out until shortly before the expiry decoded from the JWT, afterwards
+    the caller has to login again and store the new token.
+    Attributes:
+        - path: the cache file, can be set with the environment variable SAD_TOKEN_CACHE
+        - refresh_margin: seconds before the expiry a token is no longer handed out
+        - default_lifetime: seconds a token is assumed to be valid if it carries no expiry
+    '''
+    refresh_margin = 60
+    default_lifetime = 300
+
+    def __init__(self, path=None):
+        '''
+        The path like '~/.cache/sc-app-ci/tokens.json'.
+        '''
+        if path == None:
+            path = os.environ.get('SAD_TOKEN_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'sc-app-ci', 'tokens.json'))
+        self.path = path
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def getKey(user, registry):
+        '''
+        Returns the cache key like 'user@registry-1.docker.io/schulcloud/schulcloud-server'.
+        '''
+        return '%s@%s' % (user, registry)
+
+    @staticmethod
+    def decodeExpiry(token):
+        '''
+        Returns the expiry (seconds since epoch) of a JWT or None if the token is no JWT or has no expiry.
+        '''
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None
+
+    def getToken(self, user, registry):
+        '''
+        Returns the cached token of the user for the registry, None if there is no token
+        or the token expires within the refresh margin.
+        '''
+        with self.lock:
+            entry = self.load().get(self.getKey(user, registry))
+        if entry == None or entry['expires'] - self.refresh_margin <= time.time():
+            return None
+        logging.debug("Using cached token for '%s' valid until %s" % (registry, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['expires']))))
+        return entry['token']
+
+    def putToken(self, user, registry, token):
+        '''
+        Stores the token of the user for the registry together with its expiry.
+        '''
+        expires = self.decodeExpiry(token)
+        if expires == None:
+            expires = time.time() + self.default_lifetime
+        with self.lock:
+            entries = self.load()
+            entries[self.getKey(user, registry)] = {'token': token, 'expires': expires}
+            # Drop expired tokens of other registries
+            entries = {key: entry for key, entry in entries.items() if entry['expires'] > time.time()}
+            self.save(entries)
+
+    def dropToken(self, user, registry):
+        '''
+        Removes the token, e.g. after the registry rejected it.
+        '''
+        with self.lock:
+            entries = self.load()
+            if entries.pop(self.getKey(user, registry), None) != None:
+                self.save(entries)
+
+    def load(self):
+        try:
+            with open(self.path) as cacheFile:
+                return json.load(cacheFile)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, entries):
+        '''
+        Writes the entries atomically into a file with mode 600, concurrent runs never see a partial file.
+        '''
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        descriptor, temporaryPath = tempfile.mkstemp(dir=directory, prefix='.tokens-')
+        try:
+            os.chmod(temporaryPath, 0o600)
+            with os.fdopen(descriptor, 'w') as cacheFile:
+                json.dump(entries, cacheFile)
+            os.replace(temporaryPath, self.path)
+        except OSError as ex:
+            logging.warning("Could not write token cache '%s': %s" % (self.path, ex))
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
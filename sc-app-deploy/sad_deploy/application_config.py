@@ -0,0 +1,97 @@
+""" Application config module
+The applications deployed by sc-app-deploy and their rollout policies are read from a JSON file
+(default: applications.json next to sc-app-deploy.py):
+
+    {
+        "parallel": 4,
+        "defaults": {"parallelism": 1, "order": "start-first", "delay": 0, "failure_action": "rollback", "monitor": 10},
+        "applications": [
+            {"image_name": "schulcloud-server", "application_name": "server"},
+            {"image_name": "schulcloud-client", "application_name": "client", "depends_on": ["server"],
+             "rollout": {"order": "stop-first"}},
+            ...
+        ]
+    }
+
+'parallel' is the number of applications rolled out concurrently per host unless given on the command
+line. 'defaults' is the rollout policy (see sad_infra.rollout_policy) of every application, 'rollout'
+overrides it per application. An application is rolled out after the applications it 'depends_on',
+applications without dependency between each other are rolled out together.
+"""
+import json
+import os
+
+from sad_common.sadexception import SadException
+from sad_infra.rollout_policy import RolloutPolicy
+
+default_application_config = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'applications.json')
+
+policy_keys = ('parallelism', 'order', 'delay', 'failure_action', 'monitor')
+
+def createPolicy(values, dependencies, configFile):
+    '''
+    Returns the RolloutPolicy of the values (a 'defaults' or 'rollout' dictionary), raises a SadException for invalid values.
+    '''
+    unknown = set(values) - set(policy_keys)
+    if unknown:
+        raise SadException("Unknown rollout setting(s) %s in '%s'" % (', '.join(sorted(unknown)), configFile))
+    policy = RolloutPolicy(depends_on=dependencies, **values)
+    for name in ('parallelism', 'delay', 'monitor'):
+        if not isinstance(getattr(policy, name), int) or isinstance(getattr(policy, name), bool) or getattr(policy, name) < 0:
+            raise SadException("Invalid rollout setting %s '%s' in '%s', a number of at least 0 is expected" % (name, getattr(policy, name), configFile))
+    if policy.order not in RolloutPolicy.orders:
+        raise SadException("Invalid rollout order '%s' in '%s', one of %s is expected" % (policy.order, configFile, ', '.join(RolloutPolicy.orders)))
+    if policy.failure_action not in RolloutPolicy.failure_actions:
+        raise SadException("Invalid failure action '%s' in '%s', one of %s is expected" % (policy.failure_action, configFile,
+                                                                                            ', '.join(RolloutPolicy.failure_actions)))
+    return policy
+
+def readApplicationConfig(configFile=default_application_config):
+    '''
+    Reads the application config file. Returns the applications as list of dictionaries with
+    'image_name', 'application_name' and 'policy' (RolloutPolicy) and the number of applications
+    rolled out concurrently. Raises a SadException for an invalid config.
+    '''
+    try:
+        with open(configFile) as config:
+            content = json.load(config)
+    except (OSError, ValueError) as ex:
+        raise SadException("Cannot read the application config '%s': %s" % (configFile, ex))
+    defaults = content.get('defaults', {})
+    applications = []
+    for entry in content.get('applications', []):
+        if not isinstance(entry.get('image_name'), str) or not isinstance(entry.get('application_name'), str):
+            raise SadException("Invalid application '%s' in '%s', 'image_name' and 'application_name' are required" % (entry, configFile))
+        policy = createPolicy(dict(defaults, **entry.get('rollout', {})), entry.get('depends_on', []), configFile)
+        applications.append({'image_name': entry['image_name'], 'application_name': entry['application_name'], 'policy': policy})
+    names = [application['application_name'] for application in applications]
+    for application in applications:
+        missing = [name for name in application['policy'].depends_on if name not in names]
+        if missing:
+            raise SadException("'%s' depends on the unknown application(s) %s in '%s'" % (application['application_name'], ', '.join(missing), configFile))
+    # Fails for circular dependencies
+    getRolloutWaves(applications, lambda application: application['application_name'], lambda application: application['policy'].depends_on)
+    parallel = content.get('parallel', 1)
+    if not isinstance(parallel, int) or parallel < 1:
+        raise SadException("Invalid 'parallel' %s in '%s', a number of at least 1 is expected" % (parallel, configFile))
+    return applications, parallel
+
+def getRolloutWaves(items, getName, getDependencies):
+    '''
+    Orders the items by their dependencies: returns a list of waves (lists of items), every item comes in
+    a wave after the waves of the items it depends on. getName returns the name of an item, getDependencies
+    the names of the items it depends on. Dependencies outside the items (e.g. applications without the
+    tag to deploy) are ignored. Raises a SadException for circular dependencies.
+    '''
+    names = set(getName(item) for item in items)
+    done = set()
+    waves = []
+    remaining = list(items)
+    while remaining:
+        wave = [item for item in remaining if all(name in done or name not in names for name in getDependencies(item))]
+        if not wave:
+            raise SadException("Circular dependencies between the applications %s" % ', '.join(getName(item) for item in remaining))
+        waves.append(wave)
+        done.update(getName(item) for item in wave)
+        remaining = [item for item in remaining if item not in wave]
+    return waves
@@ -0,0 +1,211 @@
+""" Convergence module
+Watches the swarm tasks of the updated services until they run the new image.
+The tasks of all watched services of a host are queried with one remote call per interval
+('ps' command of remote/sad-remote.py), each service has its own deadline.
+A crash looping container is Running between its restarts, so a service only counts as converged
+once all its tasks stayed Running on the new image over stable_polls consecutive polls and the
+monitor period of its rollout policy. A task of the new image that failed or exited after the update
+started (the task history of 'ps') fails the service at once.
+"""
+import logging
+import time
+
+from sad_common.instrumentation import span
+from sad_common.sadexception import SadException
+from sad_common.ssh_transport import SshTransport
+from sad_infra.application import Application
+from sad_infra.host import Host
+
+# Consecutive polls all tasks of a service must run the new image
+stable_polls = 2
+# Task states of tasks that ended, a replicated service restarts them
+ended_states = ('Failed', 'Rejected', 'Complete')
+# Seconds per unit of docker's humanized durations like '2 minutes ago'
+duration_units = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400, 'week': 7 * 86400, 'month': 30 * 86400, 'year': 365 * 86400}
+
+def parseStateAge(current):
+    '''
+    Returns the age in seconds of a task state like 'Failed 2 minutes ago', None if unknown.
+    Docker rounds the age down to the unit, so is the result.
+    '''
+    words = current.lower().split()
+    if len(words) < 4 or words[-1] != 'ago' or words[-2].rstrip('s') not in duration_units:
+        return None
+    amount = words[-3]
+    if amount in ('a', 'an'):
+        # 'About a minute ago', 'Less than a second ago'
+        amount = 0 if words[-4] == 'than' else 1
+    elif not amount.isdigit():
+        return None
+    return int(amount) * duration_units[words[-2].rstrip('s')]
+
+class ServiceConvergence:
+    '''
+    Dataclass that stores the convergence state and timing of one updated service.
+    '''
+
+    service = None
+    # 'hotfix6_server'
+
+    image = None
+    # 'schulcloud/schulcloud-server:develop_latest'
+
+    digest = None
+    # 'sha256:...', None if the registry reported no digest
+
+    started = None
+    # Time the service update was started, the timings are relative to it
+
+    firstHealthy = None
+    # Seconds until the first task ran the new image
+
+    converged = None
+    # Seconds until all tasks ran the new image, set once they kept running it
+
+    failed = None
+    # Reason why the service failed, like '2 task(s) of the new image ended: task: non-zero exit (1)'
+
+    monitor = 0
+    # Seconds all tasks must keep running the new image, the monitor period of the rollout policy
+
+    runningSince = None
+    # Time of the first poll of the current streak in which all tasks ran the new image
+
+    runningPolls = 0
+    # Consecutive polls in which all tasks ran the new image
+
+    state = ''
+    # Last observed task states, like '1/2 running'
+
+    def __init__(self, application: Application, host: Host, started):
+        self.service = application.getSwarmServicename(host)
+        self.image = application.getImage()
+        self.digest = application.digest
+        self.started = started
+        self.monitor = application.policy.monitor if application.policy != None else 0
+
+    def isNewImage(self, task):
+        '''
+        Returns whether the task is one of the new image: the digest must match if known, otherwise the tag.
+        '''
+        if self.digest != None:
+            return task['image'].endswith('@' + self.digest)
+        return task['image'].split('@')[0] == self.image
+
+    def isRunningNewImage(self, task):
+        return task['current'].startswith('Running') and self.isNewImage(task)
+
+    def hasEndedSinceUpdate(self, task, now):
+        '''
+        Returns whether the task of the new image ended after the update started, tasks of earlier updates are ignored.
+        '''
+        if task['current'].split(' ', 1)[0] not in ended_states or not self.isNewImage(task):
+            return False
+        age = parseStateAge(task['current'])
+        return age == None or now - age >= self.started - 1
+
+    def update(self, tasks, now):
+        '''
+        Evaluates the tasks of the service, the ones it should be running and its task history.
+        '''
+        active = [task for task in tasks if task['desired'] == 'Running']
+        healthy = [task for task in active if self.isRunningNewImage(task)]
+        ended = [task for task in tasks if self.hasEndedSinceUpdate(task, now)]
+        self.state = '%d/%d running' % (len(healthy), len(active))
+        errors = [task['error'] for task in tasks if task['error']]
+        if errors:
+            self.state += ', ' + errors[-1]
+        if ended:
+            self.failed = '%d task(s) of the new image ended%s' % (len(ended), ': ' + ended[0]['error'] if ended[0]['error'] else '')
+            return
+        if healthy and self.firstHealthy == None:
+            self.firstHealthy = now - self.started
+        if healthy and len(healthy) == len(active):
+            if self.runningSince == None:
+                self.runningSince = now
+                self.runningPolls = 0
+            self.runningPolls += 1
+            if self.runningPolls >= stable_polls and now - self.runningSince >= self.monitor:
+                self.converged = self.runningSince - self.started
+        else:
+            self.runningSince = None
+            self.runningPolls = 0
+
+def parseTasks(lines):
+    '''
+    Parses the output of the remote 'ps' command into a dictionary service -> list of tasks.
+    '''
+    tasks = {}
+    for line in lines:
+        fields = line.split('|')
+        if len(fields) < 6:
+            continue
+        tasks.setdefault(fields[0], []).append({'name': fields[1], 'image': fields[2], 'current': fields[3],
+                                                'desired': fields[4], 'error': '|'.join(fields[5:])})
+    return tasks
+
+def watchConvergence(convergences, host: Host, transport: SshTransport, deadline=300, interval=5):
+    '''
+    Polls the tasks of all given services of the host together until every service converged
+    or exceeded its deadline (seconds after its update was started).
+    Returns the convergences that did not converge in time.
+    '''
+    pending = list(convergences)
+    while pending:
+        lines = transport.run(['ps'] + [convergence.service for convergence in pending], logLevel=logging.DEBUG).output
+        now = time.time()
+        tasks = parseTasks(lines)
+        for convergence in list(pending):
+            convergence.update(tasks.get(convergence.service, []), now)
+            if convergence.failed != None:
+                logging.error("'%s' failed to converge: %s" % (convergence.service, convergence.failed))
+                pending.remove(convergence)
+            elif convergence.converged != None:
+                logging.info("'%s' converged after %.1fs" % (convergence.service, convergence.converged))
+                pending.remove(convergence)
+            elif now - convergence.started > deadline:
+                logging.error("'%s' did not converge within %ds (%s)" % (convergence.service, deadline, convergence.state))
+                pending.remove(convergence)
+        if pending:
+            time.sleep(interval)
+    reportConvergence(convergences, host)
+    return [convergence for convergence in convergences if convergence.converged == None]
+
+def reportConvergence(convergences, host: Host):
+    '''
+    Logs the time to the first healthy task and to full convergence per service.
+    '''
+    def seconds(value):
+        return '-' if value == None else '%.1fs' % value
+    logging.info("Convergence of '%s':" % host.getFQDN())
+    logging.info("  %-30s %-13s %-13s %s" % ('service', 'first healthy', 'converged', 'state'))
+    for convergence in convergences:
+        logging.info("  %-30s %-13s %-13s %s" % (convergence.service, seconds(convergence.firstHealthy), seconds(convergence.converged), convergence.state))
+
+def applyConvergence(results, host: Host, transport: SshTransport, updateTimes, deadline, interval):
+    '''
+    Watches the successfully updated services of the rollout results (see rolloutApplications) and
+    returns the results with an error for every service that did not converge.
+    '''
+    convergences = {}
+    for application, error in results:
+        if error == None:
+            convergences[application.getSwarmServicename(host)] = ServiceConvergence(application, host, updateTimes[application.getSwarmServicename(host)])
+    if not convergences:
+        return results
+    try:
+        with span('convergence', host=host.getFQDN()):
+            failed = {convergence.service: convergence for convergence in watchConvergence(list(convergences.values()), host, transport, deadline, interval)}
+    except SadException as ex:
+        # E.g. the host does not provide remote/sad-remote.py yet
+        logging.warning("Could not watch the convergence on '%s' (%s)." % (host.getFQDN(), ex))
+        return results
+    converged = []
+    for application, error in results:
+        convergence = failed.get(application.getSwarmServicename(host))
+        if convergence != None and convergence.failed != None:
+            error = SadException("not converged, %s (%s)" % (convergence.failed, convergence.state))
+        elif convergence != None:
+            error = SadException("not converged within %ds (%s)" % (deadline, convergence.state))
+        converged.append((application, error))
+    return converged
@@ -1,22 +1,35 @@
 """ Deploy module
 This module handles the deployment of tags identified by the branch, 
 a Ticket-ID or version number to the destination team machine.
-The application which will be deployed are specified in the dictionary sc_image_list. 
-Adding more applications just need to be added in that dictionary.
+The application which will be deployed are specified in the application config applications.json
+together with their rollout policies (see sad_deploy.application_config).
+Adding more applications just need to be added in that file.
 """
 from logging import exception
 import sys
 import os
+import json
+import shlex
 import subprocess
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import redirect_stdout
 import sad_common
-from sad_common.docker_helper import DockerRegistry
 
-from sad_common.run_command import runCommand
+from sad_common.instrumentation import span
+from sad_common.sad_logging import logContext
+from sad_common.sadexception import SadException
+from sad_common.ssh_transport import SshTransport
+from sad_deploy.application_config import default_application_config, readApplicationConfig, getRolloutWaves
+from sad_deploy.convergence import applyConvergence
+from sad_deploy.deploy_plan import runDeployPlan
+from sad_deploy.image_pull import prePullImages
 from sad_infra.application import Application
 from sad_infra.host import Host
 import sad_secrets.secret_helper
+from sad_secrets.ssh_identity import SshIdentity
 
 # DNS parts for team machines
 team_target_postfix = "schul-cloud.dev"
@@ -29,96 +42,349 @@ dispatch_target_postfix = "schul-cloud.org"
 dispatch_host_name = "staging"
 # Works currently for images of the specified namespace only
 docker_namespace = "schulcloud"
-# Dictionary of the applications which will be tried to deploy
-sc_image_list = [
-    {'image_name': "schulcloud-server", 'application_name': "server"},
-    {'image_name': "schulcloud-client", 'application_name': "client"},
-    {'image_name': "schulcloud-nuxt-client", 'application_name': "nuxtclient"},
-    {'image_name': "schulcloud-nuxt-storybook", 'application_name': "storybook"},
-    {'image_name': "schulcloud-nuxt-vuepress", 'application_name': "vuepress"},
-    {'image_name': "schulcloud-calendar", 'application_name': "calendar" },
-    {'image_name': "schulcloud-avcheck-webserver", 'application_name': "webserver"},
-    {'image_name': "schulcloud-avcheck-scanfile", 'application_name': "scanfile"}
-]
-
-def deployImage(application: Application, host: Host, decryptedSshKeyFile: str):
-    '''
-    Deploys a single application to the given host.
-    '''
-    logging.info("Deploying '%s'..." % application.getSwarmServicename(host))
-
-    remoteUser = "travis"
+# Seconds the ssh-agent of a run keeps the decrypted ssh key, in case the run is killed before it removes the key
+ssh_key_lifetime = 3600
+# The applications which will be tried to deploy with their rollout policies and the number of applications
+# rolled out concurrently per host if not given, read from applications.json on first use (see getApplications)
+sc_image_list = None
+default_parallel = None
 
-    sshCommand=['ssh']
+def loadApplicationConfig(configFile=default_application_config):
+    '''
+    Replaces the applications and the default parallel rollout by the ones of the config file.
+    Raises a SadException for a missing or invalid config.
+    '''
+    global sc_image_list, default_parallel
+    sc_image_list, default_parallel = readApplicationConfig(configFile)
+    logging.info("Read %d application(s) from '%s'" % (len(sc_image_list), configFile))
 
-    # Disable known hosts checking.
-    sshOptions=['-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null']
+def getApplications():
+    '''
+    Returns the applications (sc_image_list), read from the default application config if none is loaded yet.
+    '''
+    if sc_image_list == None:
+        loadApplicationConfig()
+    return sc_image_list
 
-    if decryptedSshKeyFile != None:
-        # Use provided ssh key
-        sshIdentity=['-i', decryptedSshKeyFile]
-    else:
-        # Try pageant
-        sshIdentity=[]
+def getDefaultParallel():
+    '''
+    Returns the number of applications rolled out concurrently per host of the application config.
+    '''
+    getApplications()
+    return default_parallel
 
-    # remote = <build user>@<hostname>.schul-cloud.dev
-    sshRemote=['%s@%s' % (remoteUser, host.getFQDN())]
+def deployImage(application: Application, host: Host, transport: SshTransport):
+    '''
+    Deploys a single application to the given host using the ssh transport opened for that host.
+    '''
+    logging.info("Deploying '%s'..." % application.getSwarmServicename(host))
 
     # The remote command parameters.
     # image = <imagename>:<imagetag> = <repository name>:<tag>
     # service name = <hostname>_<applicationname short>. See 'docker service ls'
     sshRemoteCommandParameters=[application.getImage(), application.getSwarmServicename(host)]
-
-    command = sshCommand + sshOptions + sshIdentity + sshRemote + sshRemoteCommandParameters
-    logging.info("Running command: '%s'" % ' '.join(command))
+    if application.policy != None:
+        # The rollout policy as JSON, the remote side splits SSH_ORIGINAL_COMMAND like a shell
+        sshRemoteCommandParameters.append(shlex.quote(json.dumps(application.policy.getUpdateOptions(), separators=(',', ':'))))
 
     # Run docker service update
-    # Example call: ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i travisssh travis@hotfix6.schul-cloud.dev schulcloud/schulcloud-server:develop_latest hotfix6_server
-    # Example execution: /usr/bin/docker service update --force --image schulcloud/schulcloud-server:develop_latest hotfix6_server
-    runCommand(command)
-    #runCommand(['ls'])
+    # Example call: ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o IdentityAgent=/tmp/sad-identity-xyz/agent -o ControlPath=/tmp/sad-ssh-xyz/master travis@hotfix6.schul-cloud.dev schulcloud/schulcloud-server:develop_latest hotfix6_server
+    # Example execution: /usr/bin/docker service update --force --update-order start-first ... --image schulcloud/schulcloud-server:develop_latest hotfix6_server
+    # The output lines of the update are tagged with the service for the JSON log
+    with span('deploy_image', service=application.getSwarmServicename(host)), \
+            logContext(host=host.hostname, application=application.applicationname_short):
+        result = transport.run(sshRemoteCommandParameters, check=False)
+        if result.returncode == 2 and len(sshRemoteCommandParameters) == 3:
+            # remote/sad-remote.py of the host does not know rollout policies yet
+            logging.warning("'%s' rejected the rollout policy, updating '%s' with its current settings." % (host.getFQDN(), application.getSwarmServicename(host)))
+            result = transport.run(sshRemoteCommandParameters[:2], check=False)
+    if result.returncode != 0:
+        # The streamed output may have been dropped by a full log queue
+        for line in result.tail:
+            logging.error(line)
+        raise SadException("The process has exited with an error (exit code %s)." % result.returncode)
     logging.info("Deployment '%s' complete." % application.getSwarmServicename(host))
 
     # TODO: Inform RocketChat
 
-def deployImages(deployhost, branch, teamnumber, imagequalifier):
-    """ deployImages
-    The function loops of the sc_image_list dictionary 
-    and call deployImage if the tag for the application images exist on the docker registry
-    """
-    logging.info("Image deployment triggered on {} for {} of team {}".format(branch, imagequalifier, teamnumber))
-    testmode = os.environ.get("TESTMODE")
-    tag_middle = ''
-    # Branch prefix and "latest" qualifier must be lowercase
-    tag_qualifier = "latest".lower()
+def inspectServices(services, host: Host, transport: SshTransport):
+    '''
+    Asks the host in one remote call which image each service runs.
+    Returns a dictionary service -> image including the digest, like 'schulcloud/schulcloud-server:develop_latest@sha256:...'.
+    '''
+    running = {}
+    try:
+        for line in transport.run(['inspect'] + services).output:
+            parts = line.split()
+            if len(parts) == 2 and parts[0] in services:
+                running[parts[0]] = parts[1]
+    except SadException as ex:
+        # E.g. the host does not provide remote/sad-remote.py yet
+        logging.warning("Could not inspect the services on '%s' (%s), updating all of them." % (host.getFQDN(), ex))
+    return running
+
+def getUnchangedReason(application: Application, host: Host, running):
+    '''
+    Compares the digest the tag refers to in the registry with the digest the service runs (see inspectServices).
+    Returns the reason to skip the update, None if the service has to be updated.
+    '''
+    image = running.get(application.getSwarmServicename(host), '-')
+    runningDigest = image.split('@')[1] if '@' in image else None
+    if application.digest != None and application.digest == runningDigest:
+        return "already running %s" % application.digest
+    if application.digest == None:
+        logging.info("Updating '%s', the registry reported no digest for '%s'." % (application.getSwarmServicename(host), application.getImage()))
+    elif runningDigest == None:
+        logging.info("Updating '%s', the digest of the running image '%s' is unknown." % (application.getSwarmServicename(host), image))
+    else:
+        logging.info("Updating '%s', it runs %s instead of %s." % (application.getSwarmServicename(host), runningDigest, application.digest))
+    return None
+
+def findUnchangedApplications(applications, host: Host, transport: SshTransport):
+    '''
+    Determines the services that already run the digest the tag refers to in the registry.
+    Returns the applications to update and the skipped ones as list of (application, reason) tuples.
+    '''
+    running = inspectServices([app.getSwarmServicename(host) for app in applications], host, transport)
+    updates = []
+    skipped = []
+    for app in applications:
+        reason = getUnchangedReason(app, host, running)
+        if reason != None:
+            skipped.append((app, reason))
+        else:
+            updates.append(app)
+    return updates, skipped
+
+def rolloutApplication(application: Application, host: Host, transport: SshTransport, updateTimes=None):
+    '''
+    Worker for the rollout pool. The worker thread is renamed after the swarm service,
+    so the log lines of concurrently running rollouts stay attributable.
+    The start time of the update is stored in the updateTimes dictionary (service -> time) if given.
+    Returns None on success, otherwise the exception that aborted the rollout.
+    '''
+    threading.current_thread().name = application.getSwarmServicename(host)
+    if updateTimes != None:
+        updateTimes[application.getSwarmServicename(host)] = time.time()
+    try:
+        deployImage(application, host, transport)
+        return None
+    except Exception as ex:
+        logging.error("Deployment '%s' failed: %s" % (application.getSwarmServicename(host), ex))
+        return ex
+
+def getApplicationWaves(applications):
+    '''
+    Returns the applications as list of waves, every application after the applications it depends on.
+    '''
+    return getRolloutWaves(applications, lambda app: app.applicationname_short, lambda app: app.getDependencies())
+
+def getFailedDependency(application: Application, errors):
+    '''
+    Returns the first dependency of the application that failed (errors: application name -> exception or None), otherwise None.
+    '''
+    return next((name for name in application.getDependencies() if errors.get(name) != None), None)
+
+def rolloutApplications(applications, host: Host, transport: SshTransport, parallel=1, updateTimes=None):
+    '''
+    Deploys all given applications to the host using a pool of at most 'parallel' workers.
+    The applications are rolled out in waves by their dependencies (see getApplicationWaves), the
+    applications of a wave together. An application whose dependency failed is not updated.
+    A failing application does not stop the others, the results are returned as list of
+    (application, exception or None) tuples in the order of the given applications.
+    '''
+    workers = max(1, min(parallel, len(applications)))
+    waves = getApplicationWaves(applications)
+    logging.info("Rolling out %d application(s) in %d wave(s) with %d worker(s)" % (len(applications), len(waves), workers))
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rollout') as executor:
+        for wave in waves:
+            ready = []
+            for app in wave:
+                dependency = getFailedDependency(app, errors)
+                if dependency != None:
+                    errors[app.applicationname_short] = SadException("not updated, the dependency '%s' failed" % dependency)
+                    logging.error("Deployment '%s' skipped: %s" % (app.getSwarmServicename(host), errors[app.applicationname_short]))
+                else:
+                    ready.append(app)
+            for app, error in zip(ready, executor.map(lambda app: rolloutApplication(app, host, transport, updateTimes), ready)):
+                errors[app.applicationname_short] = error
+    return [(app, errors[app.applicationname_short]) for app in applications]
+
+def deployOverTransport(applications, host: Host, transport: SshTransport, parallel=1, skipunchanged=False, convergencetimeout=None, convergenceinterval=5,
+                        deployplan=False):
+    '''
+    Deploys the applications to one host over an opened ssh transport. The images are pulled on the host
+    before the first service is updated, see sad_deploy.image_pull.
+    With deployplan all updates are sent to the host in one remote call, see sad_deploy.deploy_plan.
+    With convergencetimeout the updated services are watched until their tasks run the new image,
+    services not converged within that many seconds count as failed.
+    Returns the rollout results and the skipped applications, see rolloutApplications and findUnchangedApplications.
+    '''
+    skipped = []
+    updateTimes = {}
+    with logContext(host=host.hostname):
+        if skipunchanged:
+            applications, skipped = findUnchangedApplications(applications, host, transport)
+        if applications:
+            prePullImages(applications, host, transport)
+        if not applications:
+            results = []
+        elif deployplan:
+            results = runDeployPlan(applications, host, transport, parallel, updateTimes)
+        else:
+            results = rolloutApplications(applications, host, transport, parallel, updateTimes)
+        if convergencetimeout != None:
+            threading.current_thread().name = host.hostname
+            results = applyConvergence(results, host, transport, updateTimes, convergencetimeout, convergenceinterval)
+    return results, skipped
+
+def reportRollout(hostResults):
+    '''
+    Logs one aggregated report of the rollout results and the skipped applications per host,
+    for several hosts followed by a host x application matrix.
+    hostResults is a list of (host, results, skipped) tuples.
+    Raises a SadException if at least one application failed.
+    '''
+    failed = []
+    for host, results, skipped in hostResults:
+        logging.info("Deployment report for '%s':" % host.getFQDN())
+        for app, error in results:
+            status = 'UPDATED' if error is None else 'FAILED (%s)' % error
+            logging.info("  %-30s %s" % (app.getSwarmServicename(host), status))
+            if error is not None:
+                failed.append(app.getSwarmServicename(host))
+        for app, reason in skipped:
+            logging.info("  %-30s SKIPPED (%s)" % (app.getSwarmServicename(host), reason))
+        hostFailed = len([error for _, error in results if error is not None])
+        logging.info("%d of %d deployment(s) succeeded, %d unchanged service(s) skipped." % (len(results) - hostFailed, len(results), len(skipped)))
+    if len(hostResults) > 1:
+        logRolloutMatrix(hostResults)
+    if failed:
+        raise SadException("Deployment failed for: %s" % ', '.join(failed))
 
+def logRolloutMatrix(hostResults):
+    '''
+    Logs the rollout result per host (rows) and application (columns).
+    '''
+    applicationNames = []
+    rows = []
+    for host, results, skipped in hostResults:
+        cells = {}
+        for app, error in results:
+            cells[app.applicationname_short] = 'UPDATED' if error is None else 'FAILED'
+        for app, _ in skipped:
+            cells[app.applicationname_short] = 'SKIPPED'
+        for name in cells:
+            if name not in applicationNames:
+                applicationNames.append(name)
+        rows.append((host.hostname, cells))
+    width = max([len(name) for name in applicationNames] + [7])
+    logging.info("Deployment matrix:")
+    logging.info(("  %-12s %s" % ('host', ' '.join(name.ljust(width) for name in applicationNames))).rstrip())
+    for hostname, cells in rows:
+        logging.info(("  %-12s %s" % (hostname, ' '.join(cells.get(name, '-').ljust(width) for name in applicationNames))).rstrip())
+
+def readHostInventory(inventoryFile):
+    '''
+    Reads the hosts from an inventory file with one fully qualified domain name per line
+    like 'hotfix6.schul-cloud.dev'. Empty lines and lines starting with '#' are ignored.
+    '''
+    hosts = []
+    with open(inventoryFile) as inventory:
+        for line in inventory:
+            fqdn = line.strip()
+            if fqdn == '' or fqdn.startswith('#'):
+                continue
+            if '.' not in fqdn:
+                raise SadException("Invalid host '%s' in inventory '%s', a fully qualified domain name is expected." % (fqdn, inventoryFile))
+            hostname, domain = fqdn.split('.', 1)
+            hosts.append(Host(hostname, domain))
+    return hosts
+
+def getDeployHosts(deployhost, teamnumbers, hostinventory):
+    '''
+    Returns the hosts to deploy to: the test or staging host, the hosts of the inventory file
+    or the team machines of the given team numbers. Team numbers and an inventory file exclude each other.
+    '''
+    testmode = os.environ.get("TESTMODE")
+    if hostinventory != None and any(teamnumber != None for teamnumber in teamnumbers):
+        raise SadException("Either team numbers or a host inventory can be given, not both.")
     if deployhost == 'test' and (testmode == None):
         # Deploy to the test host
-        deploy_host = Host(auto_host_name , auto_target_postfix)
+        return [Host(auto_host_name , auto_target_postfix)]
     elif deployhost == 'staging' and (testmode == None):
         # Deploy to the staging host
-        deploy_host = Host(dispatch_host_name , dispatch_target_postfix)
-        if imagequalifier != '':
-            tag_middle = '_' + imagequalifier
+        return [Host(dispatch_host_name , dispatch_target_postfix)]
+    elif hostinventory != None:
+        return readHostInventory(hostinventory)
     else:
-        if imagequalifier != '':
-            tag_middle = '_' + imagequalifier
-        deploy_host = Host("%s%d" % (team_host_name_prefix, teamnumber) , team_target_postfix)
-    tag_to_deploy = branch + tag_middle + "_" + tag_qualifier
-    decryptedSshKeyFile = None
+        return [Host("%s%d" % (team_host_name_prefix, teamnumber) , team_target_postfix) for teamnumber in teamnumbers]
+
+def getTagToDeploy(branch, imagequalifier):
+    '''
+    Returns the tag like 'develop_latest' or 'feature_SC-1234_latest'.
+    '''
+    tag_middle = ''
+    # Branch prefix and "latest" qualifier must be lowercase
+    tag_qualifier = "latest".lower()
+    if imagequalifier != '':
+        tag_middle = '_' + imagequalifier
+    return branch + tag_middle + "_" + tag_qualifier
+
+def openSshIdentity(lifetime=ssh_key_lifetime):
+    '''
+    Decrypts the ssh key if the passphrase is set and returns the opened SshIdentity, which has to be
+    closed after the run, otherwise None to use the ssh identity of the currently logged in user.
+    '''
     if sad_secrets.secret_helper.isPassphraseSet():
-        decryptedSshKeyFile="travisssh"
-        sad_secrets.secret_helper.gpgDecrypt(decryptedSshKeyFile)
+        return SshIdentity('travisssh.gpg', lifetime).open()
+    logging.info("Passphrase not set in CI_GITHUB_TRAVISUSER_SWARMVM_KEY. Using ssh identity of the currently logged in user.")
+    return None
+
+def checkArgs(deployhost, branchprefix, teamnumber, jiraid, imageversion):
+    '''
+    Validates the branch prefix for the deploy host and returns the image qualifier (Ticket-ID or version).
+    '''
+    imagequalifier = ''
+    if deployhost == 'test':
+        # Deploy to the test host, just develop is supported
+        if branchprefix != 'develop':
+            raise Exception("Branch prefix 'develop' only is supported with deployhost 'test'")    
+    elif deployhost == 'staging':
+        # Deploy to the staging host, just release with matching NEXT_VERSION is supported
+        if branchprefix != 'release':
+            raise Exception("deployhost 'staging' is only supported with Branch prefix 'release'")
+        if imageversion != None:
+            # Version spezification has to be with loer case letters
+            imagequalifier = imageversion.lower()
+        else:
+            raise Exception("No imageversion is specified for branchprefix '{}'".format(branchprefix))
     else:
-        logging.info("Passphrase not set in CI_GITHUB_TRAVISUSER_SWARMVM_KEY. Using ssh identity of the currently logged in user.")
-    drh = DockerRegistry(docker_namespace)
-    drh.dockerRegistryLogin()
-    no_images_deployed = 0
-    for sc_image in sc_image_list:
-        if drh.dockerRegistryCheckTag(sc_image['image_name'], tag_to_deploy):
-            app = Application(sc_image['application_name'], docker_namespace + '/' + sc_image['image_name'], tag_to_deploy)
-            deployImage(app, deploy_host, decryptedSshKeyFile)
-            no_images_deployed += 1
-    if no_images_deployed == 0:
-        # Without checking that at least on tag has been deploy the abort of the calling job would not be possible
-        raise Exception("No images deployed, tag '{}' may not exist for any image on the branch prefix '{}'".format(tag_to_deploy, branch))
\ No newline at end of file
+        # Deploy to the team host
+        if branchprefix == 'release' or branchprefix == 'master':
+            if imageversion != None:
+                # Version spezification has to be with loer case letters
+                imagequalifier = imageversion.lower()
+            else:
+                raise Exception("No imageversion is specified for branchprefix '{}'".format(branchprefix))
+        elif branchprefix == 'develop':
+                pass
+        else: # feature or hotfix
+            if jiraid != None:
+                # Ticket ID will be always in uppercase letters
+                imagequalifier = jiraid.upper()
+            else:
+                raise Exception("No jiraid is specified for branchprefix '{}'".format(branchprefix))
+    return imagequalifier
+
+def createApplication(sc_image, tag_to_deploy, tag):
+    '''
+    Returns the Application of an sc_image_list entry for the tag description reported by the registry.
+    '''
+    return Application(sc_image['application_name'], docker_namespace + '/' + sc_image['image_name'], tag_to_deploy, tag.get('digest'),
+                       sc_image.get('policy'))
+
+def raiseNoImages(tag_to_deploy, branch):
+    # Without checking that at least on tag has been deploy the abort of the calling job would not be possible
+    raise Exception("No images deployed, tag '{}' may not exist for any image on the branch prefix '{}'".format(tag_to_deploy, branch))
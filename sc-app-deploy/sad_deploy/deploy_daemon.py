@@ -0,0 +1,343 @@
+""" Deploy daemon module
+Long running deploy service. The ssh key is decrypted once, the registry session and token as well as
+one ssh master connection per host stay open between the deployments.
+
+Deploy requests are accepted over a local HTTP API (see DeployApiHandler) and split into one job per
+host and tag. Requests are coalesced: a request for a host and tag that is already queued joins that
+job. A request for a host and tag that is in flight joins the single follow-up job queued behind it,
+because the running rollout may have resolved the tag before the image was pushed. A burst of pushes
+to a branch thus results in at most two rollouts per host. Jobs of the same host never run concurrently.
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from sad_common.docker_helper import DockerRegistry
+from sad_common.instrumentation import percentile
+from sad_common.sadexception import SadException
+from sad_common.ssh_transport import SshTransport
+from sad_deploy import deploy_commands
+from sad_infra.host import Host
+
+class DeployJob:
+    '''
+    Dataclass of one rollout of a tag to a host, shared by all requests coalesced into it.
+    '''
+
+    id = None
+    # Sequence number like 17
+
+    host = None
+    # The Host to deploy to
+
+    tag = None
+    # 'develop_latest'
+
+    state = 'queued'
+    # 'queued', 'running', 'succeeded' or 'failed'
+
+    def __init__(self, id, host: Host, tag, branch):
+        self.id = id
+        self.host = host
+        self.tag = tag
+        self.branch = branch
+        self.requests = []
+        # Arrival times of the coalesced requests
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self.report = None
+        self.error = None
+        self.done = threading.Event()
+
+    def getKey(self):
+        return (self.host.getFQDN(), self.tag)
+
+    def toDict(self):
+        return {'id': self.id, 'host': self.host.getFQDN(), 'tag': self.tag, 'state': self.state, 'requests': len(self.requests),
+                'queued': self.queued, 'started': self.started, 'finished': self.finished, 'report': self.report, 'error': self.error}
+
+class DeployDaemon:
+    '''
+    The job queue, the workers and the warm sessions of the daemon.
+    Attributes:
+        - parallel, skipunchanged, convergencetimeout, convergenceinterval, deployplan: rollout options, see deploy_engine.deployImagesAsync
+        - workers: number of hosts deployed concurrently
+        - history: number of finished jobs and latencies kept for the status
+    '''
+    history = 200
+
+    def __init__(self, workers=4, parallel=1, skipunchanged=True, convergencetimeout=None, convergenceinterval=5, deployplan=False):
+        self.workers = workers
+        self.parallel = parallel
+        self.skipunchanged = skipunchanged
+        self.convergencetimeout = convergencetimeout
+        self.convergenceinterval = convergenceinterval
+        self.deployplan = deployplan
+        self.key = None
+        self.registry = None
+        self.transports = {}
+        self.queue = []
+        self.running = {}
+        self.finished = deque(maxlen=self.history)
+        self.latencies = deque(maxlen=self.history)
+        self.counters = {'requests': 0, 'coalesced': 0, 'succeeded': 0, 'failed': 0}
+        self.nextId = 1
+        self.condition = threading.Condition()
+        self.transportLock = threading.Lock()
+        self.stopping = False
+        self.threads = []
+
+    def start(self):
+        '''
+        Decrypts the ssh key, logs in to the registry and starts the workers.
+        '''
+        # The daemon keeps the key until it stops
+        self.key = deploy_commands.openSshIdentity(lifetime=None)
+        self.registry = DockerRegistry(deploy_commands.docker_namespace)
+        self.registry.dockerRegistryLogin()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.work, name='worker_%d' % number, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        '''
+        Lets the workers finish their current job and closes the ssh connections.
+        '''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        for transport in self.transports.values():
+            transport.close()
+        self.transports = {}
+        if self.key != None:
+            self.key.close()
+
+    def submit(self, deployhost, branchprefix, teamnumber=None, jiraid=None, imageversion=None):
+        '''
+        Queues the rollout of the branch to the hosts of the request, coalesced with the jobs queued
+        for the same host and tag. Returns the jobs, raises an Exception for invalid requests.
+        '''
+        imagequalifier = deploy_commands.checkArgs(deployhost, branchprefix, teamnumber, jiraid, imageversion)
+        if deployhost == 'team' and teamnumber == None:
+            raise SadException("deployhost team requires a teamnumber")
+        teamnumbers = teamnumber if isinstance(teamnumber, list) else [teamnumber]
+        tag = deploy_commands.getTagToDeploy(branchprefix, imagequalifier)
+        arrival = time.time()
+        jobs = []
+        with self.condition:
+            for host in deploy_commands.getDeployHosts(deployhost, teamnumbers, None):
+                self.counters['requests'] += 1
+                job = next((job for job in self.queue if job.getKey() == (host.getFQDN(), tag)), None)
+                if job != None:
+                    self.counters['coalesced'] += 1
+                    logging.info("Request for '%s' on '%s' joins queued job %d" % (tag, host.getFQDN(), job.id))
+                else:
+                    job = DeployJob(self.nextId, host, tag, branchprefix)
+                    self.nextId += 1
+                    self.queue.append(job)
+                    logging.info("Queued job %d: '%s' on '%s' (queue depth %d)" % (job.id, tag, host.getFQDN(), len(self.queue)))
+                job.requests.append(arrival)
+                jobs.append(job)
+            self.condition.notify_all()
+        return jobs
+
+    def takeJob(self):
+        # The oldest job whose host is not busy, None when stopping
+        with self.condition:
+            while True:
+                if self.stopping:
+                    return None
+                busy = [job.host.getFQDN() for job in self.running.values()]
+                job = next((job for job in self.queue if job.host.getFQDN() not in busy), None)
+                if job != None:
+                    self.queue.remove(job)
+                    self.running[job.id] = job
+                    job.state = 'running'
+                    job.started = time.time()
+                    return job
+                self.condition.wait()
+
+    def work(self):
+        while True:
+            job = self.takeJob()
+            if job == None:
+                return
+            try:
+                self.runJob(job)
+                job.state = 'succeeded'
+            except Exception as ex:
+                logging.error("Job %d failed: %s" % (job.id, ex))
+                job.error = str(ex)
+                job.state = 'failed'
+            self.finishJob(job)
+
+    def finishJob(self, job: DeployJob):
+        with self.condition:
+            job.finished = time.time()
+            del self.running[job.id]
+            self.counters[job.state] += 1
+            self.finished.append(job)
+            self.latencies.extend(job.finished - arrival for arrival in job.requests)
+            self.condition.notify_all()
+        job.done.set()
+
+    def getJob(self, id):
+        '''
+        Returns the queued, running or recently finished job with the id, None if unknown.
+        '''
+        with self.condition:
+            jobs = self.queue + list(self.running.values()) + list(self.finished)
+        return next((job for job in jobs if job.id == id), None)
+
+    def getTransport(self, host: Host):
+        '''
+        Returns the open ssh transport of the host, opened on first use and kept for the following jobs.
+        A master connection that exited while idle (see ssh_transport.master_idle_timeout) is opened again.
+        '''
+        # Jobs of the same host do not run concurrently, so only one worker opens the transport of a host
+        with self.transportLock:
+            transport = self.transports.get(host.getFQDN())
+        if transport != None and not transport.isAlive():
+            transport.close()
+            transport = None
+        if transport == None:
+            transport = SshTransport(host, self.key).open()
+            with self.transportLock:
+                self.transports[host.getFQDN()] = transport
+        return transport
+
+    def runJob(self, job: DeployJob):
+        '''
+        Resolves the tag in the registry and rolls it out to the host of the job.
+        '''
+        threading.current_thread().name = job.host.hostname
+        logging.info("Running job %d: '%s' on '%s' for %d request(s)" % (job.id, job.tag, job.host.getFQDN(), len(job.requests)))
+        self.registry.dockerRegistryLogin()
+        tags = self.registry.getTags([sc_image['image_name'] for sc_image in deploy_commands.getApplications()], job.tag)
+        applications = [deploy_commands.createApplication(sc_image, job.tag, tags[sc_image['image_name']])
+                        for sc_image in deploy_commands.getApplications() if tags[sc_image['image_name']] != None]
+        if len(applications) == 0:
+            deploy_commands.raiseNoImages(job.tag, job.branch)
+        transport = self.getTransport(job.host)
+        results, skipped = deploy_commands.deployOverTransport(applications, job.host, transport, self.parallel, self.skipunchanged,
+                                                               self.convergencetimeout, self.convergenceinterval, self.deployplan)
+        threading.current_thread().name = job.host.hostname
+        job.report = {app.getSwarmServicename(job.host): 'UPDATED' if error == None else 'FAILED (%s)' % error for app, error in results}
+        job.report.update({app.getSwarmServicename(job.host): 'SKIPPED (%s)' % reason for app, reason in skipped})
+        deploy_commands.reportRollout([(job.host, results, skipped)])
+
+    def getStatus(self):
+        '''
+        Returns the queue depth, the jobs in flight, the counters and the request latencies (request until
+        its rollout finished) as dictionary.
+        '''
+        with self.condition:
+            latencies = sorted(self.latencies)
+            status = dict(self.counters)
+            status.update({'queue_depth': len(self.queue), 'in_flight': len(self.running),
+                           'queued': [job.toDict() for job in self.queue], 'running': [job.toDict() for job in self.running.values()]})
+        status['latency'] = {'count': len(latencies),
+                             'p50': percentile(latencies, 50) if latencies else None,
+                             'p95': percentile(latencies, 95) if latencies else None}
+        return status
+
+    def getMetrics(self):
+        '''
+        Returns the status in the Prometheus text format.
+        '''
+        status = self.getStatus()
+        lines = [
+            '# TYPE sad_daemon_queue_depth gauge', 'sad_daemon_queue_depth %d' % status['queue_depth'],
+            '# TYPE sad_daemon_in_flight gauge', 'sad_daemon_in_flight %d' % status['in_flight'],
+            '# TYPE sad_daemon_requests_total counter', 'sad_daemon_requests_total %d' % status['requests'],
+            '# TYPE sad_daemon_coalesced_total counter', 'sad_daemon_coalesced_total %d' % status['coalesced'],
+            '# TYPE sad_daemon_rollouts_total counter',
+            'sad_daemon_rollouts_total{result="succeeded"} %d' % status['succeeded'],
+            'sad_daemon_rollouts_total{result="failed"} %d' % status['failed'],
+            '# HELP sad_daemon_request_latency_seconds Seconds from a request until its rollout finished, recent requests.',
+            '# TYPE sad_daemon_request_latency_seconds summary'
+        ]
+        if status['latency']['count'] > 0:
+            lines.append('sad_daemon_request_latency_seconds{quantile="0.5"} %.3f' % status['latency']['p50'])
+            lines.append('sad_daemon_request_latency_seconds{quantile="0.95"} %.3f' % status['latency']['p95'])
+        lines.append('sad_daemon_request_latency_seconds_count %d' % status['latency']['count'])
+        return '\n'.join(lines) + '\n'
+
+class DeployApiHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP API of the daemon:
+        POST /deploy     {"deployhost": "team", "branchprefix": "feature", "teamnumber": 6, "jiraid": "SC-1234", "imageversion": null, "wait": false}
+                         queues the rollout, answers 202 with the jobs, with wait 200 once they finished
+        GET  /jobs/<id>  state and report of a job
+        GET  /status     queue depth, jobs in flight, counters and latencies as JSON
+        GET  /metrics    the same in the Prometheus text format
+    '''
+    protocol_version = 'HTTP/1.1'
+    daemon = None
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
+
+    def send(self, status, body, contentType='application/json'):
+        if not isinstance(body, str):
+            body = json.dumps(body, indent=2)
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            return self.send(200, self.daemon.getStatus())
+        if self.path == '/metrics':
+            return self.send(200, self.daemon.getMetrics(), 'text/plain; version=0.0.4')
+        if self.path.startswith('/jobs/') and self.path[len('/jobs/'):].isdigit():
+            job = self.daemon.getJob(int(self.path[len('/jobs/'):]))
+            if job != None:
+                return self.send(200, job.toDict())
+        self.send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/deploy':
+            return self.send(404, {'error': 'not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            jobs = self.daemon.submit(request.get('deployhost'), request.get('branchprefix'), request.get('teamnumber'),
+                                      request.get('jiraid'), request.get('imageversion'))
+        except Exception as ex:
+            return self.send(400, {'error': str(ex)})
+        if request.get('wait'):
+            for job in jobs:
+                job.done.wait()
+            failed = any(job.state == 'failed' for job in jobs)
+            return self.send(500 if failed else 200, {'jobs': [job.toDict() for job in jobs]})
+        self.send(202, {'jobs': [job.toDict() for job in jobs]})
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(daemon: DeployDaemon, address='127.0.0.1', port=8765):
+    '''
+    Starts the daemon and answers the API requests until interrupted.
+    '''
+    daemon.start()
+    handler = type('Handler', (DeployApiHandler,), {'daemon': daemon})
+    server = ThreadingServer((address, port), handler)
+    logging.info("Deploy daemon listening on http://%s:%d" % (address, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Stopping the deploy daemon")
+    finally:
+        server.server_close()
+        daemon.stop()
@@ -0,0 +1,183 @@
+""" Deploy engine module
+Runs a deployment as asyncio dependency graph instead of a sequence of steps:
+
+    decrypt ssh key ──> open ssh transport per host ──┬──> (inspect services) ──┐
+    registry login ──> check tag per application ─────┴────────────────────────┴──> pull images ──> update service
+
+The ssh key decryption and the registry login overlap, each tag check starts as soon as the login is
+done. Once all tag checks of a host passed, the images are pulled on the host (see sad_deploy.image_pull)
+and each service update starts as soon as the images are there and the updates of the applications
+it depends on (see sad_deploy.application_config) are done. The blocking steps are the ones of sad_deploy.deploy_commands, run in a thread pool, so the
+wall time of a deployment gets close to its slowest chain of steps instead of the sum of all steps.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sad_common.docker_helper import DockerRegistry
+from sad_common.sadexception import SadException
+from sad_common.ssh_transport import SshTransport
+from sad_deploy import deploy_commands
+from sad_deploy.convergence import applyConvergence
+from sad_deploy.deploy_plan import runDeployPlan
+from sad_deploy.image_pull import prePullImages
+from sad_infra.application import getSwarmServicename
+from sad_infra.host import Host
+
+# Threads for the blocking steps, bounds the concurrent subprocesses and registry requests
+engine_workers = 32
+
+def runNamed(name, function, *args):
+    # Names the pool thread after the step, so the log lines stay attributable
+    threading.current_thread().name = name
+    return function(*args)
+
+async def runBlocking(name, function, *args):
+    '''
+    Runs the blocking function in the thread pool of the engine, in a thread with the given name.
+    '''
+    return await asyncio.get_event_loop().run_in_executor(None, runNamed, name, function, *args)
+
+async def checkTag(drh: DockerRegistry, login, sc_image, tag_to_deploy):
+    '''
+    Waits for the registry login and returns the Application if the tag exists for the image, otherwise None.
+    '''
+    await login
+    tag = await runBlocking('registry', drh.dockerRegistryGetTag, sc_image['image_name'], tag_to_deploy)
+    return deploy_commands.createApplication(sc_image, tag_to_deploy, tag) if tag != None else None
+
+async def prePullHost(tagChecks, host: Host, transport: SshTransport, running):
+    '''
+    Waits for the tag checks and pulls the images of the applications to update on the host.
+    '''
+    applications = [application for application in await asyncio.gather(*tagChecks) if application != None]
+    if running != None:
+        services = await running
+        applications = [application for application in applications if deploy_commands.getUnchangedReason(application, host, services) == None]
+    if applications:
+        await runBlocking(host.hostname, prePullImages, applications, host, transport)
+
+async def deployApplication(tagCheck, dependencies, deployments, host: Host, transport: SshTransport, running, pulled, parallel: asyncio.Semaphore,
+                            updateTimes, deployplan):
+    '''
+    Waits for the tag check of the application and updates its service on the host after the images
+    are pulled (pulled task) and after the deployments (dictionary application name -> task) of the
+    applications it depends on.
+    Returns None if the tag does not exist, ('skipped', application, reason) for unchanged services,
+    with deployplan ('planned', application, None) for the services to update with the deploy plan,
+    otherwise ('deployed', application, exception or None).
+    '''
+    application = await tagCheck
+    if application == None:
+        return None
+    if running != None:
+        reason = deploy_commands.getUnchangedReason(application, host, await running)
+        if reason != None:
+            return ('skipped', application, reason)
+    await pulled
+    if deployplan:
+        # The remote side orders the updates of the plan
+        return ('planned', application, None)
+    for name in dependencies:
+        outcome = await deployments[name]
+        if outcome != None and outcome[0] == 'deployed' and outcome[2] != None:
+            error = SadException("not updated, the dependency '%s' failed" % name)
+            logging.error("Deployment '%s' skipped: %s" % (application.getSwarmServicename(host), error))
+            return ('deployed', application, error)
+    async with parallel:
+        error = await runBlocking('rollout', deploy_commands.rolloutApplication, application, host, transport, updateTimes)
+    return ('deployed', application, error)
+
+async def deployHost(host: Host, key, tagChecks, parallel, skipunchanged, convergence, deployplan, hosts: asyncio.Semaphore):
+    '''
+    Opens the ssh transport of the host as soon as the key is available, pulls the images once all tag
+    checks passed and deploys every application after the pull. With deployplan the updates are sent
+    in one remote call after the pull. With convergence (timeout, interval) the updated services are watched
+    until they converged, see deploy_commands.deployOverTransport.
+    Returns the rollout results and the skipped applications, see deploy_commands.deployOverTransport.
+    '''
+    async with hosts:
+        transport = SshTransport(host, await key)
+        await runBlocking(host.hostname, transport.open)
+        try:
+            running = None
+            if skipunchanged:
+                services = [getSwarmServicename(sc_image['application_name'], host) for sc_image in deploy_commands.getApplications()]
+                running = asyncio.ensure_future(runBlocking(host.hostname, deploy_commands.inspectServices, services, host, transport))
+            pulled = asyncio.ensure_future(prePullHost(tagChecks, host, transport, running))
+            semaphore = asyncio.Semaphore(parallel)
+            updateTimes = {}
+            # All tasks exist before the first one runs, so every deployment can wait for the ones it depends on
+            deployments = {}
+            for tagCheck, sc_image in zip(tagChecks, deploy_commands.getApplications()):
+                dependencies = sc_image['policy'].depends_on if sc_image.get('policy') != None else []
+                deployments[sc_image['application_name']] = asyncio.ensure_future(
+                    deployApplication(tagCheck, dependencies, deployments, host, transport, running, pulled, semaphore, updateTimes,
+                                      deployplan))
+            outcomes = await asyncio.gather(*deployments.values(), return_exceptions=True)
+            # Also when no deployment waited for it, e.g. all services unchanged
+            await pulled
+            for outcome in outcomes:
+                if isinstance(outcome, BaseException):
+                    raise outcome
+            results = [(application, error) for kind, application, error in filter(None, outcomes) if kind == 'deployed']
+            skipped = [(application, reason) for kind, application, reason in filter(None, outcomes) if kind == 'skipped']
+            planned = [application for kind, application, _ in filter(None, outcomes) if kind == 'planned']
+            if planned:
+                results = await runBlocking(host.hostname, runDeployPlan, planned, host, transport, parallel, updateTimes)
+            if convergence[0] != None:
+                results = await runBlocking(host.hostname, applyConvergence, results, host, transport, updateTimes, *convergence)
+        finally:
+            await runBlocking(host.hostname, transport.close)
+    return results, skipped
+
+async def runDeployment(deployhost, branch, teamnumber, imagequalifier, parallel, skipunchanged, hostinventory, hostparallel, convergence, deployplan):
+    teamnumbers = teamnumber if isinstance(teamnumber, (list, tuple)) else [teamnumber]
+    deploy_hosts = deploy_commands.getDeployHosts(deployhost, teamnumbers, hostinventory)
+    if len(deploy_hosts) == 0:
+        raise SadException("No hosts to deploy to.")
+    tag_to_deploy = deploy_commands.getTagToDeploy(branch, imagequalifier)
+
+    drh = DockerRegistry(deploy_commands.docker_namespace)
+    key = asyncio.ensure_future(runBlocking('secrets', deploy_commands.openSshIdentity))
+    login = asyncio.ensure_future(runBlocking('registry', drh.dockerRegistryLogin))
+    tagChecks = [asyncio.ensure_future(checkTag(drh, login, sc_image, tag_to_deploy)) for sc_image in deploy_commands.getApplications()]
+    hosts = asyncio.Semaphore(len(deploy_hosts) if hostparallel == None else max(1, hostparallel))
+    hostTasks = [deployHost(host, key, tagChecks, parallel, skipunchanged, convergence, deployplan, hosts) for host in deploy_hosts]
+    outcomes = await asyncio.gather(*hostTasks, return_exceptions=True)
+    # Collect the remaining tasks, so their failures do not go unnoticed
+    await asyncio.gather(key, login, *tagChecks, return_exceptions=True)
+    if key.exception() == None and key.result() != None:
+        key.result().close()
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            raise outcome
+    if all(tagCheck.result() == None for tagCheck in tagChecks):
+        deploy_commands.raiseNoImages(tag_to_deploy, branch)
+    deploy_commands.reportRollout([(host, results, skipped) for host, (results, skipped) in zip(deploy_hosts, outcomes)])
+
+def deployImagesAsync(deployhost, branch, teamnumber, imagequalifier, parallel=1, skipunchanged=False, hostinventory=None, hostparallel=None,
+                      convergencetimeout=None, convergenceinterval=5, deployplan=False):
+    """ deployImagesAsync
+    Deploys the images of the tag identified by the branch and the image qualifier (Ticket-ID or version)
+    to the deploy host, runs the steps as dependency graph on an asyncio event loop.
+    teamnumber is a single team number or a list of team numbers, alternatively the team hosts are read
+    from the hostinventory file. Up to hostparallel hosts (default: all) are deployed concurrently.
+    With parallel > 1 up to that many applications are rolled out concurrently per host.
+    With skipunchanged services already running the image digest of the tag are not updated.
+    With convergencetimeout the updated services must converge within that many seconds and with
+    deployplan the updates of a host are sent in one remote call, see deploy_commands.deployOverTransport.
+    """
+    logging.info("Image deployment triggered on {} for {} of team {}".format(branch, imagequalifier, teamnumber))
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=engine_workers, thread_name_prefix='engine')
+    loop.set_default_executor(executor)
+    try:
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(runDeployment(deployhost, branch, teamnumber, imagequalifier, parallel, skipunchanged, hostinventory, hostparallel,
+                                              (convergencetimeout, convergenceinterval), deployplan))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+        executor.shutdown()
@@ -0,0 +1,102 @@
+""" Deploy plan module
+A deploy plan describes all service updates of one host, so the host can run them with a single remote
+call ('plan' command of remote/sad-remote.py) instead of one ssh round trip per application:
+
+    {"host": "hotfix6.schul-cloud.dev", "parallel": 4,
+     "services": [{"service": "hotfix6_server", "image": "schulcloud/schulcloud-server:develop_latest",
+                   "policy": {"order": "start-first", ...}},
+                  {"service": "hotfix6_client", "image": "schulcloud/schulcloud-client:develop_latest",
+                   "policy": {...}, "after": ["hotfix6_server"]}, ...]}
+
+The remote side starts the updates concurrently and streams one JSON line per started and finished update.
+The services are listed in rollout order, an update starts after the updates of the services in its
+'after' list succeeded. The 'policy' is the rollout policy of the application (see sad_infra.rollout_policy).
+"""
+import json
+import logging
+import shlex
+import time
+
+from sad_common.instrumentation import span
+from sad_common.sad_logging import logContext
+from sad_common.sadexception import SadException
+from sad_common.ssh_transport import SshTransport
+from sad_deploy.application_config import getRolloutWaves
+from sad_infra.host import Host
+
+def createDeployPlan(applications, host: Host, parallel=1):
+    '''
+    Returns the deploy plan of the applications (e.g. created from sc_image_list) for the host.
+    '''
+    names = dict((app.applicationname_short, app) for app in applications)
+    services = []
+    for wave in getRolloutWaves(applications, lambda app: app.applicationname_short, lambda app: app.getDependencies()):
+        for app in wave:
+            entry = {'service': app.getSwarmServicename(host), 'image': app.getImage()}
+            if app.policy != None:
+                entry['policy'] = app.policy.getUpdateOptions()
+            after = [names[name].getSwarmServicename(host) for name in app.getDependencies() if name in names]
+            if after:
+                entry['after'] = after
+            services.append(entry)
+    return {'host': host.getFQDN(), 'parallel': max(1, parallel), 'services': services}
+
+def parsePlanEvents(lines):
+    '''
+    Parses the JSON lines streamed by the remote 'plan' command, other output lines are ignored.
+    Returns a dictionary service -> {'started': ..., 'finished': ..., 'returncode': ..., 'output': [...]}.
+    '''
+    events = {}
+    for line in lines:
+        if not line.startswith('{'):
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        state = events.setdefault(event.get('service'), {})
+        if event.get('event') == 'started':
+            state['started'] = event['time']
+        elif event.get('event') == 'finished':
+            state['finished'] = event['time']
+            state['returncode'] = event.get('returncode')
+            state['output'] = event.get('output', [])
+    return events
+
+def runDeployPlan(applications, host: Host, transport: SshTransport, parallel=1, updateTimes=None):
+    '''
+    Sends the deploy plan of the applications to the host and waits for all updates.
+    The start time of each update is stored in the updateTimes dictionary (service -> time) if given.
+    Returns the results as list of (application, exception or None) tuples, see deploy_commands.rolloutApplications.
+    '''
+    plan = createDeployPlan(applications, host, parallel)
+    logging.info("Sending deploy plan with %d service update(s) to '%s'" % (len(plan['services']), host.getFQDN()))
+    start = time.time()
+    try:
+        # The remote side splits SSH_ORIGINAL_COMMAND like a shell, so the JSON needs to be quoted
+        with span('deploy_plan', host=host.getFQDN()):
+            output = transport.run(['plan', shlex.quote(json.dumps(plan, separators=(',', ':')))], logLevel=logging.DEBUG).output
+    except SadException as ex:
+        logging.error("Deploy plan on '%s' failed: %s" % (host.getFQDN(), ex))
+        return [(app, ex) for app in applications]
+    events = parsePlanEvents(output)
+    results = []
+    for app in applications:
+        service = app.getSwarmServicename(host)
+        state = events.get(service, {})
+        if updateTimes != None:
+            updateTimes[service] = start + state.get('started', 0)
+        with logContext(host=host.hostname, application=app.applicationname_short):
+            if 'finished' not in state:
+                error = SadException("no result reported by the deploy plan")
+            elif state['returncode'] != 0:
+                error = SadException("The process has exited with an error (exit code %s)." % state['returncode'])
+                for line in state['output']:
+                    logging.error("%s: %s" % (service, line))
+            else:
+                error = None
+                logging.info("Deployment '%s' complete after %.1fs." % (service, state['finished'] - state.get('started', 0)))
+            if error != None:
+                logging.error("Deployment '%s' failed: %s" % (service, error))
+        results.append((app, error))
+    return results
@@ -0,0 +1,72 @@
+""" Image pull module
+Before the services of a host are switched to the new images, the images are pulled on the host in one
+remote call ('pull' command of remote/sad-remote.py) while the old tasks keep running. The service updates
+then start their new tasks from the local images, so the download no longer counts as downtime and the
+pulls of the applications do not compete with each other during the rollout.
+
+The pull runs on the swarm manager the ssh connection reaches. In a swarm with several nodes, tasks
+scheduled on the other nodes still pull their image during the service update.
+"""
+import json
+import logging
+import time
+
+from sad_common.instrumentation import span, tracer
+from sad_common.sad_logging import logContext
+from sad_common.ssh_transport import SshTransport
+from sad_infra.host import Host
+
+# Seconds the pulls of a host may take before the rollout starts without them
+pull_timeout = 600
+
+def parsePullEvents(lines):
+    '''
+    Parses the JSON lines printed by the remote 'pull' command, other output lines are ignored.
+    Returns a dictionary image -> {'time': ..., 'duration': ..., 'returncode': ..., 'output': [...]}.
+    '''
+    events = {}
+    for line in lines:
+        if not line.startswith('{'):
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if event.get('event') == 'pulled':
+            events[event.get('image')] = event
+    return events
+
+def prePullImages(applications, host: Host, transport: SshTransport):
+    '''
+    Pulls the images of the applications on the host concurrently and logs the pull duration per image.
+    Returns a dictionary image -> pull duration in seconds, None for images that could not be pulled.
+    A failed pre-pull does not stop the rollout, the service update pulls the image itself.
+    '''
+    images = list(dict.fromkeys(app.getImage() for app in applications))
+    logging.info("Pulling %d image(s) on '%s' before the rollout" % (len(images), host.getFQDN()))
+    start = time.time()
+    with span('pre_pull', host=host.getFQDN()):
+        result = transport.run(['pull'] + images, timeout=pull_timeout, logLevel=logging.DEBUG, check=False)
+    events = parsePullEvents(result.output)
+    if result.timedout:
+        logging.warning("Pre-pull on '%s' stopped after the timeout of %ss." % (host.getFQDN(), pull_timeout))
+    elif result.returncode != 0 and not events:
+        # e.g. remote/sad-remote.py of the host does not know the pull command yet
+        logging.warning("Pre-pull on '%s' failed (exit code %s), the service updates pull the images." % (host.getFQDN(), result.returncode))
+        return dict((image, None) for image in images)
+    durations = {}
+    for app in applications:
+        image = app.getImage()
+        event = events.get(image)
+        with logContext(host=host.hostname, application=app.applicationname_short):
+            if event == None or event.get('returncode') != 0:
+                durations[image] = None
+                for line in (event or {}).get('output', []):
+                    logging.warning("%s: %s" % (image, line))
+                logging.warning("Pre-pull of '%s' on '%s' failed, the service update pulls it." % (image, host.getFQDN()))
+            else:
+                durations[image] = event['duration']
+                tracer.record('image_pull', start + event['time'] - event['duration'], event['duration'], True, {'host': host.getFQDN(), 'image': image})
+                logging.info("Pulled '%s' on '%s' in %.1fs." % (image, host.getFQDN(), event['duration']))
+    logging.info("Pre-pull on '%s' done in %.1fs." % (host.getFQDN(), time.time() - start))
+    return durations
@@ -1,4 +1,17 @@
 from sad_infra.host import Host
+from sad_infra.rollout_policy import RolloutPolicy
+
+def getSwarmServicename(applicationname_short, host: Host):
+    '''
+    Returns the swarm service name of the application (applicationname_short like 'server') on the host,
+    see Application.getSwarmServicename.
+    '''
+    if host.hostname == "test":
+        # Broken the pattern on the "test" server.
+        servicename = "%s-schul-cloud_%s" % (host.hostname, applicationname_short)
+    else:
+        servicename = "%s_%s" % (host.hostname, applicationname_short)
+    return  servicename
 
 class Application:
     '''
@@ -14,27 +27,38 @@ class Application:
     applicationname_short = None
     # 'server'
 
-    def __init__(self, applicationname_short, imagename, imagetag):
+    digest = None
+    # 'sha256:...', the manifest digest the tag refers to in the registry
+
+    policy = None
+    # The RolloutPolicy, None to update the service with the settings it has
+
+    def __init__(self, applicationname_short, imagename, imagetag, digest=None, policy: RolloutPolicy = None):
         '''
         The applicationname_short like 'server'.
         The imagename like 'schulcloud/schulcloud-server'.
         The imagetag like 'develop_latest'.
+        The digest like 'sha256:...', None if unknown.
+        The policy from the application config, None if unknown.
         '''
         self.applicationname_short = applicationname_short
         self.imagename = imagename
         self.imagetag = imagetag
+        self.digest = digest
+        self.policy = policy
+
+    def getDependencies(self):
+        '''
+        Returns the short names of the applications to roll out before this one.
+        '''
+        return self.policy.depends_on if self.policy != None else []
 
     def getSwarmServicename(self, host: Host):
         '''
         The servicename is constructed from two parts: <hostname>_<applicationname_short>
         E.g.: "hotfix6_server".
         '''
-        if host.hostname == "test":
-            # Broken the pattern on the "test" server.
-            servicename = "%s-schul-cloud_%s" % (host.hostname, self.applicationname_short)
-        else:
-            servicename = "%s_%s" % (host.hostname, self.applicationname_short)
-        return  servicename
+        return getSwarmServicename(self.applicationname_short, host)
 
     def getImage(self):
         '''
@@ -0,0 +1,45 @@
+class RolloutPolicy:
+    '''
+    Dataclass that stores how the service of an application is updated, see applications.json.
+    '''
+
+    parallelism = 1
+    # Tasks of the service updated at once, 0 for all
+
+    order = 'start-first'
+    # 'start-first' starts the new task before the old one is stopped, so the service stays available,
+    # 'stop-first' stops the old task first, e.g. for applications that must not run twice
+
+    delay = 0
+    # Seconds between the updates of two batches of tasks
+
+    failure_action = 'rollback'
+    # 'rollback', 'pause' or 'continue' if an updated task fails within the monitor time
+
+    monitor = 10
+    # Seconds an updated task is watched for failure
+
+    depends_on = None
+    # Applications (short names like 'server') rolled out before this one
+
+    orders = ('start-first', 'stop-first')
+    failure_actions = ('rollback', 'pause', 'continue')
+
+    def __init__(self, parallelism=1, order='start-first', delay=0, failure_action='rollback', monitor=10, depends_on=None):
+        self.parallelism = parallelism
+        self.order = order
+        self.delay = delay
+        self.failure_action = failure_action
+        self.monitor = monitor
+        self.depends_on = list(depends_on or [])
+
+    def getUpdateOptions(self):
+        '''
+        Returns the options sent to remote/sad-remote.py for 'docker service update'.
+        '''
+        return {'parallelism': self.parallelism, 'order': self.order, 'delay': self.delay, 'failure_action': self.failure_action,
+                'monitor': self.monitor}
+
+    def __str__(self):
+        after = ", after %s" % ', '.join(self.depends_on) if self.depends_on else ''
+        return "%s, %d task(s) at once, delay %ds, on failure %s%s" % (self.order, self.parallelism, self.delay, self.failure_action, after)
@@ -1,18 +1,59 @@
 import logging
 import os
-from sad_common.run_command import runCommand
+import subprocess
+import tempfile
+from sad_common.instrumentation import span
+from sad_common.sadexception import SadException
 
-def gpgDecrypt(decryptToFile: str):
+# Initial size of the plaintext buffer, doubled as needed
+plaintext_buffer_size = 64 * 1024
+
+def readIntoBuffer(stream, size=plaintext_buffer_size):
+    '''
+    Reads the unbuffered stream until EOF directly into a bytearray and returns a bytearray of the data
+    read. No other copy of the data is left in memory, the buffers read into are overwritten.
+    '''
+    buffer = bytearray(size)
+    length = 0
+    while True:
+        if length == len(buffer):
+            larger = bytearray(2 * len(buffer))
+            larger[:length] = buffer
+            buffer[:] = bytes(len(buffer))
+            buffer = larger
+        with memoryview(buffer)[length:] as free:
+            count = stream.readinto(free)
+        if not count:
+            break
+        length += count
+    # Resizing the bytearray could free its memory without overwriting it, so the data is copied instead
+    with memoryview(buffer)[:length] as view:
+        data = bytearray(view)
+    buffer[:] = bytes(len(buffer))
+    return data
+
+def gpgDecryptToMemory(encryptedFile: str):
     '''
-    Decrypts the private key file using the passphrase from the CI_GITHUB_TRAVISUSER_SWARMVM_KEY environment variable.
-    By convention an input file that matches the output file with the ".gpg" extension must exist.
+    Decrypts the file using the passphrase from the CI_GITHUB_TRAVISUSER_SWARMVM_KEY environment variable
+    and returns the plaintext as bytearray, so the caller can overwrite it. The output of gpg is read
+    directly into the bytearray, no bytes copy is made. Nothing is written to disk and the plaintext is
+    not logged.
     '''
-    encryptedFile='%s.gpg' % decryptToFile
-    logging.info("Decrypting  '%s' to '%s'." % (encryptedFile, decryptToFile))
+    logging.info("Decrypting '%s' into memory." % encryptedFile)
     passphrase= os.environ['CI_GITHUB_TRAVISUSER_SWARMVM_KEY']
-    decryptCommand=['gpg', '--quiet', '--batch', '--yes', '--decrypt', '--passphrase=%s' % passphrase, '--output', decryptToFile, encryptedFile]
-    runCommand(decryptCommand)
-    runCommand(['chmod', '600', decryptToFile])
+    decryptCommand=['gpg', '--quiet', '--batch', '--yes', '--decrypt', '--passphrase=%s' % passphrase, '--output', '-', encryptedFile]
+    with span('gpg_decrypt'), tempfile.TemporaryFile() as errorOutput:
+        # bufsize=0: no buffered reader in between that keeps its own copy of the plaintext
+        with subprocess.Popen(decryptCommand, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=errorOutput, bufsize=0) as process:
+            plaintext = readIntoBuffer(process.stdout)
+        errorOutput.seek(0)
+        errors = errorOutput.read()
+    if process.returncode != 0:
+        plaintext[:] = bytes(len(plaintext))
+        for line in errors.decode(errors='replace').splitlines():
+            logging.error(line)
+        raise SadException("Decrypting '%s' failed (exit code %s)." % (encryptedFile, process.returncode))
+    return plaintext
 
 def isPassphraseSet():
     '''
@@ -0,0 +1,134 @@
+import atexit
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from sad_common.sadexception import SadException
+from sad_secrets.secret_helper import gpgDecryptToMemory
+
+# Runs ssh-agent -D until the standard input of the shell is closed, $1 is the agent socket
+agent_watchdog = 'ssh-agent -D -a "$1" & agent=$!; read -r line; kill $agent; wait $agent'
+
+class SshIdentity:
+    '''
+    The private ssh key of a run, decrypted once and handed to every ssh connection of the run.
+    open() loads the key into a short-lived ssh-agent of this process, listening on a socket in a
+    private temporary directory; getSshOptions() points ssh to that agent. The decrypted key is
+    overwritten in memory as soon as the agent has it and never written to the working directory.
+    close() stops the agent, so the key is gone with the run. It is also called at interpreter exit, and
+    the agent stops by itself when this process ends without close(), e.g. when it is killed with SIGKILL.
+    The key is loaded with a lifetime in addition.
+    If no ssh-agent can be started, the key is written to the private temporary directory instead
+    and overwritten and removed by close().
+    The class can be used as a context manager.
+    '''
+
+    # Seconds to wait for the agent socket
+    agent_start_timeout = 5
+
+    def __init__(self, encryptedFile: str = 'travisssh.gpg', lifetime: int = None):
+        '''
+        The encryptedFile like 'travisssh.gpg', decrypted with the passphrase of CI_GITHUB_TRAVISUSER_SWARMVM_KEY.
+        The lifetime in seconds the agent keeps the key, None to keep it until close().
+        '''
+        self.encryptedFile = encryptedFile
+        self.lifetime = lifetime
+        self.directory = None
+        self.agent = None
+        self.agentSocket = None
+        self.keyFile = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        '''
+        Decrypts the key and loads it into the agent, falls back to the temporary key file.
+        '''
+        key = gpgDecryptToMemory(self.encryptedFile)
+        try:
+            self.directory = tempfile.mkdtemp(prefix='sad-identity-')
+            atexit.register(self.close)
+            try:
+                self.startAgent(key)
+            except (OSError, SadException) as ex:
+                logging.warning("No ssh-agent for the ssh key (%s), using a temporary key file." % ex)
+                self.stopAgent()
+                self.writeKeyFile(key)
+        finally:
+            key[:] = bytes(len(key))
+        return self
+
+    def startAgent(self, key: bytearray):
+        socket = os.path.join(self.directory, 'agent')
+        if shutil.which('ssh-agent') == None:
+            raise SadException("ssh-agent not found")
+        # -D keeps the agent in the foreground, in a shell that holds the read end of a pipe from this
+        # process. The pipe is closed when this process exits, even if it is killed, and the shell then
+        # stops the agent, so the key does not outlive the run (or the daemon) for up to its lifetime.
+        self.agent = subprocess.Popen(['sh', '-c', agent_watchdog, 'sad-ssh-agent', socket], stdin=subprocess.PIPE,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        deadline = time.time() + self.agent_start_timeout
+        while not os.path.exists(socket):
+            if self.agent.poll() != None or time.time() > deadline:
+                raise SadException("ssh-agent did not start")
+            time.sleep(0.01)
+        command = ['ssh-add', '-q'] + (['-t', str(self.lifetime)] if self.lifetime != None else []) + ['-']
+        process = subprocess.run(command, input=key, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 env=dict(os.environ, SSH_AUTH_SOCK=socket))
+        if process.returncode != 0:
+            raise SadException("ssh-add failed: %s" % process.stdout.decode(errors='replace').strip())
+        self.agentSocket = socket
+        logging.info("ssh key loaded into ssh-agent (watchdog %d)" % self.agent.pid)
+
+    def writeKeyFile(self, key: bytearray):
+        keyFile = os.path.join(self.directory, 'key')
+        with open(os.open(keyFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as output:
+            output.write(key)
+        self.keyFile = keyFile
+
+    def getSshOptions(self):
+        '''
+        Returns the ssh options to authenticate with the key.
+        '''
+        if self.agentSocket != None:
+            return ['-o', 'IdentityAgent=%s' % self.agentSocket]
+        if self.keyFile != None:
+            return ['-i', self.keyFile]
+        return []
+
+    def stopAgent(self):
+        if self.agent != None:
+            # Closing the pipe stops the agent and its shell
+            self.agent.stdin.close()
+            try:
+                self.agent.wait(self.agent_start_timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.agent.pid, signal.SIGKILL)
+                self.agent.wait()
+        self.agent = None
+        self.agentSocket = None
+
+    def close(self):
+        '''
+        Stops the agent and removes the key file, can be called more than once.
+        '''
+        with self.lock:
+            self.stopAgent()
+            if self.keyFile != None:
+                with open(self.keyFile, 'r+b') as keyFile:
+                    keyFile.write(bytes(os.path.getsize(self.keyFile)))
+                self.keyFile = None
+            if self.directory != None:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                self.directory = None
+                logging.info("ssh key removed")
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *args):
+        self.close()
@@ -9,7 +9,8 @@ The script is prepared to easily switch deployment to another host. The remote u
 remote host. The remote host must be prepared with docker swarm.
 
 The remote travis user is granted access to the remote host by a private ssh-key that is registered on that host. This key is provided
-in an encypted file travisssh.gpg, which is decypted using a secret provided by the GitHub CI.
+in an encypted file travisssh.gpg, which is decypted using a secret provided by the GitHub CI. The key is decrypted into memory
+and loaded into an ssh-agent that lives as long as the run, it is never written to the working directory (see sad_secrets.ssh_identity).
 
 If the passphrase is not set in the CI_GITHUB_TRAVISUSER_SWARMVM_KEY environment variable, we fall back to pageant. This
 means you can use this script locally for development purposes, if your personal key is registered with the travis remote user.
@@ -20,58 +21,60 @@ import os
 import logging
 import argparse
 
+from sad_common.docker_helper import DockerRegistry
+from sad_common.instrumentation import tracer
 from sad_common.sad_logging import initLogging
-from sad_deploy.deploy_commands import deployImages
+from sad_common.tag_index import TagIndex
+from sad_deploy import deploy_commands
+from sad_deploy.application_config import default_application_config
+from sad_deploy.deploy_commands import checkArgs
+from sad_deploy.deploy_engine import deployImagesAsync
 
 def parseArguments():
     '''
     Parses the program arguments and returns the data parsed by argparse.
     '''
     parser = argparse.ArgumentParser(description='Deploy branch specific images of Schul-Cloud to a team assigned Docker Swarm machine.'
+            , epilog='Before the services of a host are updated, the images are pulled on its swarm manager only. Tasks scheduled '
+                     'on other nodes of the swarm still pull their image during the update.'
             , add_help=True
     )
     parser.add_argument('--version', action='version', version='1.1.0', help='Prints the script version')
     parser.add_argument('--branchprefix', type=str, choices=['feature','develop', 'release', 'master', 'hotfix'], required=True, help='Branch prefix to deploy')
     parser.add_argument('--deployhost', type=str, choices=['test', 'team','staging'], required=True, help='Destination host for deployment')
-    parser.add_argument('--teamnumber', type=int, help='the number of the team to identify the team machine')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--teamnumber', type=int, help='the number of the team to identify the team machine')
+    group.add_argument('--teamnumbers', type=str, help='Comma separated team numbers to deploy to several team machines, like 1,4,6')
+    group.add_argument('--hostinventory', type=str, help='File with one fully qualified host name per line to deploy to (deployhost team)')
     parser.add_argument('--jiraid', type=str, help='JIRA issue ID to identify the branch')
     parser.add_argument('--imageversion',type=str, help='Version number to identify the branch')
+    parser.add_argument('--appconfig', type=str, help='Application config with the applications and their rollout policies (default: applications.json)')
+    parser.add_argument('--parallel', type=int, help='Number of applications rolled out concurrently (default: parallel of the application config)')
+    parser.add_argument('--skipunchanged', action='store_true', help='Do not update services that already run the image digest of the tag')
+    parser.add_argument('--hostparallel', type=int, help='Number of hosts deployed concurrently (default: all)')
+    parser.add_argument('--convergencetimeout', type=int, help='Seconds the updated services have to run the new image, not watched if not set')
+    parser.add_argument('--convergenceinterval', type=int, default=5, help='Seconds between the task state queries per host (default: 5)')
+    parser.add_argument('--deployplan', action='store_true', help='Send all service updates of a host in one remote call (needs remote/sad-remote.py)')
+    parser.add_argument('--tracefile', type=str, help='File the timed phases of the run are appended to as JSON lines')
+    parser.add_argument('--metricsfile', type=str, help='Prometheus textfile the phase timings of the run are written to')
+    parser.add_argument('--tagcachemaxage', type=int, default=0, help='Seconds tag lookups are answered from the tag index without asking the registry (default: 0)')
+    parser.add_argument('--refreshtags', action='store_true', help='Ignore the tag index of earlier runs and fetch the tags again')
+    parser.add_argument('--notagcache', action='store_true', help='Neither read nor write the tag index')
+    parser.add_argument('--logformat', choices=['text', 'json'], default='text', help='Format of the log file in ./log, json for one JSON object per line tagged with host and application (default: text)')
     args = parser.parse_args()
+    if args.parallel != None and args.parallel < 1:
+        parser.error('--parallel must be at least 1')
+    if args.hostparallel != None and args.hostparallel < 1:
+        parser.error('--hostparallel must be at least 1')
+    if args.teamnumbers != None:
+        try:
+            args.teamnumbers = [int(number) for number in args.teamnumbers.split(',') if number.strip() != '']
+        except ValueError:
+            parser.error('--teamnumbers must be a comma separated list of numbers')
+    if args.deployhost == 'team' and args.teamnumber == None and args.teamnumbers == None and args.hostinventory == None:
+        parser.error('deployhost team requires --teamnumber, --teamnumbers or --hostinventory')
     return args
 
-def checkArgs(deployhost, branchprefix, teamnumber, jiraid, imageversion):
-    imagequalifier = ''
-    if deployhost == 'test':
-        # Deploy to the test host, just develop is supported
-        if branchprefix != 'develop':
-            raise Exception("Branch prefix 'develop' only is supported with deployhost 'test'")    
-    elif deployhost == 'staging':
-        # Deploy to the staging host, just release with matching NEXT_VERSION is supported
-        if branchprefix != 'release':
-            raise Exception("deployhost 'staging' is only supported with Branch prefix 'release'")
-        if imageversion != None:
-            # Version spezification has to be with loer case letters
-            imagequalifier = imageversion.lower()
-        else:
-            raise Exception("No imageversion is specified for branchprefix '{}'".format(branchprefix))
-    else:
-        # Deploy to the team host
-        if branchprefix == 'release' or branchprefix == 'master':
-            if imageversion != None:
-                # Version spezification has to be with loer case letters
-                imagequalifier = imageversion.lower()
-            else:
-                raise Exception("No imageversion is specified for branchprefix '{}'".format(branchprefix))
-        elif branchprefix == 'develop':
-                pass
-        else: # feature or hotfix
-            if jiraid != None:
-                # Ticket ID will be always in uppercase letters
-                imagequalifier = jiraid.upper()
-            else:
-                raise Exception("No jiraid is specified for branchprefix '{}'".format(branchprefix))
-    return imagequalifier
-
 
 if __name__ == '__main__':
     try:
@@ -84,17 +87,25 @@ if __name__ == '__main__':
             print(os.environ['PATH'])
             sys.exit(1)
 
-        initLogging()
         parsedArgs = parseArguments()
+        initLogging(parsedArgs.logformat)
         logging.info('Call arguments given: %s' % sys.argv[1:])
+        tracer.configure(parsedArgs.tracefile, parsedArgs.metricsfile)
+        deploy_commands.loadApplicationConfig(parsedArgs.appconfig or default_application_config)
+        parallel = deploy_commands.default_parallel if parsedArgs.parallel == None else parsedArgs.parallel
+        DockerRegistry.tag_index = None if parsedArgs.notagcache else TagIndex(max_age=parsedArgs.tagcachemaxage, refresh=parsedArgs.refreshtags)
         deployhost   = parsedArgs.deployhost
         branchprefix = parsedArgs.branchprefix
         jiraid = parsedArgs.jiraid
         imageversion = parsedArgs.imageversion
-        teamnumber = parsedArgs.teamnumber
+        teamnumber = parsedArgs.teamnumber if parsedArgs.teamnumbers == None else parsedArgs.teamnumbers
         imagequalifier = checkArgs(deployhost, branchprefix, teamnumber, jiraid, imageversion)
-        deployImages(deployhost, branchprefix, teamnumber, imagequalifier)
+        deployImagesAsync(deployhost, branchprefix, teamnumber, imagequalifier, parallel, parsedArgs.skipunchanged,
+                          parsedArgs.hostinventory, parsedArgs.hostparallel, parsedArgs.convergencetimeout, parsedArgs.convergenceinterval,
+                          parsedArgs.deployplan)
+        tracer.finish('sc-app-deploy', True)
     except Exception as ex:
         logging.exception(ex)
         logging.info("Deployment failed.")
+        tracer.finish('sc-app-deploy', False)
         exit(1)
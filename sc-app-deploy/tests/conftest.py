@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The packages of sc-app-deploy are imported like sc-app-deploy.py does, from its directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,67 @@
+from sad_deploy.convergence import ServiceConvergence, parseStateAge, parseTasks
+from sad_infra.application import Application
+from sad_infra.host import Host
+from sad_infra.rollout_policy import RolloutPolicy
+
+host = Host('hotfix6', 'schul-cloud.dev')
+new = 'schulcloud/schulcloud-server:develop_latest@sha256:new'
+old = 'schulcloud/schulcloud-server:develop_latest@sha256:old'
+
+def createConvergence(monitor=10, started=1000):
+    application = Application('server', 'schulcloud/schulcloud-server', 'develop_latest', 'sha256:new', RolloutPolicy(monitor=monitor))
+    return ServiceConvergence(application, host, started)
+
+def poll(convergence, now, *lines):
+    convergence.update(parseTasks(lines).get('hotfix6_server', []), now)
+
+def test_parseTasks():
+    tasks = parseTasks(['hotfix6_server|hotfix6_server.1|%s|Running 5 seconds ago|Running|' % new,
+                        'hotfix6_server|hotfix6_server.1|%s|Shutdown 6 seconds ago|Shutdown|' % old,
+                        'hotfix6_client|hotfix6_client.1|x|Failed 1 minute ago|Shutdown|task: non-zero exit (1)|more',
+                        'garbage'])
+    assert len(tasks['hotfix6_server']) == 2
+    assert tasks['hotfix6_client'][0]['error'] == 'task: non-zero exit (1)|more'
+
+def test_parseStateAge():
+    assert parseStateAge('Failed 2 minutes ago') == 120
+    assert parseStateAge('Failed about a minute ago') == 60
+    assert parseStateAge('Running less than a second ago') == 0
+    assert parseStateAge('Running 5 seconds ago') == 5
+    assert parseStateAge('Preparing') == None
+
+def test_converges_after_monitor_period():
+    convergence = createConvergence(monitor=10)
+    running = 'hotfix6_server|hotfix6_server.1|%s|Running 3 seconds ago|Running|' % new
+    replaced = 'hotfix6_server|hotfix6_server.1|%s|Shutdown 4 seconds ago|Shutdown|' % old
+    poll(convergence, 1005, running, replaced)
+    assert convergence.firstHealthy == 5 and convergence.converged == None
+    poll(convergence, 1010, running, replaced)
+    assert convergence.converged == None
+    poll(convergence, 1015, running, replaced)
+    assert convergence.converged == 5 and convergence.failed == None
+
+def test_needs_consecutive_polls_without_monitor():
+    convergence = createConvergence(monitor=0)
+    poll(convergence, 1005, 'hotfix6_server|hotfix6_server.1|%s|Running 3 seconds ago|Running|' % new)
+    assert convergence.converged == None
+    poll(convergence, 1010, 'hotfix6_server|hotfix6_server.1|%s|Starting 1 second ago|Running|' % new)
+    poll(convergence, 1015, 'hotfix6_server|hotfix6_server.1|%s|Running 3 seconds ago|Running|' % new)
+    assert convergence.converged == None
+    poll(convergence, 1020, 'hotfix6_server|hotfix6_server.1|%s|Running 8 seconds ago|Running|' % new)
+    assert convergence.converged == 15
+
+def test_crash_loop_fails():
+    convergence = createConvergence()
+    poll(convergence, 1030, 'hotfix6_server|hotfix6_server.1|%s|Running 2 seconds ago|Running|' % new,
+         'hotfix6_server|hotfix6_server.1|%s|Failed 8 seconds ago|Shutdown|task: non-zero exit (1)' % new)
+    assert convergence.converged == None
+    assert convergence.failed == '1 task(s) of the new image ended: task: non-zero exit (1)'
+
+def test_failures_before_the_update_are_ignored():
+    convergence = createConvergence(monitor=0)
+    lines = ['hotfix6_server|hotfix6_server.1|%s|Running 3 seconds ago|Running|' % new,
+             'hotfix6_server|hotfix6_server.1|%s|Failed 2 hours ago|Shutdown|task: non-zero exit (1)' % new,
+             'hotfix6_server|hotfix6_server.1|%s|Failed 5 seconds ago|Shutdown|task: non-zero exit (1)' % old]
+    poll(convergence, 1005, *lines)
+    poll(convergence, 1010, *lines)
+    assert convergence.failed == None and convergence.converged == 5
@@ -0,0 +1,15 @@
+import pytest
+
+from sad_common.sadexception import SadException
+from sad_deploy.deploy_commands import getDeployHosts
+
+def test_getDeployHosts_team_numbers(monkeypatch):
+    monkeypatch.delenv('TESTMODE', raising=False)
+    assert [host.getFQDN() for host in getDeployHosts('team', [1, 4], None)] == ['hotfix1.schul-cloud.dev', 'hotfix4.schul-cloud.dev']
+
+def test_getDeployHosts_inventory(tmp_path):
+    inventory = tmp_path / 'hosts'
+    inventory.write_text('# team machines\nhotfix6.schul-cloud.dev\n\n')
+    assert [host.getFQDN() for host in getDeployHosts('team', [None], str(inventory))] == ['hotfix6.schul-cloud.dev']
+    with pytest.raises(SadException, match='not both'):
+        getDeployHosts('team', [1], str(inventory))
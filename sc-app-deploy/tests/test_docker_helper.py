@@ -0,0 +1,60 @@
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from sad_benchmark.hub_stub import HubStub
+from sad_common.docker_helper import DockerRegistry
+from sad_common.token_cache import TokenCache
+
+repos = ['schulcloud-server', 'schulcloud-client', 'schulcloud-calendar']
+
+@pytest.fixture
+def stub(monkeypatch, tmp_path):
+    hub = HubStub(retryAfter=1)
+    for repo in repos:
+        hub.addRepository(repo, [('develop_latest', datetime(2021, 2, 1, tzinfo=timezone.utc))])
+    url = hub.start()
+    monkeypatch.setattr(DockerRegistry, 'base_url', url + '/v2')
+    monkeypatch.setattr(DockerRegistry, 'tag_index', None)
+    monkeypatch.setenv('SAD_TOKEN_CACHE', str(tmp_path / 'tokens.json'))
+    monkeypatch.setenv('DOCKER_USERNAME', 'user')
+    monkeypatch.setenv('DOCKER_TOKEN', 'secret')
+    yield hub
+    hub.stop()
+
+def createRegistry():
+    registry = DockerRegistry('schulcloud')
+    registry.dockerRegistryLogin()
+    return registry
+
+def test_checkTags(stub):
+    assert createRegistry().checkTags(repos + ['schulcloud-missing'], 'develop_latest') == dict(
+        [(repo, True) for repo in repos] + [('schulcloud-missing', False)])
+    assert stub.requests['tag'] == 4
+
+def test_checkTags_waits_for_retry_after(stub):
+    registry = createRegistry()
+    stub.rateLimitEvery = 2
+    start = time.time()
+    assert registry.checkTags(repos, 'develop_latest') == dict((repo, True) for repo in repos)
+    assert stub.requests['429'] >= 1
+    assert time.time() - start >= stub.retryAfter
+
+def test_checkTags_retries_server_errors(stub):
+    registry = createRegistry()
+    stub.failRequests(2)
+    assert registry.checkTags(repos, 'develop_latest') == dict((repo, True) for repo in repos)
+    assert stub.requests['502'] == 2
+
+def test_checkTags_logs_in_again_after_401(stub):
+    stub.requireToken = True
+    TokenCache().putToken('user', DockerRegistry.base_url, stub.token)
+    stub.expireToken()
+    registry = createRegistry()
+    assert stub.requests.get('login') == None
+    assert registry.checkTags(repos, 'develop_latest') == dict((repo, True) for repo in repos)
+    # The concurrent lookups share one fresh login, which replaces the cached token
+    assert stub.requests['login'] == 1
+    assert stub.requests['401'] == len(repos)
+    assert TokenCache().getToken('user', DockerRegistry.base_url) == stub.token
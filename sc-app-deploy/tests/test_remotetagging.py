@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+# remotetagging.py is a script in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from remotetagging import TagOperation, parseArguments, planOperations
+
+def describe(*tags):
+    return [{'name': name, 'digest': digest} for name, digest in tags]
+
+def test_glob_deletion_of_one_digest_deletes_all_tags():
+    descriptions = {'server': describe(('develop_latest', 'sha256:d'), ('feature_SC-1_1', 'sha256:a'), ('feature_SC-1_latest', 'sha256:a'))}
+    aliases = {'server': [tag['name'] for tag in descriptions['server']]}
+    plan, rejected, skipped, together = planOperations([TagOperation('del', 'server', 'feature_SC-1*')], aliases, descriptions)
+    assert [operation.tag for operation in plan] == ['feature_SC-1_1']
+    assert [(operation.tag, removedWith.tag) for operation, removedWith in together] == [('feature_SC-1_latest', 'feature_SC-1_1')]
+    assert together[0][1] is plan[0]
+    assert rejected == [] and skipped == []
+
+def test_deletion_sharing_the_digest_of_a_kept_or_added_tag_is_skipped():
+    descriptions = {'server': describe(('develop_latest', 'sha256:d'), ('feature_SC-1_latest', 'sha256:d'), ('feature_SC-2_latest', 'sha256:b'))}
+    aliases = {'server': [tag['name'] for tag in descriptions['server']]}
+    operations = [TagOperation('del', 'server', 'feature_*'), TagOperation('add', 'server', 'feature_SC-2_latest', 'staging')]
+    plan, rejected, skipped, together = planOperations(operations, aliases, descriptions)
+    assert [operation.action for operation in plan] == ['add']
+    assert sorted(operation.tag for operation, _ in skipped) == ['feature_SC-1_latest', 'feature_SC-2_latest']
+    assert together == []
+
+@pytest.mark.parametrize('rate', ['0', '-1'])
+def test_rate_must_be_positive(monkeypatch, rate):
+    monkeypatch.setattr(sys, 'argv', ['remotetagging.py', '--retention', '--repo', 'all', '--max-age', '30', '--rate', rate])
+    with pytest.raises(SystemExit):
+        parseArguments()
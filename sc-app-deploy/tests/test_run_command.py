@@ -0,0 +1,43 @@
+import threading
+import time
+
+import pytest
+
+from sad_common.run_command import Cancellation, runCommand
+from sad_common.sadexception import SadException
+
+def test_output_and_returncode():
+    result = runCommand(['sh', '-c', 'echo one; echo two; exit 3'], check=False)
+    assert result.returncode == 3
+    assert result.output == ['one', 'two']
+    assert not result.timedout
+
+def test_timeout_kills_background_children():
+    start = time.time()
+    result = runCommand(['sh', '-c', 'sleep 4 & sleep 5'], timeout=0.5, check=False)
+    assert result.timedout
+    assert time.time() - start < 2
+
+def test_cancel_kills_the_process_group():
+    cancel = Cancellation()
+    threading.Timer(0.3, cancel.set).start()
+    start = time.time()
+    with pytest.raises(SadException, match='cancelled'):
+        runCommand(['sh', '-c', 'sleep 4 & sleep 5'], cancel=cancel)
+    assert time.time() - start < 2
+
+def test_cancel_after_the_command_does_not_change_the_result():
+    cancel = Cancellation()
+    result = runCommand(['sh', '-c', 'echo done'], cancel=cancel, timeout=5)
+    cancel.set()
+    assert result.returncode == 0
+    assert not result.cancelled
+
+def test_cancel_without_timeout_stops_the_watcher():
+    cancel = Cancellation()
+    threads = threading.active_count()
+    for _ in range(3):
+        assert runCommand(['sh', '-c', 'echo done'], cancel=cancel).output == ['done']
+    # The watchers woke up when their command finished and were joined
+    assert threading.active_count() == threads
+    assert not cancel.is_set()
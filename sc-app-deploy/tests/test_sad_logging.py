@@ -0,0 +1,27 @@
+import logging
+import queue
+
+from sad_common.sad_logging import BoundedQueueHandler
+
+def makeRecord(level, commandOutput=False):
+    record = logging.LogRecord('test', level, __file__, 1, 'line', None, None)
+    if commandOutput:
+        record.command_output = True
+    return record
+
+def test_full_queue_drops_debug_and_command_output():
+    recordQueue = queue.Queue(maxsize=1)
+    handler = BoundedQueueHandler(recordQueue)
+    handler.enqueue(makeRecord(logging.INFO))
+    handler.enqueue(makeRecord(logging.DEBUG))
+    handler.enqueue(makeRecord(logging.INFO, commandOutput=True))
+    assert handler.dropped == 2
+    assert recordQueue.qsize() == 1
+
+def test_command_output_is_queued_while_there_is_room():
+    recordQueue = queue.Queue(maxsize=2)
+    handler = BoundedQueueHandler(recordQueue)
+    handler.enqueue(makeRecord(logging.INFO, commandOutput=True))
+    handler.enqueue(makeRecord(logging.DEBUG))
+    assert handler.dropped == 0
+    assert recordQueue.qsize() == 2
@@ -0,0 +1,12 @@
+import io
+
+from sad_secrets.secret_helper import readIntoBuffer
+
+def test_readIntoBuffer_grows_the_buffer():
+    data = bytes(range(256)) * 10
+    plaintext = readIntoBuffer(io.BytesIO(data), size=16)
+    assert isinstance(plaintext, bytearray)
+    assert plaintext == data
+
+def test_readIntoBuffer_empty_stream():
+    assert readIntoBuffer(io.BytesIO(b''), size=16) == bytearray()
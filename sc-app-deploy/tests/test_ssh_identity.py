@@ -0,0 +1,108 @@
+import os
+import shutil
+import signal
+import stat
+import subprocess
+import sys
+import time
+
+import pytest
+
+from sad_secrets.ssh_identity import SshIdentity
+
+pytestmark = pytest.mark.skipif(None in (shutil.which('gpg'), shutil.which('ssh-keygen')), reason='gpg and ssh-keygen are required')
+
+requiresAgent = pytest.mark.skipif(None in (shutil.which('ssh-agent'), shutil.which('ssh-add')), reason='ssh-agent is required')
+
+@pytest.fixture
+def encryptedKey(monkeypatch, tmp_path):
+    '''
+    Returns the file name of a new ssh key encrypted like travisssh.gpg and the plain key.
+    '''
+    gnupg = tmp_path / 'gnupg'
+    gnupg.mkdir(mode=0o700)
+    monkeypatch.setenv('GNUPGHOME', str(gnupg))
+    monkeypatch.setenv('CI_GITHUB_TRAVISUSER_SWARMVM_KEY', 'secret')
+    keyFile = str(tmp_path / 'key')
+    subprocess.run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', keyFile], check=True)
+    subprocess.run(['gpg', '--quiet', '--batch', '--yes', '--pinentry-mode', 'loopback', '--passphrase', 'secret', '--symmetric',
+                    '--output', keyFile + '.gpg', keyFile], check=True)
+    with open(keyFile, 'rb') as plain:
+        key = plain.read()
+    yield keyFile + '.gpg', key
+    subprocess.run(['gpgconf', '--kill', 'gpg-agent'], stderr=subprocess.DEVNULL)
+
+def listAgentKeys(socket):
+    return subprocess.run(['ssh-add', '-l'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=dict(os.environ, SSH_AUTH_SOCK=socket))
+
+def fingerprint(keyFile):
+    return subprocess.run(['ssh-keygen', '-l', '-f', keyFile], stdout=subprocess.PIPE, check=True).stdout.split()[1]
+
+@requiresAgent
+def test_agent_keeps_the_key_for_its_lifetime(encryptedKey):
+    encryptedFile, _ = encryptedKey
+    with SshIdentity(encryptedFile, lifetime=1) as identity:
+        socket = identity.agentSocket
+        assert identity.getSshOptions() == ['-o', 'IdentityAgent=%s' % socket]
+        assert identity.keyFile == None
+        assert fingerprint(encryptedFile[:-len('.gpg')]) in listAgentKeys(socket).stdout
+        # ssh-add -t: the agent drops the key after the lifetime
+        deadline = time.time() + 5
+        while listAgentKeys(socket).returncode == 0:
+            assert time.time() < deadline
+            time.sleep(0.1)
+        directory = identity.directory
+    assert not os.path.exists(directory)
+    assert listAgentKeys(socket).returncode == 2
+
+def test_falls_back_to_a_private_key_file(encryptedKey, monkeypatch, tmp_path):
+    encryptedFile, key = encryptedKey
+    # An ssh-agent that cannot start
+    stubs = tmp_path / 'bin'
+    stubs.mkdir()
+    (stubs / 'ssh-agent').write_text('#!/bin/sh\nexit 1\n')
+    (stubs / 'ssh-agent').chmod(0o755)
+    monkeypatch.setenv('PATH', '%s%s%s' % (stubs, os.pathsep, os.environ['PATH']))
+    # The watchdog shell outlives the failed agent, its socket never appears
+    monkeypatch.setattr(SshIdentity, 'agent_start_timeout', 0.5)
+    identity = SshIdentity(encryptedFile).open()
+    keyFile = identity.keyFile
+    assert identity.agentSocket == None
+    assert identity.getSshOptions() == ['-i', keyFile]
+    assert stat.S_IMODE(os.stat(keyFile).st_mode) == 0o600
+    with open(keyFile, 'rb') as opened:
+        assert opened.read() == key
+        directory = identity.directory
+        identity.close()
+        # The file is overwritten before it is removed
+        opened.seek(0)
+        assert opened.read() == bytes(len(key))
+    assert not os.path.exists(directory)
+    assert identity.getSshOptions() == []
+    identity.close()
+
+@requiresAgent
+def test_agent_stops_when_the_process_is_killed(encryptedKey):
+    encryptedFile, _ = encryptedKey
+    script = ('import sys, time\n'
+              'from sad_secrets.ssh_identity import SshIdentity\n'
+              'print(SshIdentity(sys.argv[1]).open().agentSocket, flush=True)\n'
+              'time.sleep(60)\n')
+    process = subprocess.Popen([sys.executable, '-c', script, encryptedFile], stdout=subprocess.PIPE,
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    socket = process.stdout.readline().decode().strip()
+    try:
+        assert listAgentKeys(socket).returncode == 0
+        # No close() and no atexit handler, only the closed pipe stops the agent
+        process.send_signal(signal.SIGKILL)
+        process.wait()
+        deadline = time.time() + 5
+        while listAgentKeys(socket).returncode != 2:
+            assert time.time() < deadline
+            time.sleep(0.1)
+    finally:
+        process.stdout.close()
+        if process.poll() == None:
+            process.kill()
+            process.wait()
+        shutil.rmtree(os.path.dirname(socket), ignore_errors=True)
@@ -0,0 +1,76 @@
+import os
+import sys
+
+import pytest
+
+from sad_common.ssh_transport import SshTransport
+from sad_infra.host import Host
+
+fake_ssh = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sad_benchmark', 'fake_ssh.py')
+connect_delay = 0.3
+
+@pytest.fixture
+def fakeSsh(monkeypatch, tmp_path):
+    '''
+    Points SshTransport to sad_benchmark/fake_ssh.py, returns a function reading the logged ssh invocations.
+    '''
+    monkeypatch.setenv('SAD_SSH_COMMAND', '%s %s' % (sys.executable, fake_ssh))
+    monkeypatch.setenv('SAD_FAKE_SSH_DELAY', '0')
+    monkeypatch.setenv('SAD_FAKE_SSH_CONNECT_DELAY', str(connect_delay))
+    monkeypatch.setenv('SAD_FAKE_SSH_STATE', str(tmp_path))
+    monkeypatch.setenv('SAD_FAKE_SSH_LOG', str(tmp_path / 'ssh.log'))
+
+    def invocations():
+        if not os.path.exists(tmp_path / 'ssh.log'):
+            return []
+        with open(tmp_path / 'ssh.log') as log:
+            return [line.split()[1] for line in log]
+    return invocations
+
+host = Host('hotfix6', 'schul-cloud.dev')
+
+def test_runs_reuse_the_master_connection(fakeSsh):
+    transport = SshTransport(host).open()
+    try:
+        assert transport.isAlive()
+        transport.run(['schulcloud/schulcloud-server:develop_latest', 'hotfix6_server'])
+        result = transport.run(['inspect', 'hotfix6_server'])
+        assert result.output[0].startswith('hotfix6_server schulcloud/schulcloud-server:develop_latest@')
+        transport.run(['inspect', 'hotfix6_client'])
+    finally:
+        transport.close()
+    assert fakeSsh() == ['master', 'update', 'inspect', 'inspect', 'exit']
+    assert transport.commandCount == 3
+
+def test_connect_time_is_measured_apart_from_the_commands(fakeSsh):
+    with SshTransport(host) as transport:
+        transport.run(['inspect', 'hotfix6_server'])
+        transport.run(['inspect', 'hotfix6_server'])
+    assert transport.connectTime >= connect_delay
+    # The commands over the master connection are not charged the connect delay
+    assert transport.commandTime < 2 * connect_delay
+
+def test_close_stops_the_master_connection(fakeSsh):
+    transport = SshTransport(host).open()
+    controlDir = transport.controlDir
+    transport.close()
+    assert not os.path.exists(controlDir)
+    assert not transport.isAlive()
+    assert fakeSsh()[-1] == 'exit'
+
+def test_falls_back_to_one_connection_per_command(fakeSsh, monkeypatch, tmp_path):
+    # An ssh without multiplexing: the master connection fails, commands work
+    wrapper = tmp_path / 'ssh'
+    wrapper.write_text('#!/bin/sh\nfor arg in "$@"; do [ "$arg" = "-N" ] && exit 255; done\nexec %s %s "$@"\n' % (sys.executable, fake_ssh))
+    wrapper.chmod(0o755)
+    monkeypatch.setenv('SAD_SSH_COMMAND', str(wrapper))
+    transport = SshTransport(host).open()
+    try:
+        assert transport.controlPath == None
+        assert transport.connectTime == None
+        assert not transport.isAlive()
+        assert transport.run(['inspect', 'hotfix6_server']).returncode == 0
+        assert transport.commandTime >= connect_delay
+    finally:
+        transport.close()
+    assert fakeSsh() == ['inspect']
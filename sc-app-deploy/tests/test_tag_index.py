@@ -0,0 +1,83 @@
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+from sad_benchmark.hub_stub import HubStub
+from sad_common.docker_helper import DockerRegistry
+from sad_common.tag_index import TagIndex
+
+tags = [('develop_latest', datetime(2021, 2, 1, tzinfo=timezone.utc)), ('master_latest', datetime(2021, 1, 1, tzinfo=timezone.utc))]
+
+@pytest.fixture
+def stub(monkeypatch, tmp_path):
+    hub = HubStub()
+    hub.addRepository('schulcloud-server', tags)
+    url = hub.start()
+    monkeypatch.setattr(DockerRegistry, 'base_url', url + '/v2')
+    monkeypatch.setenv('SAD_TAG_INDEX', str(tmp_path / 'tags'))
+    monkeypatch.setenv('SAD_TOKEN_CACHE', str(tmp_path / 'tokens.json'))
+    monkeypatch.setenv('DOCKER_USERNAME', 'user')
+    monkeypatch.setenv('DOCKER_TOKEN', 'secret')
+    yield hub
+    hub.stop()
+
+def createRegistry(monkeypatch, max_age=0, refresh=False):
+    monkeypatch.setattr(DockerRegistry, 'tag_index', TagIndex(max_age=max_age, refresh=refresh))
+    registry = DockerRegistry('schulcloud')
+    registry.dockerRegistryLogin()
+    return registry
+
+def test_getTag_revalidates_with_etag(stub, monkeypatch):
+    registry = createRegistry(monkeypatch)
+    description = registry.dockerRegistryGetTag('schulcloud-server', 'develop_latest')
+    assert stub.requests.get('304') == None
+    assert createRegistry(monkeypatch).dockerRegistryGetTag('schulcloud-server', 'develop_latest') == description
+    assert stub.requests['tag'] == 2
+    assert stub.requests['304'] == 1
+
+def test_getTag_within_staleness_window(stub, monkeypatch):
+    description = createRegistry(monkeypatch).dockerRegistryGetTag('schulcloud-server', 'develop_latest')
+    registry = createRegistry(monkeypatch, max_age=60)
+    assert registry.dockerRegistryGetTag('schulcloud-server', 'develop_latest')['digest'] == description['digest']
+    # A tag missing from a fresh listing is not requested either
+    list(registry.listTags('schulcloud-server'))
+    assert registry.dockerRegistryGetTag('schulcloud-server', 'feature_latest') == None
+    assert stub.requests['tag'] == 1
+
+def test_getTag_refresh_ignores_earlier_runs(stub, monkeypatch):
+    createRegistry(monkeypatch, max_age=60).dockerRegistryGetTag('schulcloud-server', 'develop_latest')
+    registry = createRegistry(monkeypatch, max_age=60, refresh=True)
+    registry.dockerRegistryGetTag('schulcloud-server', 'develop_latest')
+    assert stub.requests['tag'] == 2
+    assert stub.requests.get('304') == None
+    # Entries stored by this run are used again
+    registry.dockerRegistryGetTag('schulcloud-server', 'develop_latest')
+    assert stub.requests['tag'] == 2
+
+def test_getTag_removes_missing_tag(stub, monkeypatch):
+    registry = createRegistry(monkeypatch)
+    registry.dockerRegistryGetTag('schulcloud-server', 'develop_latest')
+    assert DockerRegistry.tag_index.getTag('schulcloud/schulcloud-server', 'develop_latest') != None
+    stub.addRepository('schulcloud-server', tags[1:])
+    assert registry.dockerRegistryGetTag('schulcloud-server', 'develop_latest') == None
+    assert DockerRegistry.tag_index.getTag('schulcloud/schulcloud-server', 'develop_latest') == None
+
+def test_listTags_touches_unchanged_listing(stub, monkeypatch):
+    registry = createRegistry(monkeypatch)
+    listing = list(registry.listTags('schulcloud-server', page_size=1))
+    assert [tag['name'] for tag in listing] == ['develop_latest', 'master_latest']
+    _, listed, _ = DockerRegistry.tag_index.getListing('schulcloud/schulcloud-server')
+    assert list(registry.listTags('schulcloud-server', page_size=1)) == listing
+    assert stub.requests['list'] == 3
+    assert stub.requests['304'] == 1
+    _, touched, _ = DockerRegistry.tag_index.getListing('schulcloud/schulcloud-server')
+    assert touched > listed
+
+def test_getPath_does_not_collide(tmp_path):
+    index = TagIndex(directory=str(tmp_path))
+    assert index.getPath('a_b/c') != index.getPath('a/b_c')
+    index.putTag('a_b/c', {'name': 'latest', 'digest': 'sha256:1'})
+    index.putTag('a/b_c', {'name': 'latest', 'digest': 'sha256:2'})
+    assert index.getTag('a_b/c', 'latest')['description']['digest'] == 'sha256:1'
+    assert os.path.isfile(os.path.join(str(tmp_path), 'a', 'b_c.json'))
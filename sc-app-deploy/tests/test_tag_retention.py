@@ -0,0 +1,37 @@
+from datetime import datetime, timezone
+
+from sad_common.tag_retention import RetentionPolicy, selectExpiredTags
+
+now = datetime(2021, 3, 1, tzinfo=timezone.utc).timestamp()
+
+def tag(name, digest, day):
+    return {'name': name, 'digest': digest, 'last_updated': '2021-02-%02dT10:00:00.000000Z' % day}
+
+def test_old_tags_beyond_keep_last_expire():
+    tags = [tag('feature_SC-%d_latest' % day, 'sha256:%d' % day, day) for day in range(1, 8)]
+    expired, skipped, together = selectExpiredTags(tags, RetentionPolicy(keep_last=2, max_age_days=20), now)
+    assert sorted(name for name, _ in expired) == ['feature_SC-1_latest', 'feature_SC-2_latest', 'feature_SC-3_latest', 'feature_SC-4_latest',
+                                                   'feature_SC-5_latest']
+    assert skipped == []
+
+def test_alias_of_unmanaged_tag_is_kept():
+    tags = [tag('develop_latest', 'sha256:a', 2), tag('feature_SC-1_latest', 'sha256:a', 1), tag('feature_SC-2_latest', 'sha256:b', 1)]
+    expired, skipped, together = selectExpiredTags(tags, RetentionPolicy(max_age_days=10), now)
+    assert expired == [('feature_SC-2_latest', '27 days old')]
+    assert [name for name, _ in skipped] == ['feature_SC-1_latest']
+    assert "'develop_latest'" in skipped[0][1]
+
+def test_alias_of_protected_or_newest_tag_is_kept():
+    tags = [tag('hotfix_SC-9_latest', 'sha256:p', 1), tag('hotfix_SC-5_latest', 'sha256:h', 28), tag('hotfix_SC-1_latest', 'sha256:p', 1),
+            tag('feature_SC-3_latest', 'sha256:n', 28), tag('feature_SC-1_latest', 'sha256:n', 1)]
+    expired, skipped, together = selectExpiredTags(tags, RetentionPolicy(keep_last=1, max_age_days=10, protected=['hotfix_SC-9*']), now)
+    assert expired == []
+    assert sorted(name for name, _ in skipped) == ['feature_SC-1_latest', 'hotfix_SC-1_latest']
+
+def test_expired_tags_of_one_digest_are_deleted_once():
+    tags = [tag('feature_SC-1_latest', 'sha256:a', 1), tag('feature_SC-2_latest', 'sha256:a', 1), tag('feature_SC-3_latest', None, 1)]
+    expired, skipped, together = selectExpiredTags(tags, RetentionPolicy(max_age_days=10), now)
+    assert [name for name, _ in expired] == ['feature_SC-1_latest']
+    assert together == [('feature_SC-2_latest', 'feature_SC-1_latest')]
+    assert [name for name, _ in skipped] == ['feature_SC-3_latest']
+    assert skipped[0][1].startswith('digest unknown')